@@ -0,0 +1,357 @@
+#!/usr/bin/env python
+"""
+Pencil's benchmark harness.
+Starts a pencil server (`pencil/pencil.py`, as a separate process) in front of
+a fake carbon server that just counts what it receives, then drives the pencil
+UDP port with a configurable load generator, at increasing packet rates.
+
+For every rate, the loss rate is measured by comparing the amount of packets
+sent with the amount of packets pencil reports through its command server.
+The report holds:
+
+1. the maximum sustainable packet rate - the highest rate with a loss rate
+   under --max-loss.
+2. the loss rate, kernel drops and pencil's parse time for every rate.
+3. flush latency percentiles, from the pencil.flush_duration_ms gauge pencil
+   sends to (the fake) carbon.
+4. resident memory per metric key.
+
+Usage:
+
+    ./benchmarks/bench.py --keys 10000 --mix 70:10:20 --start-rate 5000
+    ./benchmarks/bench.py --setting receive_mode='"batched"' --output results.json
+
+Pencil settings are passed as --setting name=<json value>. only linux is supported,
+since memory is read from /proc.
+"""
+
+import os
+import sys
+import time
+import json
+import random
+import socket
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+try:
+    import SocketServer
+except ImportError:
+    # python 3
+    import socketserver as SocketServer
+from optparse import OptionParser
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PENCIL = os.path.join(ROOT, 'pencil', 'pencil.py')
+
+
+class FakeCarbon(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """
+    A carbon line protocol server counting datapoints and bytes,
+    and keeping the values of pencil's flush duration gauge.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, flush_metric):
+        SocketServer.TCPServer.__init__(self, address, CarbonHandler)
+        self.flush_metric = flush_metric
+        self.lock = threading.Lock()
+        self.datapoints = 0
+        self.bytes = 0
+        self.flush_durations = []
+
+
+class CarbonHandler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        server = self.server
+        prefix = (server.flush_metric + ' ').encode('ascii')
+        for line in self.rfile:
+            with server.lock:
+                server.datapoints += 1
+                server.bytes += len(line)
+                if line.startswith(prefix):
+                    server.flush_durations.append(float(line.split()[1]))
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    if not values:
+        return None
+    index = int(round(pct / 100.0 * (len(values) - 1)))
+    return values[index]
+
+
+def rss_bytes(pid):
+    for line in open('/proc/%d/status' % (pid)):
+        if line.startswith('VmRSS:'):
+            return int(line.split()[1]) * 1024
+    return 0
+
+
+def build_packets(options, count=20000):
+    """
+    A pool of random packets following the key cardinality and metric type mix,
+    built up front so generating load costs as little as possible.
+    """
+    mix = [int(part) for part in options.mix.split(':')]
+    types = ['c'] * mix[0] + ['g'] * mix[1] + ['ms'] * mix[2]
+    packets = []
+    for i in range(count):
+        lines = []
+        for j in range(options.metrics_per_packet):
+            metric_type = random.choice(types)
+            key = 'bench.%s.%d' % (metric_type, random.randrange(options.keys))
+            lines.append('%s:%d|%s' % (key, random.randint(1, 1000), metric_type))
+        packets.append('\n'.join(lines).encode('ascii'))
+    return packets
+
+
+def every_key_packets(options):
+    """
+    Packets touching every key once, to measure memory with all keys in place.
+    """
+    mix = [int(part) for part in options.mix.split(':')]
+    types = [t for t, weight in zip(['c', 'g', 'ms'], mix) if weight]
+    packets = []
+    for i in range(options.keys):
+        for metric_type in types:
+            packets.append(('bench.%s.%d:1|%s' % (metric_type, i, metric_type)).encode('ascii'))
+    return packets
+
+
+def send_packets(address, packets, rate, duration, sent):
+    """
+    Send packets from the pool at `rate` packets per second, for `duration` seconds.
+    packets are sent in small bursts, sleeping between bursts to keep the pace.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    burst = max(1, rate // 1000)
+    count = 0
+    pool_size = len(packets)
+    start = time.time()
+    deadline = start + duration
+    while True:
+        now = time.time()
+        if now >= deadline:
+            break
+        for i in range(burst):
+            sock.sendto(packets[(count + i) % pool_size], address)
+        count += burst
+        ahead = start + float(count) / rate - time.time()
+        if ahead > 0:
+            time.sleep(ahead)
+    with sent.get_lock():
+        sent.value += count
+
+
+def generate_load(address, packets, rate, duration, senders):
+    sent = multiprocessing.Value('l', 0)
+    processes = [
+        multiprocessing.Process(target=send_packets,
+            args=(address, packets, max(1, rate // senders), duration, sent))
+        for i in range(senders)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    return sent.value
+
+
+def command(address, name):
+    """
+    Run a command on pencil's command server, and return its output lines.
+    """
+    sock = socket.create_connection(address)
+    fileobj = sock.makefile('rw')
+    fileobj.readline()
+    fileobj.write('%s\r\n' % (name))
+    fileobj.flush()
+    sock.settimeout(0.5)
+    lines = []
+    try:
+        while True:
+            line = fileobj.readline()
+            if not line:
+                break
+            lines.append(line.strip())
+    except socket.timeout:
+        pass
+    try:
+        fileobj.write('quit\r\n')
+        fileobj.flush()
+    except socket.error:
+        pass
+    sock.close()
+    return lines
+
+
+def pencil_stats(address):
+    stats = {}
+    for line in command(address, 'stats'):
+        if ': ' in line:
+            name, value = line.split(': ', 1)
+            stats[name] = float(value)
+    return stats
+
+
+def wait_for_port(address, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            command(address, 'quit')
+            return
+        except socket.error:
+            time.sleep(0.1)
+    raise RuntimeError('pencil did not start listening on %s:%s' % address)
+
+
+def run(options, settings):
+    bind = ('127.0.0.1', options.port)
+    management = ('127.0.0.1', options.port + 1)
+    carbon_address = ('127.0.0.1', options.port + 2)
+
+    carbon = FakeCarbon(carbon_address, '%s.flush_duration_ms' % (settings.get('instrumentation_prefix', 'pencil')))
+    carbon_thread = threading.Thread(target=carbon.serve_forever)
+    carbon_thread.daemon = True
+    carbon_thread.start()
+
+    workdir = tempfile.mkdtemp(prefix='pencil-bench-')
+    pencil_settings = {
+        'bind_adress': '%s:%d' % bind,
+        'management_address': '%s:%d' % management,
+        'graphite_address': '%s:%d' % carbon_address,
+        'flush_interval': options.flush_interval,
+        'log_name': os.path.join(workdir, 'pencil.log'),
+        'log_level': 'error',
+        'spool_path': None,
+        'instrumentation': True,
+    }
+    pencil_settings.update(settings)
+    settings_path = os.path.join(workdir, 'settings.json')
+    json.dump(pencil_settings, open(settings_path, 'w'))
+
+    devnull = open(os.devnull, 'w')
+    server = subprocess.Popen([sys.executable, PENCIL, settings_path],
+        cwd=os.path.dirname(PENCIL), stdout=devnull, stderr=devnull)
+    results = {'settings': pencil_settings, 'steps': []}
+    try:
+        wait_for_port(management)
+        rss_start = rss_bytes(server.pid)
+
+        # touch every key, so memory is measured with the whole key set in place.
+        generate_load(bind, every_key_packets(options), options.start_rate,
+            float(options.keys * 3) / options.start_rate, 1)
+        time.sleep(options.flush_interval * 2)
+        results['rss_per_key'] = float(rss_bytes(server.pid) - rss_start) / options.keys
+
+        packets = build_packets(options)
+        rate = options.start_rate
+        results['max_sustainable_rate'] = None
+        while rate <= options.max_rate:
+            before = pencil_stats(management)
+            sent = generate_load(bind, packets, rate, options.duration, options.senders)
+            # let pencil drain its socket buffer before counting. ingest workers
+            # only report their packet counts on flush, so wait for one as well.
+            time.sleep(options.flush_interval + 1)
+            after = pencil_stats(management)
+            received = after['packets'] - before['packets']
+            step = {
+                'rate': rate,
+                'sent': sent,
+                'received': int(received),
+                'loss': 1.0 - received / max(sent, 1),
+                'kernel_drops': int(after['kernel_drops'] - before['kernel_drops']),
+                'parse_time_ms': after['parse_time_ms'] - before['parse_time_ms'],
+                'achieved_rate': sent / float(options.duration),
+            }
+            results['steps'].append(step)
+            print('rate %(rate)8d pps: sent %(sent)9d, received %(received)9d, loss %(loss)6.2f%%, '
+                  'kernel drops %(kernel_drops)8d' % dict(step, loss=step['loss'] * 100))
+
+            if step['loss'] > options.max_loss:
+                break
+            if step['achieved_rate'] < rate * 0.9:
+                print('the load generator could not keep up, add more --senders.')
+                break
+            results['max_sustainable_rate'] = rate
+            rate = int(rate * options.step)
+
+        results['rss'] = rss_bytes(server.pid)
+    finally:
+        try:
+            command(management, 'stop_server')
+        except socket.error:
+            pass
+        time.sleep(options.flush_interval + 1)
+        if server.poll() is None:
+            server.terminate()
+        server.wait()
+        carbon.shutdown()
+
+    durations = carbon.flush_durations
+    results['flush_latency_ms'] = dict(
+        ('p%s' % (pct), percentile(durations, pct)) for pct in (50, 90, 99, 100)
+    )
+    results['datapoints_received'] = carbon.datapoints
+    results['bytes_received'] = carbon.bytes
+    return results
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--keys', type='int', default=1000,
+        help='distinct metric keys (default: %default)')
+    parser.add_option('--mix', default='70:10:20',
+        help='counter:gauge:timer ratio of generated metrics (default: %default)')
+    parser.add_option('--metrics-per-packet', type='int', default=1,
+        help='newline separated metrics in every packet (default: %default)')
+    parser.add_option('--start-rate', type='int', default=5000,
+        help='packets per second of the first step (default: %default)')
+    parser.add_option('--max-rate', type='int', default=1000000,
+        help='stop after this packet rate (default: %default)')
+    parser.add_option('--step', type='float', default=1.5,
+        help='packet rate multiplier between steps (default: %default)')
+    parser.add_option('--duration', type='float', default=10,
+        help='seconds to send every step for (default: %default)')
+    parser.add_option('--max-loss', type='float', default=0.001,
+        help='highest loss rate still considered sustainable (default: %default)')
+    parser.add_option('--senders', type='int', default=1,
+        help='load generator processes (default: %default)')
+    parser.add_option('--flush-interval', type='int', default=2,
+        help='pencil flush interval, in seconds (default: %default)')
+    parser.add_option('--port', type='int', default=28125,
+        help='UDP port for pencil. the next two ports are used for the '
+             'command server and the fake carbon server (default: %default)')
+    parser.add_option('--setting', action='append', default=[],
+        help='a pencil setting, as name=<json value>. may be repeated')
+    parser.add_option('--output',
+        help='write the results, as JSON, to this file')
+    options, args = parser.parse_args()
+
+    settings = {}
+    for setting in options.setting:
+        name, value = setting.split('=', 1)
+        settings[name] = json.loads(value)
+
+    results = run(options, settings)
+
+    print('')
+    print('max sustainable rate: %s pps' % (results['max_sustainable_rate']))
+    print('flush latency (ms): %s' % (', '.join(
+        '%s=%s' % (k, v) for k, v in sorted(results['flush_latency_ms'].items())
+    )))
+    print('memory per key: %.1f bytes (total RSS %d bytes)' % (results['rss_per_key'], results['rss']))
+    print('carbon received %d datapoints, %d bytes' % (
+        results['datapoints_received'], results['bytes_received']
+    ))
+
+    if options.output:
+        json.dump(results, open(options.output, 'w'), indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,4 @@
-from pencil.pencil import PencilServer, main
+from .pencil import PencilServer, main
 
 __all__ = ['PencilServer', ]
 VERSION = (0, 1, 0)
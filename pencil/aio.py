@@ -0,0 +1,546 @@
+"""
+The asyncio runtime.
+Runs the pencil server on an asyncio event loop instead of gevent, on python 3.7 and up.
+when uvloop (https://github.com/MagicStack/uvloop) is installed, its event loop is used.
+
+1. UDP ingest - an asyncio `DatagramProtocol`, parsing every datagram as it arrives
+   (or buffering it until the next flush, in the 'buffered' ingest mode).
+2. TCP ingest, batches of edge pencils (see forward.py) and the command server - asyncio streams.
+3. graphite - asyncio streams, with the same spool, replay rate and reconnect backoff
+   as the gevent runtime.
+4. flushing - a task flushing every window of the flush schedule (see scheduler.py).
+
+Parsing, aggregation, formatting, the bookkeeping of flushes and spools, and the commands themselves
+are shared with the gevent runtime: only the I/O is done differently.
+ingest workers and the 'batched' receive mode are only available with gevent.
+"""
+
+import time
+import socket
+import asyncio
+import logging
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import uvloop
+except ImportError:
+    # uvloop is optional, fall back to asyncio's own event loop.
+    uvloop = None
+
+from .pencil import PencilServer
+from .connection import GraphiteConnection
+from .graphite_client import GraphiteBackend, get_timestamp
+from .command_server import CommandServer
+from .forward import FRAME_HEADER, MAX_BATCH_SIZE
+
+
+def split_address(addr):
+    host, port = addr.rsplit(':', 1)
+    return host, int(port)
+
+
+class DatagramListener(asyncio.DatagramProtocol):
+    """
+    Hands every datagram to the message handler, or adds it to the message buffer.
+    """
+    def __init__(self, addr, message_buffer, message_handler=None, receive_buffer_size=0):
+        self.addr = addr
+        self.message_buffer = message_buffer
+        self.message_handler = message_handler
+        self.receive_buffer_size = receive_buffer_size
+        self.transport = None
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        await loop.create_datagram_endpoint(lambda: self, local_addr=split_address(self.addr))
+        if self.receive_buffer_size:
+            sock = self.transport.get_extra_info('socket')
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.receive_buffer_size)
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, address):
+        if self.message_handler is not None:
+            self.message_handler(data)
+        else:
+            self.message_buffer.append(data)
+
+    def error_received(self, exc):
+        logging.warning('UDP listener error: %s' % (exc))
+
+    def stop(self):
+        if self.transport is not None:
+            self.transport.close()
+
+
+class StreamListener(object):
+    """
+    Newline delimited lines over persistent TCP connections, like the gevent
+    runtime's TCPListener: complete lines are handed to the message handler
+    a chunk at a time, and a client sending faster than pencil parses is
+    slowed down by TCP flow control.
+    """
+    read_size = 65536
+    max_line_length = 65536
+
+    def __init__(self, addr, message_handler):
+        self.addr = addr
+        self.message_handler = message_handler
+        self.dropped_lines = 0
+        self.server = None
+
+    async def start(self):
+        host, port = split_address(self.addr)
+        self.server = await asyncio.start_server(self.handle, host, port)
+
+    async def handle(self, reader, writer):
+        address = writer.get_extra_info('peername')
+        logging.debug('new TCP ingest connection from %s' % (str(address)))
+        pending = b''
+        try:
+            while True:
+                data = await reader.read(self.read_size)
+                if not data:
+                    break
+                if pending:
+                    data = pending + data
+                end = data.rfind(b'\n')
+                if end < 0:
+                    pending = data
+                    if len(pending) > self.max_line_length:
+                        logging.warning('dropping a line longer than %d bytes from %s' % (
+                            self.max_line_length, str(address)
+                        ))
+                        self.dropped_lines += 1
+                        pending = b''
+                    continue
+                pending = data[end + 1:]
+                self.message_handler(data[:end])
+                # don't let a busy connection starve the other listeners.
+                await asyncio.sleep(0)
+        except OSError as e:
+            logging.warning('TCP ingest connection from %s failed: %s' % (str(address), e))
+        except asyncio.CancelledError:
+            # the server is shutting down.
+            pass
+        finally:
+            writer.close()
+        # the last line doesn't have to end with a newline.
+        if pending:
+            self.message_handler(pending)
+
+    def stop(self):
+        if self.server is not None:
+            self.server.close()
+
+
+class BatchStreamListener(object):
+    """
+    Batches of partial aggregates forwarded by edge pencils, like the gevent
+    runtime's BatchListener: every batch is framed by its length, and handed
+    to the batch handler as soon as it was read in full.
+    """
+    def __init__(self, addr, batch_handler):
+        self.addr = addr
+        self.batch_handler = batch_handler
+        self.server = None
+
+    async def start(self):
+        host, port = split_address(self.addr)
+        self.server = await asyncio.start_server(self.handle, host, port)
+
+    async def handle(self, reader, writer):
+        address = writer.get_extra_info('peername')
+        logging.debug('new batch connection from %s' % (str(address)))
+        try:
+            while True:
+                try:
+                    header = await reader.readexactly(FRAME_HEADER.size)
+                except asyncio.IncompleteReadError as e:
+                    if e.partial:
+                        logging.warning('batch connection from %s closed mid batch' % (str(address)))
+                    break
+                length, = FRAME_HEADER.unpack(header)
+                if length > MAX_BATCH_SIZE:
+                    logging.warning('closing the batch connection from %s: a batch of %d bytes is too large' % (
+                        str(address), length
+                    ))
+                    break
+                try:
+                    payload = await reader.readexactly(length)
+                except asyncio.IncompleteReadError:
+                    logging.warning('batch connection from %s closed mid batch' % (str(address)))
+                    break
+                self.batch_handler(payload)
+        except OSError as e:
+            logging.warning('batch connection from %s failed: %s' % (str(address), e))
+        except asyncio.CancelledError:
+            # the server is shutting down.
+            pass
+        finally:
+            writer.close()
+
+    def stop(self):
+        if self.server is not None:
+            self.server.close()
+
+
+class CommandStreamServer(object):
+    """
+    Serves the command server's commands over asyncio streams.
+    """
+    def __init__(self, addr, pencil_server):
+        self.addr = addr
+        self.commands = CommandServer(pencil_server)
+        self.server = None
+
+    async def start(self):
+        host, port = split_address(self.addr)
+        self.server = await asyncio.start_server(self.handle, host, port)
+
+    async def handle(self, reader, writer):
+        logging.debug('new connection from ' + str(writer.get_extra_info('peername')))
+        writer.write(b'Welcome to pencil\'s command server. Type quit to exit.\r\n')
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    # the client went away.
+                    break
+                line = line.decode('utf-8', 'replace')
+                if not line.strip():
+                    continue
+
+                output = self.commands.run(line)
+                if output is None:
+                    break
+                if isinstance(output, str):
+                    writer.write(('%s\r\n' % (output)).encode('utf-8'))
+                else:
+                    for chunk in output:
+                        writer.write(chunk.encode('utf-8'))
+                        await writer.drain()
+                        await asyncio.sleep(0)
+                    writer.write(b'\r\n')
+                await writer.drain()
+        except (OSError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    def stop(self):
+        if self.server is not None:
+            self.server.close()
+
+
+class AsyncGraphiteConnection(GraphiteConnection):
+    """
+    A long lived connection to graphite over asyncio streams.
+    connects lazily, and backs off reconnecting exactly like the gevent connection.
+    """
+    def __init__(self, *args, **kwargs):
+        super(AsyncGraphiteConnection, self).__init__(*args, **kwargs)
+        self.reader = None
+        self.writer = None
+
+    def is_healthy(self):
+        """
+        True if the connection is open and the peer hasn't closed it.
+        graphite never writes back to its clients, so EOF means the server closed the connection.
+        """
+        if self.writer is None:
+            return False
+        if self.writer.is_closing() or self.reader.at_eof():
+            logging.info('graphite closed the connection')
+            return False
+        return True
+
+    async def connect(self):
+        if time.time() < self.retry_at:
+            raise socket.error('not reconnecting to graphite for another %d seconds' % (
+                self.retry_at - time.time()
+            ))
+        logging.debug('connecting to graphite over TCP')
+        try:
+            self.reader, self.writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port), self.timeout
+            )
+            sock = self.writer.get_extra_info('socket')
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        except (OSError, asyncio.TimeoutError) as e:
+            self.connect_failures += 1
+            self.close()
+            self._backoff()
+            raise socket.error('could not connect to graphite: %s' % (e or 'timed out'))
+        logging.info('connected to graphite at %s:%s' % (self.host, self.port))
+
+    async def sendall(self, data):
+        """
+        Write all of `data`, reconnecting first if needed.
+        if anything goes wrong, `socket.error` is raised and the caller
+        should consider `data` as not sent at all.
+        """
+        if not self.is_healthy():
+            self.close()
+            await self.connect()
+        try:
+            self.writer.write(data)
+            await asyncio.wait_for(self.writer.drain(), self.timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            self.close()
+            self._backoff()
+            raise socket.error('could not write to graphite: %s' % (e or 'timed out'))
+        self.failures = 0
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            logging.debug('TCP connection to graphite closed.')
+        self.reader = None
+        self.writer = None
+
+
+class AsyncGraphiteBackend(GraphiteBackend):
+    """
+    A single graphite (carbon) server, written to over asyncio streams.
+    """
+    connection_class = AsyncGraphiteConnection
+
+    async def flush(self, msg, count):
+        """
+        Send a serialized message of `count` stats, or just replay the spool if there is none.
+        """
+        if msg is not None:
+            await self.send(msg, count)
+        elif len(self.spool) > 0:
+            logging.debug('spool size: %s, sending data to graphite' % (len(self.spool)))
+            await self.socket_write_buffer()
+        else:
+            logging.debug('spool is empty, not sending data to graphite')
+
+    async def send(self, msg, count):
+        """
+        Send a fresh message of `count` stats to graphite, or spool it
+        if graphite is not available.
+        once graphite accepts data again, replay the spooled backlog.
+        """
+        try:
+            await self.connection.sendall(msg)
+        except socket.error as e:
+            self._send_failed(msg, e)
+            return
+
+        self._sent(msg, count)
+        if len(self.spool) > 0:
+            await self.socket_write_buffer()
+
+    async def socket_write_buffer(self):
+        """
+        Replay the spooled messages to graphite, oldest first, at up to
+        `replay_rate` bytes per second.
+        """
+        self.spool.expire()
+        budget = self.replay_rate * self.flush_interval
+        while True:
+            msg = self._next_replay(budget)
+            if msg is None:
+                break
+            try:
+                await self.connection.sendall(msg)
+            except socket.error as e:
+                logging.error('could not replay spooled data to graphite server %s: %s' % (self.address, e))
+                return
+            budget -= self._replayed(msg)
+
+        logging.debug('%d spooled messages left to send to graphite' % (len(self.spool)))
+
+
+class AsyncioPencilServer(PencilServer):
+    """
+    The pencil server, on asyncio.
+    """
+    graphite_backend_class = AsyncGraphiteBackend
+
+    def _setup_listener(self, storage):
+        if self.settings['receive_mode'] != 'datagram':
+            raise ValueError('the %s receive mode needs the gevent runtime' % (self.settings['receive_mode']))
+        message_handler = None
+        if self.settings['ingest_mode'] == 'incremental':
+            message_handler = self.handle_message
+        return DatagramListener(
+            self.settings['bind_adress'],
+            message_buffer=storage,
+            message_handler=message_handler,
+            receive_buffer_size=self.settings['receive_buffer_size']
+        )
+
+    def _setup_tcp_listener(self):
+        if not self.settings['tcp_bind_address']:
+            return None
+        return StreamListener(self.settings['tcp_bind_address'], message_handler=self.handle_lines)
+
+    def _setup_batch_listener(self):
+        if not self.settings['forward_bind_address']:
+            return None
+        return BatchStreamListener(self.settings['forward_bind_address'], batch_handler=self.handle_batch)
+
+    def _setup_management_server(self):
+        return CommandStreamServer(self.settings['management_address'], self)
+
+    def _setup_workers(self):
+        if self.settings['workers']:
+            raise ValueError('ingest workers need the gevent runtime')
+        return None
+
+    def _setup_flush_threadpool(self):
+        if not self.settings['flush_threads']:
+            return None
+        return ThreadPoolExecutor(self.settings['flush_threads'])
+
+    def start(self):
+        """
+        Run the server on asyncio's event loop (or uvloop's) until it is stopped.
+        """
+        if uvloop is not None:
+            logging.info('running on uvloop')
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        asyncio.run(self.serve())
+        logging.info('pencil server - all services halted.')
+
+    async def serve(self):
+        self._is_running = True
+        self.start_date = datetime.datetime.now()
+        self._stopped = asyncio.Event()
+        self.schedule.start()
+        self.load_snapshot()
+
+        logging.info('starting UDP listener')
+        await self._listener.start()
+        if self._tcp_listener is not None:
+            logging.info('starting TCP listener')
+            await self._tcp_listener.start()
+        if self._batch_listener is not None:
+            logging.info('starting batch listener')
+            await self._batch_listener.start()
+        logging.info('starting command server')
+        await self._management_listener.start()
+
+        logging.info('starting flush daemon')
+        flush_daemon = asyncio.ensure_future(self._flush_daemon())
+        snapshot_daemon = None
+        if self.settings['snapshot_path'] and self.settings['snapshot_interval']:
+            logging.info('starting snapshot daemon')
+            snapshot_daemon = asyncio.ensure_future(self._snapshot_daemon())
+        heartbeat = None
+        if self.block_detector is not None:
+            logging.info('starting block detector')
+            self.block_detector.start()
+            heartbeat = asyncio.ensure_future(self._heartbeat())
+        logging.info('pencil server started, and is accepting requests.')
+        await self._stopped.wait()
+
+        await flush_daemon
+        if snapshot_daemon is not None:
+            await snapshot_daemon
+        if heartbeat is not None:
+            await heartbeat
+        # Flush before stopping the server, unless the next pencil takes over the window:
+        if not self.settings['snapshot_path'] or not self.save_snapshot(final=True):
+            await self.flush(*self.schedule.window())
+        for backend in self.graphite.backends:
+            backend.connection.close()
+        if self.block_detector is not None:
+            self.block_detector.stop()
+        self.profiler.stop()
+
+    def stop(self):
+        """
+        Stops all services for this server and exits
+        """
+        logging.info('stopping UDP listener')
+        self._listener.stop()
+        if self._tcp_listener is not None:
+            logging.info('stopping TCP listener')
+            self._tcp_listener.stop()
+        if self._batch_listener is not None:
+            logging.info('stopping batch listener')
+            self._batch_listener.stop()
+        logging.info('stopping command server')
+        self._management_listener.stop()
+        logging.info('stopping flush daemon')
+        self._is_running = False
+        self._stopped.set()
+
+    async def _flush_daemon(self):
+        """
+        runs flush() on every window of the flush schedule, one flush at a time.
+        """
+        schedule = self.schedule
+        while self._is_running:
+            try:
+                await asyncio.wait_for(self._stopped.wait(), schedule.delay())
+            except asyncio.TimeoutError:
+                pass
+            if not self._is_running:
+                break
+            try:
+                await self.flush(*schedule.window())
+            except Exception:
+                # keep flushing the next windows.
+                logging.exception('flushing the window ending at %d failed' % (schedule.window()[0]))
+            schedule.advance()
+
+    async def _snapshot_daemon(self):
+        """
+        writes a checkpoint snapshot every X (configurable) seconds.
+        """
+        interval = self.settings['snapshot_interval']
+        while self._is_running:
+            try:
+                await asyncio.wait_for(self._stopped.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+            if not self._is_running:
+                break
+            self.save_snapshot()
+
+    async def _heartbeat(self):
+        """
+        ticks the block detector for as long as the event loop is free to run it.
+        """
+        detector = self.block_detector
+        while self._is_running:
+            try:
+                await asyncio.wait_for(self._stopped.wait(), detector.tick_interval)
+            except asyncio.TimeoutError:
+                pass
+            detector.tick()
+
+    async def flush(self, timestamp=None, interval=None):
+        """
+        Flush data to graphite: aggregate any buffered messages,
+        then format the aggregated data and send it to all graphite backends, stamped with `timestamp`.
+        """
+        logging.debug('flushing message buffer')
+        graphite = self.graphite
+        queue = self._take_messages()
+
+        with self._instrumented_flush():
+            graphite.parse_queue(queue)
+            if timestamp is None:
+                timestamp = get_timestamp()
+            state = graphite.swap_window(interval)
+            with graphite.timed('format'):
+                if graphite.flush_threadpool is not None:
+                    loop = asyncio.get_running_loop()
+                    messages = await loop.run_in_executor(graphite.flush_threadpool, graphite.format, state, timestamp)
+                else:
+                    messages = graphite.format(state, timestamp)
+            with graphite.timed('send'):
+                # backends are written to concurrently, so a slow one doesn't stall the others.
+                await asyncio.gather(*[
+                    backend.flush(*messages.get(backend, (None, 0)))
+                    for backend in graphite.backends
+                ])
@@ -0,0 +1,115 @@
+"""
+Limits on the amount of distinct metric keys.
+A single misbehaving client sending unique metric names (request ids,
+timestamps in key names...) would otherwise grow the aggregates until pencil
+runs out of memory.
+
+Keys are capped globally and per prefix (the first few dot separated parts of
+the key). new keys over a cap are either rejected, or folded into a single
+overflow key. the prefixes responsible for rejected keys are tracked with a
+space-saving sketch, so the top offenders can be looked up through the
+command server, in fixed memory.
+"""
+
+from .compat import iteritems
+
+
+class SpaceSaving(object):
+    """
+    The space-saving heavy hitters sketch (Metwally et al.).
+    Tracks at most `size` items. when a new item shows up and the sketch is full,
+    it replaces the item with the lowest count, inheriting that count as its error.
+    every item that occurred more than total / size times is guaranteed to be tracked,
+    and its count is over estimated by at most its error.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.counts = {}
+        self.errors = {}
+
+    def add(self, item, count=1):
+        if item in self.counts:
+            self.counts[item] += count
+            return
+        if len(self.counts) < self.size:
+            self.counts[item] = count
+            self.errors[item] = 0
+            return
+        victim = min(self.counts, key=self.counts.get)
+        floor = self.counts.pop(victim)
+        del self.errors[victim]
+        self.counts[item] = floor + count
+        self.errors[item] = floor
+
+    def top(self, n=None):
+        """
+        (item, count, error) tuples, heaviest first.
+        """
+        items = sorted(iteritems(self.counts), key=lambda item: item[1], reverse=True)
+        return [(item, count, self.errors[item]) for item, count in items[:n]]
+
+
+class CardinalityLimiter(object):
+    """
+    Decides whether a new key may be aggregated.
+    `admit` is called once for every key the graphite client doesn't track yet,
+    and `release` once a tracked key is forgotten (see the graphite client's TTLs).
+    a cap of 0 is unlimited.
+    """
+    def __init__(self, max_keys=0, max_keys_per_prefix=0, prefix_depth=1,
+                 policy='reject', overflow_key='pencil.overflow', top_k=20):
+        if policy not in ('reject', 'overflow'):
+            raise ValueError('unknown cardinality policy: %s' % (policy))
+        self.max_keys = max_keys
+        self.max_keys_per_prefix = max_keys_per_prefix
+        self.prefix_depth = prefix_depth
+        self.policy = policy
+        self.overflow_key = overflow_key
+
+        self.keys = 0
+        self.prefixes = {}
+        # admitted key -> the amount of times it was admitted (once per metric type it is tracked as).
+        self.admitted = {}
+        self.rejected = 0
+        self.offenders = SpaceSaving(top_k)
+
+    def prefix(self, key):
+        return '.'.join(key.split('.', self.prefix_depth)[:self.prefix_depth])
+
+    def admit(self, key):
+        """
+        Returns the key to aggregate into - the key itself, or the overflow key
+        when over a cap - or None if the key is rejected.
+        """
+        if key == self.overflow_key:
+            return key
+        prefix = self.prefix(key)
+        prefix_keys = self.prefixes.get(prefix, 0)
+        if (self.max_keys and self.keys >= self.max_keys) or \
+           (self.max_keys_per_prefix and prefix_keys >= self.max_keys_per_prefix):
+            self.rejected += 1
+            self.offenders.add(prefix)
+            if self.policy == 'overflow':
+                return self.overflow_key
+            return None
+        self.keys += 1
+        self.prefixes[prefix] = prefix_keys + 1
+        self.admitted[key] = self.admitted.get(key, 0) + 1
+        return key
+
+    def release(self, key):
+        admitted = self.admitted.get(key)
+        if not admitted:
+            # never admitted (the overflow key is not limited).
+            return
+        if admitted > 1:
+            self.admitted[key] = admitted - 1
+        else:
+            del self.admitted[key]
+        prefix = self.prefix(key)
+        prefix_keys = self.prefixes[prefix]
+        self.keys -= 1
+        if prefix_keys > 1:
+            self.prefixes[prefix] = prefix_keys - 1
+        else:
+            del self.prefixes[prefix]
@@ -3,10 +3,30 @@ Pencil's command server.
 A telnet interface for probing and querying a Pencil server instance.
 This file defines the available commands, as well as define the command
 server interface, accepting these commands.
+
+Commands either return a string, or an iterable of string chunks. chunks are
+written one by one, yielding to the event loop in between, so large outputs
+don't hold back ingestion. an empty chunk just yields to the event loop.
+
+The commands are shared by both runtimes. `create_command_server` serves them
+with gevent, the asyncio runtime serves them on its own (see aio.py).
 """
 
+import re
+import time
+import fnmatch
 import logging
-from gevent.server import StreamServer
+import json
+
+try:
+    import gevent
+    from gevent.server import StreamServer
+except ImportError:
+    # the asyncio runtime (see aio.py) runs without gevent.
+    gevent = None
+
+from .compat import xrange, string_types, to_str
+from .instrumentation import kernel_drops
 
 
 # Command actions.
@@ -23,27 +43,136 @@ class BaseCommand(object):
         raise NotImplementedError('Override this!')
 
 
-class ShowStorageCommand(BaseCommand):
+class QueryCommand(BaseCommand):
     """
-    print out the raw message buffer currently stored 
-    by the pencil server instance.
+    A baseline for commands listing aggregated data. takes an optional glob
+    pattern of keys to list (a pattern without wildcards lists keys by prefix),
+    and any of the following options:
+        limit=N - list at most N rows, 0 lists all of them. default is 1000
+        offset=N - skip the first N rows, for paging through the rest.
+        format=json - a single JSON document instead of `key: value` lines.
+    keys are filtered and rows are written in chunks of `chunk_size`,
+    yielding to the event loop in between.
     """
+    default_limit = 1000
+    chunk_size = 500
+    sort = True
+
+    def rows(self):
+        """
+        The mapping to list.
+        """
+        raise NotImplementedError('Override this!')
+
+    def value(self, value):
+        return value
+
     def execute(self, *args):
-        return str(self.pencil_server._listener.message_buffer)
+        pattern = None
+        options = {'limit': self.default_limit, 'offset': 0, 'format': 'text'}
+        for arg in args:
+            if '=' not in arg:
+                pattern = arg
+                continue
+            name, value = arg.split('=', 1)
+            if name not in options:
+                return 'unknown option: %s. options are: %s' % (name, ', '.join(sorted(options)))
+            if name == 'format':
+                if value not in ('text', 'json'):
+                    return 'unknown format: %s. formats are: text, json' % (value)
+                options[name] = value
+                continue
+            try:
+                options[name] = int(value)
+            except ValueError:
+                return '%s should be a number' % (name)
+
+        if pattern is not None and not set('*?[') & set(pattern):
+            pattern += '*'
+        return self.stream(pattern, options['limit'], options['offset'], options['format'] == 'json')
+
+    def stream(self, pattern, limit, offset, json_format):
+        rows = self.rows()
+        keys = list(rows)
+        if pattern is not None:
+            match = re.compile(fnmatch.translate(pattern)).match
+            matched = []
+            for i in xrange(0, len(keys), self.chunk_size * 10):
+                matched.extend([k for k in keys[i:i + self.chunk_size * 10] if match(k)])
+                yield ''
+            keys = matched
+        if self.sort:
+            keys.sort()
+        total = len(keys)
+        end = offset + limit if limit else total
+        keys = keys[offset:end]
+
+        if json_format:
+            yield '{"total": %d, "offset": %d, "rows": [' % (total, offset)
+        for i in xrange(0, len(keys), self.chunk_size):
+            chunk = keys[i:i + self.chunk_size]
+            if json_format:
+                prefix = ', ' if i else ''
+                yield prefix + ', '.join([
+                    json.dumps(self.json_row(k, rows)) for k in chunk
+                ])
+            else:
+                yield ''.join(['%s\r\n' % (self.text_row(k, rows)) for k in chunk])
+        if json_format:
+            yield ']}'
+        else:
+            yield 'listed %d of %d rows, from offset %d.' % (len(keys), total, offset)
+
+    def text_row(self, key, rows):
+        return '%s: %s' % (key, self.value(rows.get(key)))
+
+    def json_row(self, key, rows):
+        return {'key': key, 'value': self.value(rows.get(key))}
+
+
+class ShowStorageCommand(QueryCommand):
+    """
+    print out the raw message buffer currently stored 
+    by the pencil server instance. the pattern filters messages.
+    """
+    sort = False
+
+    def rows(self):
+        return [to_str(message) for message in self.pencil_server._listener.message_buffer]
+
+    def text_row(self, key, rows):
+        return key
+
+    def json_row(self, key, rows):
+        return key
 
 
 class ShowStatusCommand(BaseCommand):
     """
-    Print out the server's start date
-    and the amount of handled requests
+    Print out the server's start date,
+    the amount of handled requests and the amount of datagrams dropped by the kernel
     """
     def execute(self, *args):
-        return 'up since %s, total requests: %s' % (
+        return 'up since %s, total requests: %s, kernel drops: %s' % (
             self.pencil_server.start_date,
-            self.pencil_server.request_count
+            self.pencil_server.request_count,
+            kernel_drops(self.pencil_server.settings['bind_adress'])
         )
 
 
+class ShowStatsCommand(BaseCommand):
+    """
+    Print out pencil's own throughput and latency numbers,
+    one `name: value` pair per line.
+    """
+    def execute(self, *args):
+        instrumentation = self.pencil_server.instrumentation
+        if instrumentation is None:
+            return 'instrumentation is disabled.'
+        report = instrumentation.report()
+        return '\r\n'.join(['%s: %s' % (k, report[k]) for k in sorted(report)])
+
+
 class StopServerCommand(BaseCommand):
     """
     Stop the pencil server instance.
@@ -53,28 +182,172 @@ class StopServerCommand(BaseCommand):
         return 'shutting down server.'
 
 
-class GraphiteTimers(BaseCommand):
+class GraphiteTimers(QueryCommand):
     """
     print the currently aggregated timers for this pencil instance.
     """
-    def execute(self, *args):
-        return str(self.pencil_server.graphite.timers)
+    def rows(self):
+        return self.pencil_server.graphite.timers
 
+    def value(self, timer):
+        if timer is None or not timer.size > 0:
+            return None
+        return {'count': timer.count, 'lower': timer.lower, 'upper': timer.upper, 'sum': timer.sum}
 
-class GraphiteCounters(BaseCommand):
+
+class GraphiteSets(QueryCommand):
+    """
+    print the estimated amount of unique members of the currently aggregated sets for this pencil instance.
+    """
+    def rows(self):
+        return self.pencil_server.graphite.sets
+
+    def value(self, sketch):
+        if sketch is None:
+            return None
+        return sketch.count()
+
+
+class GraphiteCounters(QueryCommand):
     """
     print the currently aggregated counters for this pencil instance.
     """
-    def execute(self, *args):
-        return str(self.pencil_server.graphite.counters)
+    def rows(self):
+        return self.pencil_server.graphite.counters
 
 
-class GraphiteGauges(BaseCommand):
+class GraphiteGauges(QueryCommand):
     """
     print the currently aggregated gauges for this pencil instance.
     """
+    def rows(self):
+        return self.pencil_server.graphite.gauges
+
+class ShowCardinalityCommand(BaseCommand):
+    """
+    Print out the amount of distinct keys against the configured caps,
+    and the prefixes responsible for most rejected keys.
+    takes an optional amount of prefixes to list.
+    """
     def execute(self, *args):
-        return str(self.pencil_server.graphite.gauges)
+        limiter = self.pencil_server.graphite.limiter
+        if limiter is None:
+            return 'no cardinality limits are configured.'
+        try:
+            n = int(args[0]) if args else None
+        except ValueError:
+            return 'usage: cardinality [amount of prefixes]'
+        lines = [
+            'keys: %s (max: %s, max per prefix: %s)' % (
+                limiter.keys, limiter.max_keys or 'unlimited', limiter.max_keys_per_prefix or 'unlimited'
+            ),
+            'rejected metrics: %s (policy: %s)' % (limiter.rejected, limiter.policy),
+            'top offending prefixes:',
+        ]
+        for prefix, count, error in limiter.offenders.top(n):
+            lines.append('  %s: %s (+/- %s)' % (prefix, count, error))
+        return '\r\n'.join(lines)
+
+class ShowHistoryCommand(BaseCommand):
+    """
+    Print out the recently flushed values of the stats of a key
+    (e.g. key, key_per_second, key.count, key.p99...).
+    takes the key, and an optional format=json.
+    """
+    def execute(self, *args):
+        graphite = self.pencil_server.graphite
+        history = graphite.history
+        if history is None:
+            return 'history is disabled. set history_size to keep recent values.'
+        if not args:
+            return 'usage: history <key> [format=json]'
+        key = args[0]
+        json_format = 'format=json' in args[1:]
+
+        names = [key, '%s_per_second' % (key)]
+        names.extend('%s.%s' % (key, suffix) for suffix in graphite.keys.timer_suffixes)
+        series = [(name, history.values(name)) for name in names if name in history]
+        if json_format:
+            return json.dumps(dict(series))
+        if not series:
+            return 'no history for %s' % (key)
+        lines = []
+        for name, values in series:
+            lines.append('%s:' % (name))
+            lines.extend('  %s %s' % (timestamp, value) for timestamp, value in values)
+        return '\r\n'.join(lines)
+
+class ProfileStartCommand(BaseCommand):
+    """
+    Start sampling the event loop for a fixed amount of seconds (10 by default).
+    takes the amount of seconds, and an optional interval=MS between samples (5 by default).
+    """
+    def execute(self, *args):
+        usage = 'usage: profile_start [seconds] [interval=MS]'
+        duration = 10.0
+        interval = 5.0
+        try:
+            for arg in args:
+                if arg.startswith('interval='):
+                    interval = float(arg.split('=', 1)[1])
+                else:
+                    duration = float(arg)
+        except ValueError:
+            return usage
+        if duration <= 0 or interval <= 0:
+            return usage
+        try:
+            self.pencil_server.profiler.start(duration, interval / 1000.0)
+        except ValueError as e:
+            return '%s. stop it with profile_stop.' % (e)
+        return 'profiling the event loop for %g seconds, every %g ms.' % (duration, interval)
+
+
+class ProfileStopCommand(BaseCommand):
+    """
+    Stop sampling the event loop, if it is still running, and print out the functions
+    seen running in most samples (self), along with the samples they were on the stack in (total).
+    takes an optional amount of functions to list (20 by default).
+    """
+    def execute(self, *args):
+        try:
+            n = int(args[0]) if args else 20
+        except ValueError:
+            return 'usage: profile_stop [amount of functions]'
+        profiler = self.pencil_server.profiler
+        profiler.stop()
+        if not profiler.samples:
+            return 'no samples. start profiling with profile_start.'
+        lines = [
+            '%d samples over %.3f seconds, every %g ms' % (
+                profiler.samples, profiler.duration, profiler.interval * 1000
+            ),
+            '  self%  total%  function',
+        ]
+        for function, self_count, total_count in profiler.top(n):
+            lines.append('%6.1f%% %6.1f%%  %s' % (
+                100.0 * self_count / profiler.samples, 100.0 * total_count / profiler.samples, function
+            ))
+        return '\r\n'.join(lines)
+
+
+class ShowBlocksCommand(BaseCommand):
+    """
+    Print out the recent times the event loop was blocked for longer than 'block_threshold',
+    along with the stack holding it.
+    """
+    def execute(self, *args):
+        detector = self.pencil_server.block_detector
+        if detector is None:
+            return 'block detection is disabled. set block_threshold to detect blocks.'
+        blocks = list(detector.recent)
+        lines = ['%d blocks over %g seconds since startup' % (detector.blocks, detector.threshold)]
+        for block in blocks:
+            lines.append('blocked for %.3f seconds at %s, in:' % (
+                block['duration'], time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(block['time']))
+            ))
+            lines.extend(block['stack'].rstrip('\n').split('\n'))
+        return '\r\n'.join(lines)
 
 # The actual server class
 class CommandServer(object):
@@ -84,9 +357,16 @@ class CommandServer(object):
     commands =  {
         'storage': ShowStorageCommand,
         'status' : ShowStatusCommand,
+        'stats' : ShowStatsCommand,
+        'cardinality' : ShowCardinalityCommand,
+        'history' : ShowHistoryCommand,
+        'profile_start' : ProfileStartCommand,
+        'profile_stop' : ProfileStopCommand,
+        'blocks' : ShowBlocksCommand,
         'stop_server' : StopServerCommand,
         'timers' : GraphiteTimers,
         'gauges' : GraphiteGauges,
+        'sets' : GraphiteSets,
         'counters' : GraphiteCounters
     }
 
@@ -95,7 +375,7 @@ class CommandServer(object):
         self.commands = self.__class__.commands
 
     def get_commands(self):
-        commands = self.commands.keys()
+        commands = list(self.commands)
         commands.append('help')
         commands.append('quit')
         command_list = ', '.join(commands)
@@ -103,11 +383,30 @@ class CommandServer(object):
         return 'available commands: %s' % (command_list)
 
 
+    def run(self, line):
+        """
+        Run a single command line. returns the command's output,
+        or None if the client asked to quit.
+        """
+        command_parts = line.strip().split()
+        # arguments (key patterns) are case sensitive, command names are not.
+        command = command_parts[0].lower()
+        args = command_parts[1:]
+
+        if command == 'quit':
+            return None
+
+        if command in self.commands:
+            command_class = self.commands[command](self.pencil_server)
+            return command_class.execute(*args)
+        return self.get_commands()
+
+
     def server(self, socket, address):
         """
         this method will be used to build a TCP server (`StreamServer`) by gevent
         """
-        fileobj = socket.makefile()
+        fileobj = socket.makefile('rw')
         fileobj.write('Welcome to pencil\'s command server. Type quit to exit.\r\n')
         logging.debug('new connection from ' + str(address))
         fileobj.flush()
@@ -115,30 +414,27 @@ class CommandServer(object):
             line = fileobj.readline()
             
             if not line:
-                fileobj.write('')
-                continue
+                # the client went away.
+                break
             
-            command_parts = line.strip().lower().split()
-            if not len(command_parts) > 0:
-                fileobj.write('')
+            if not line.strip():
                 continue
 
-            command = command_parts[0]
-            args = command_parts[1:]
-
             logging.debug('executing command from %s: %s' % (address, line))
-
-            if command == 'quit':
+            output = self.run(line)
+            if output is None:
                 break
 
-            if command in self.commands.keys():
-                command_class = self.commands[command](self.pencil_server)
-                output = command_class.execute(*args)
+            if isinstance(output, string_types):
+                fileobj.write('%s\r\n' % (output))
             else:
-                output = self.get_commands()
-
-            fileobj.write('%s\r\n' % (output))
+                for chunk in output:
+                    fileobj.write(chunk)
+                    fileobj.flush()
+                    gevent.sleep(0)
+                fileobj.write('\r\n')
             fileobj.flush()
+        fileobj.close()
 
 
 
@@ -0,0 +1,69 @@
+"""
+Python 2 and 3 compatibility.
+pencil runs on python 2.7, and on python 3. the few names that differ
+between the two are defined here, so the rest of the code doesn't have to care.
+data read from and written to sockets is bytes on python 3, and str (which is
+bytes) on python 2.
+"""
+
+import sys
+import time
+
+PY3 = sys.version_info[0] >= 3
+
+if PY3:
+    string_types = (str,)
+    xrange = range
+    intern = sys.intern
+    monotonic = time.monotonic
+
+    def iteritems(d):
+        return iter(d.items())
+
+    def itervalues(d):
+        return iter(d.values())
+
+    def to_bytes(s):
+        if isinstance(s, str):
+            return s.encode('utf-8')
+        return s
+
+    def to_str(b):
+        if isinstance(b, (bytes, bytearray)):
+            return b.decode('utf-8', 'replace')
+        return b
+
+    def array_to_bytes(a):
+        return a.tobytes()
+
+    def array_frombytes(a, data):
+        a.frombytes(data)
+else:
+    string_types = (basestring,)
+    xrange = xrange
+    intern = intern
+    try:
+        # the PyPI backport of time.monotonic
+        from monotonic import monotonic
+    except ImportError:
+        monotonic = time.time
+
+    def iteritems(d):
+        return d.iteritems()
+
+    def itervalues(d):
+        return d.itervalues()
+
+    def to_bytes(s):
+        if isinstance(s, unicode):
+            return s.encode('utf-8')
+        return s
+
+    def to_str(b):
+        return b
+
+    def array_to_bytes(a):
+        return a.tostring()
+
+    def array_frombytes(a, data):
+        a.fromstring(data)
@@ -0,0 +1,105 @@
+"""
+A long lived TCP connection to the Graphite server.
+The connection is opened once and reused by every flush. when it breaks,
+reconnecting is delayed with an exponential backoff, so a graphite server
+that is down isn't hammered with connection attempts on every flush.
+"""
+
+import time
+import logging
+try:
+    from gevent import socket
+    from gevent import select
+except ImportError:
+    # the asyncio runtime (see aio.py) runs without gevent, and has a connection of its own.
+    import socket
+    import select
+
+
+class GraphiteConnection(object):
+    """
+    Wraps a single TCP socket to graphite. Does the following:
+    1. connect lazily, on the first write.
+    2. before every write, check the connection is still alive.
+       graphite never writes back to its clients, so a readable socket means
+       the server closed the connection (or sent an error).
+    3. write every message in full, or raise `socket.error`.
+    4. when a write or a connection attempt fails, close the socket
+       and refuse to reconnect until the backoff delay has passed.
+    """
+    def __init__(self, host, port, timeout=5, min_backoff=1, max_backoff=60):
+        self.host = host
+        self.port = int(port)
+        self.timeout = timeout
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+
+        self.sock = None
+        self.failures = 0
+        self.connect_failures = 0
+        self.retry_at = 0
+
+    def is_healthy(self):
+        """
+        True if the socket is connected and the peer hasn't closed it.
+        """
+        if self.sock is None:
+            return False
+        try:
+            readable, _, _ = select.select([self.sock], [], [], 0)
+            if readable and not self.sock.recv(4096):
+                logging.info('graphite closed the connection')
+                return False
+        except (select.error, socket.error):
+            return False
+        return True
+
+    def connect(self):
+        if time.time() < self.retry_at:
+            raise socket.error('not reconnecting to graphite for another %d seconds' % (
+                self.retry_at - time.time()
+            ))
+        logging.debug('connecting to graphite over TCP')
+        try:
+            self.sock = socket.create_connection((self.host, self.port), self.timeout)
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        except socket.error:
+            self.connect_failures += 1
+            self.close()
+            self._backoff()
+            raise
+        logging.info('connected to graphite at %s:%s' % (self.host, self.port))
+
+    def sendall(self, data):
+        """
+        Write all of `data`, reconnecting first if needed.
+        if anything goes wrong, `socket.error` is raised and the caller
+        should consider `data` as not sent at all.
+        """
+        if not self.is_healthy():
+            self.close()
+            self.connect()
+        try:
+            self.sock.sendall(data)
+        except socket.error:
+            self.close()
+            self._backoff()
+            raise
+        self.failures = 0
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+            logging.debug('TCP socket to graphite closed.')
+        self.sock = None
+
+    def _backoff(self):
+        self.failures += 1
+        delay = min(self.max_backoff, self.min_backoff * 2 ** (self.failures - 1))
+        self.retry_at = time.time() + delay
+        logging.debug('graphite connection failed %d times, backing off for %d seconds' % (
+            self.failures, delay
+        ))
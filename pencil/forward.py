@@ -0,0 +1,95 @@
+"""
+Two-tier forwarding.
+With many hosts, having every pencil send every stat to carbon multiplies the
+amount of metrics carbon has to take in, and keeps percentiles and unique counts
+per host. instead, edge pencils (with `forward_address` set) aggregate locally and,
+at every flush, forward their partial aggregates of the window - counter sums,
+the last value of every gauge, timers of either engine and set sketches - to a
+central pencil (listening on `forward_bind_address`), which merges the batches
+of all edges into its own window, and writes to graphite once.
+
+Batches travel over TCP, using the same compact binary encoding as snapshots
+(see snapshot.py), framed by length:
+
+    frame:   [length: 4 bytes][payload]
+    payload: [magic: 8 bytes][version: 2 bytes][window timestamp: 8 bytes][window interval: 8 bytes][host][state]
+
+edges use the regular graphite backend machinery to send batches, so a central
+pencil that is down or slow is handled like a carbon server would be: batches
+are spooled, and replayed once the central pencil is back.
+"""
+
+import struct
+
+from .snapshot import pack_string, unpack_string, pack_state, unpack_state
+from .compat import itervalues, to_str
+
+MAGIC = b'PNCLBTCH'
+VERSION = 1
+FRAME_HEADER = struct.Struct('!L')
+HEADER = struct.Struct('!8sHdd')
+
+# the largest payload a central pencil accepts.
+MAX_BATCH_SIZE = 64 * 1024 * 1024
+
+
+def pack_batch(state, timestamp, interval, host):
+    """
+    A frame forwarding `state` (see Graphite.snapshot), aggregated by `host`
+    during the window ending at `timestamp`.
+    """
+    payload = b''.join([
+        HEADER.pack(MAGIC, VERSION, timestamp, interval),
+        pack_string(host),
+        pack_state(state),
+    ])
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+
+def unpack_batch(payload):
+    """
+    Read the payload of a frame written by `pack_batch`.
+    returns a dict of 'state', 'timestamp', 'interval' and 'host'.
+    raises ValueError if the payload is not a valid batch.
+    """
+    try:
+        magic, version, timestamp, interval = HEADER.unpack_from(payload, 0)
+        if magic != MAGIC:
+            raise ValueError('not a pencil batch')
+        if version != VERSION:
+            raise ValueError('unsupported batch version: %d' % (version))
+        host, offset = unpack_string(payload, HEADER.size)
+        state, offset = unpack_state(payload, offset)
+    except struct.error:
+        raise ValueError('truncated batch')
+    if offset != len(payload):
+        raise ValueError('trailing data after batch')
+    return {
+        'state': state,
+        'timestamp': int(timestamp),
+        'interval': interval,
+        'host': to_str(host),
+    }
+
+
+class BatchProtocol(object):
+    """
+    The protocol edge pencils send batches to a central pencil with.
+    unlike the graphite protocols, aggregates are serialized by `pack_batch`
+    instead of being crunched into stats (see Graphite.format_batch).
+    """
+
+    def count(self, msg):
+        """
+        The amount of aggregated keys in a serialized message.
+        only used for spooled messages, so unpacking the batches is affordable.
+        """
+        count = 0
+        offset = 0
+        while offset < len(msg):
+            length, = FRAME_HEADER.unpack_from(msg, offset)
+            offset += FRAME_HEADER.size
+            state = unpack_batch(msg[offset:offset + length])['state']
+            count += sum(len(values) for values in itervalues(state))
+            offset += length
+        return count
@@ -4,166 +4,701 @@ Currently, it is heavily coupled to the Pencil aggregation server.
 since it's a simple protocol, There is little need to ever decouple the two.
 """
 
+import math
 import time
+import socket
 import logging
-from gevent import socket 
+from contextlib import contextmanager
+try:
+    import gevent
+except ImportError:
+    # the asyncio runtime (see aio.py) runs without gevent, and sends on its own.
+    gevent = None
+
+from .compat import string_types, iteritems, itervalues
+from .timers import timer_factory, summarize, merge_timers
+from .connection import GraphiteConnection
+from .spool import Spool
+from .protocols import create_protocol
+from .hashing import ConsistentHashRing
+from .keytable import KeyTable
+from .hll import HyperLogLog, check_precision
+from .forward import BatchProtocol, pack_batch
+
+# the phases of a flush, timed in `Graphite.flush_phase_time`.
+FLUSH_PHASES = ('copy', 'parse', 'aggregate', 'format', 'send')
 
 def get_timestamp():
     return int(time.time())
 
+def parse_value(value):
+    """
+    The numeric value of a metric.
+    raises ValueError for values that can't be aggregated (inf and nan).
+    """
+    value = float(value)
+    if math.isinf(value) or math.isnan(value):
+        raise ValueError('value out of range')
+    return value
+
+class GraphiteBackend(object):
+    """
+    A single graphite (carbon) server, addressed as "host:port" or "host:port:instance".
+    every backend has its own connection, spool and reconnect backoff,
+    so a backend that is down or slow doesn't hold back the others.
+    """
+    connection_class = GraphiteConnection
+
+    def __init__(self, address, flush_interval, protocol, timeout=5,
+                 min_backoff=1, max_backoff=60, spool=None, replay_rate=0):
+        # plain strings, so ring positions match carbon's even if the address came in as unicode.
+        parts = str(address).split(':')
+        self.address = address
+        self.host = parts[0]
+        self.port = parts[1]
+        self.instance = None
+        if len(parts) > 2:
+            self.instance = parts[2]
+        self.connection = self.connection_class(self.host, self.port, timeout=timeout,
+            min_backoff=min_backoff, max_backoff=max_backoff)
+
+        self.flush_interval = flush_interval
+        self.protocol = protocol
+        self.processed = 0
+        self.bytes_sent = 0
+
+        # collect messages into a spool in case graphite is down.
+        # the backlog is replayed at up to `replay_rate` bytes per second (0 is unlimited).
+        if spool is None:
+            spool = Spool()
+        self.spool = spool
+        self.replay_rate = replay_rate
+
+
+    def flush(self, msg, count):
+        """
+        Send a serialized message of `count` stats, or just replay the spool if there is none.
+        """
+        if msg is not None:
+            self.send(msg, count)
+        elif len(self.spool) > 0:
+            logging.debug('spool size: %s, sending data to graphite' % (len(self.spool)))
+            self.socket_write_buffer()
+        else:
+            logging.debug('spool is empty, not sending data to graphite')
+
+
+    def send(self, msg, count):
+        """
+        Send a fresh message of `count` stats to graphite, or spool it
+        if graphite is not available.
+        once graphite accepts data again, replay the spooled backlog.
+        """
+        try:
+            self.connection.sendall(msg)
+        except socket.error as e:
+            self._send_failed(msg, e)
+            return
+
+        self._sent(msg, count)
+        if len(self.spool) > 0:
+            self.socket_write_buffer()
+
+
+    def _send_failed(self, msg, error):
+        logging.error('could not flush data to graphite server %s: %s' % (self.address, error))
+        logging.error('will try again in %d seconds' % (self.flush_interval))
+        self.spool.append(msg)
+
+
+    def _sent(self, msg, count):
+        logging.debug('send the following message to graphite: %r' % (msg))
+        self.processed += count
+        self.bytes_sent += len(msg)
+
+
+    def socket_write_buffer(self):
+        """
+        Replay the spooled messages to graphite, oldest first, at up to
+        `replay_rate` bytes per second.
+        a message is only removed from the spool once it was written in full,
+        so nothing is lost when the connection breaks mid-write.
+        """
+        self.spool.expire()
+        budget = self.replay_rate * self.flush_interval
+        while True:
+            msg = self._next_replay(budget)
+            if msg is None:
+                break
+            try:
+                self.connection.sendall(msg)
+            except socket.error as e:
+                logging.error('could not replay spooled data to graphite server %s: %s' % (self.address, e))
+                return
+            budget -= self._replayed(msg)
+
+        logging.debug('%d spooled messages left to send to graphite' % (len(self.spool)))
+
+
+    def _next_replay(self, budget):
+        """
+        The next spooled message to replay, or None if the spool is empty
+        or the replay `budget` (in bytes) is used up.
+        """
+        if self.replay_rate and budget <= 0:
+            return None
+        return self.spool.peek()
+
+
+    def _replayed(self, msg):
+        """
+        Remove a replayed message from the spool. returns its size.
+        """
+        self.processed += self.protocol.count(msg)
+        self.bytes_sent += len(msg)
+        self.spool.pop()
+        return len(msg)
+
+
 class Graphite(object):
     """
     The Graphite client class. Does the following:
-    1. crunch out the counters, gauges and timers from pencil into
-       graphite-protocol strings.
-    2. write these stats into a transient buffer
-    3. "flush" this buffer into graphite. if graphite is not available,
-       keep messages in the buffer until flushing succeeds.
-    4. repeat.
+    1. crunch out the counters, gauges, timers and sets from pencil into
+       graphite-protocol messages (line or pickle, see protocols.py).
+    2. send these stats to graphite over a long lived connection.
+       with several graphite backends, every stat is routed to a single
+       backend by consistent hashing of its name (see hashing.py).
+    3. if graphite is not available, keep messages in a bounded spool
+       (see spool.py), and replay them once graphite is back.
+    4. keep reporting idle keys for a configurable amount of flushes
+       (a TTL per metric type), then forget them.
+    5. optionally, cap the amount of distinct keys (see cardinality.py).
+    6. optionally, keep the recently flushed values of every stat (see history.py).
+    7. repeat.
+    with a `forward_host`, the aggregates are forwarded as batches to a central pencil
+    (see forward.py) instead of being crunched into stats, and `server_addr` is that pencil's address.
     """
-    def __init__(self, server_addr, flush_interval):
-        host, port = server_addr.split(':')
-        self.host = host
-        self.port = port
-        
+    def __init__(self, server_addr, flush_interval, timer_engine='raw',
+                 timer_percentiles=(), timer_precision=0.01, timeout=5,
+                 min_backoff=1, max_backoff=60, spool_factory=None, replay_rate=0,
+                 protocol='line', pickle_batch_size=500, flush_threadpool=None,
+                 counter_ttl=None, gauge_ttl=None, timer_ttl=0, limiter=None, history=None,
+                 backend_class=GraphiteBackend, set_precision=12, set_ttl=None, forward_host=None):
         self.flush_interval = flush_interval
+        self.forward_host = forward_host
+        if forward_host is not None:
+            self.protocol = BatchProtocol()
+        else:
+            self.protocol = create_protocol(protocol, pickle_batch_size)
+
+        # server_addr is either a single address or a list of them.
+        if isinstance(server_addr, string_types):
+            server_addr = [server_addr]
+        if spool_factory is None:
+            spool_factory = lambda address: Spool()
+        self.backends = []
+        for address in server_addr:
+            self.backends.append(backend_class(address, flush_interval, self.protocol,
+                timeout=timeout, min_backoff=min_backoff, max_backoff=max_backoff,
+                spool=spool_factory(address), replay_rate=replay_rate))
+
+        self.ring = None
+        if len(self.backends) > 1:
+            self._nodes = {}
+            for backend in self.backends:
+                self._nodes[(backend.host, backend.instance)] = backend
+            if len(self._nodes) < len(self.backends):
+                raise ValueError('graphite backends on the same host need distinct instances (host:port:instance)')
+            self.ring = ConsistentHashRing([(b.host, b.instance) for b in self.backends])
+        # metric name -> backend, so every name is only hashed once.
+        self._routes = {}
+        
+        # creates an empty timer for the configured engine (see timers.py)
+        self.new_timer = timer_factory(timer_engine, timer_precision)
+        self.timer_percentiles = timer_percentiles
+        # unique counts of set members are estimated with HyperLogLog sketches (see hll.py)
+        check_precision(set_precision)
+        self.set_precision = set_precision
+
+        # interned keys, and the names of the stats they are reported as.
+        self.keys = KeyTable(timer_percentiles)
         
-        self.processed = 0
         self.bad_lines = 0
+        # seconds spent in every phase of flushing, since startup: taking buffered messages
+        # and worker aggregates (by the pencil server), parsing messages, swapping out
+        # the aggregates, crunching them into messages and sending them.
+        self.flush_phase_time = dict.fromkeys(FLUSH_PHASES, 0.0)
         
         # Initialize data
+        # these only hold the keys seen during the current flush interval.
         self.counters = {}
         self.gauges = {}
         self.timers = {}
-        self.stats = []
+        self.sets = {}
+
+        # idle keys keep being reported for `ttl` flush intervals, then they are forgotten.
+        # a ttl of None never forgets them.
+        self.ttls = {'counters': counter_ttl, 'gauges': gauge_ttl, 'timers': timer_ttl, 'sets': set_ttl}
+        # generations are numbered by flush. key -> the last generation the key was seen in.
+        self.generation = 0
+        self._last_seen = {'counters': {}, 'gauges': {}, 'timers': {}, 'sets': {}}
+        self._gauge_values = {}
+        self.evicted = 0
+
+        # decides whether new keys may be aggregated. None admits every key.
+        self.limiter = limiter
+        # recently flushed values, None keeps nothing.
+        self.history = history
+
+        # with a flush thread pool, swapped out aggregates are formatted off the event loop.
+        self.flush_threadpool = flush_threadpool
 
-        # collect messages into a buffer in case graphite is down.
-        self._buffer = []
         logging.debug('initialized Graphite client.')
-        logging.debug(' host = %s, port = %s, flush interval = %d' % (
-            host, port, flush_interval
+        logging.debug(' backends = %s, flush interval = %d' % (
+            ', '.join(server_addr), flush_interval
         ))
 
 
-    def socket_write_buffer(self):
+    @property
+    def processed(self):
+        return sum(backend.processed for backend in self.backends)
+
+
+    @property
+    def key_count(self):
+        """
+        Amount of keys reported on every flush, active or idle,
+        as of the last flush.
+        """
+        return sum(len(seen) for seen in itervalues(self._last_seen))
+
+
+    def route(self, stats):
+        """
+        Split (name, value) stats between the backends.
+        returns a backend -> stats mapping.
+        """
+        if self.ring is None:
+            return {self.backends[0]: stats}
+
+        batches = dict((backend, []) for backend in self.backends)
+        routes = self._routes
+        for stat in stats:
+            backend = routes.get(stat[0])
+            if backend is None:
+                backend = routes[stat[0]] = self._nodes[self.ring.get_node(stat[0])]
+            batches[backend].append(stat)
+        return batches
+
+
+    def parse(self, message):
+        """
+        Parse a single message and fold it into the aggregated
+        counters, gauges and timers.
+        a message may hold several newline separated metrics.
+        """
+        if not isinstance(message, str):
+            # bytes, straight from a socket on python 3.
+            message = message.decode('utf-8', 'replace')
+        for line in message.split('\n'):
+            line = line.strip()
+            if line:
+                self.parse_line(line)
+
+
+    def parse_line(self, line):
+        """
+        Parse a single `key:value|type[|@sample_rate]` metric.
+        counters and timer counts are scaled up by the sample rate.
+        the value of a set metric is a member, counted once no matter the sample rate.
+        """
         try:
-            msg = ''.join(self._buffer)
-            logging.debug('connecting to graphite over TCP')
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.connect((self.host, self.port))
-            logging.debug('connected to graphite, sending data')
-            sock.send(msg)
-            logging.debug('send the following message to graphite: %s' % (msg))
-            sock.close()
-            logging.debug('TCP socket to graphite closed.')
-
-            self.processed += len(msg.split('\n'))
-            self._buffer = []
-        
-        except socket.error, msg:
-            logging.error('could not flush data to graphite server: %s' % (msg))
-            logging.error('will try again in %d seconds' % (self.flush_interval))
-        
+            key, value = line.split(':')
+        except ValueError:
+            logging.warning('got a bad line: %s' % (line))
+            self.bad_lines += 1
+            return
+
+        fields = value.split('|')
+        if not len(fields) > 1:
+            # Bad line
+            logging.warning('got a bad line: %s' % (line))
+            self.bad_lines += 1
+            return
+
+        msg_type = fields[1].strip()
+        msg_value = fields[0]
 
+        logging.debug('message key = %s, type = %s, message value = %s' % (key, msg_type, msg_value))
+
+        try:
+            sample_rate = 1.0
+            if len(fields) > 2 and fields[2].startswith('@'):
+                sample_rate = float(fields[2][1:])
+                if not 0 < sample_rate <= 1:
+                    raise ValueError('sample rate out of range')
 
-    def write(self, queue):
-        # Parse and aggregate data.
-        for message in queue:
-            key, value = message.split(':')
-            fields = value.split('|')
-            msg_type = fields[1].strip()
-            msg_value = fields[0]
-            
-            if not len(fields) > 1:
-                # Bad line
-                logging.warning('got a bad line: %s' % (message))
-                self.bad_lines += 1
-                continue
-            
-            logging.debug('message key = %s, type = %s, message value = %s' % (key, msg_type, msg_value))
-            
             # Timers
             if msg_type == 'ms':
+                timer_value = parse_value(msg_value)
+                if not key in self.timers:
+                    key = self._admit('timers', key)
+                    if key is None:
+                        return
                 if not key in self.timers:
-                    self.timers[key] = []
-                logging.debug('got timer request. appending to key = %s, value = %s' % (key, float(msg_value)))
-                self.timers[key].append(float(msg_value))
-            
+                    self.timers[key] = self.new_timer()
+                logging.debug('got timer request. appending to key = %s, value = %s' % (key, timer_value))
+                self.timers[key].add(timer_value, sample_rate)
+
             # Gauges
             elif msg_type == 'g':
+                gauge_value = parse_value(msg_value)
                 logging.debug('got gauge request. setting key = %s, value = %s' % (key, msg_value))
-                self.gauges[key] = msg_value
+                self.set_gauge(key, gauge_value)
+
+            # Sets
+            elif msg_type == 's':
+                if key not in self.sets:
+                    key = self._admit('sets', key)
+                    if key is None:
+                        return
+                if key not in self.sets:
+                    self.sets[key] = HyperLogLog(self.set_precision)
+                logging.debug('got set request. adding to key = %s, member = %s' % (key, msg_value))
+                self.sets[key].add(msg_value)
 
             # Counters
-            else:
-                if key not in self.counters:
-                    self.counters[key] = 0
+            elif msg_type == 'c':
+                counter_value = parse_value(msg_value)
                 logging.debug('got counter request. appending to key = %s, value = %s' % (key, msg_value))
-                self.counters[key] += float(msg_value)
-                logging.debug('counter request current value = %s' % (self.counters[key]))
-        
-        # aggregate data
-        timestamp = get_timestamp()
-        
+                self.add_counter(key, counter_value / sample_rate)
+
+            else:
+                raise ValueError('unknown metric type')
+        except ValueError:
+            logging.warning('got a bad value: %s' % (line))
+            self.bad_lines += 1
+
+
+    def add_counter(self, key, value):
+        """
+        Add `value` to a counter, like a parsed counter line does.
+        """
+        if key not in self.counters:
+            key = self._admit('counters', key)
+            if key is None:
+                return
+        self.counters[key] = self.counters.get(key, 0) + value
+
+
+    def set_gauge(self, key, value):
+        """
+        Set a gauge, like a parsed gauge line does.
+        """
+        if key not in self.gauges:
+            key = self._admit('gauges', key)
+            if key is None:
+                return
+        self.gauges[key] = value
+
+
+    def _admit(self, kind, key):
+        """
+        Returns the key to aggregate a metric of a key not seen during this flush interval into,
+        or None if the cardinality limiter rejects it.
+        """
+        key = self.keys.intern(key)
+        if self.limiter is None or key in self._last_seen[kind]:
+            return key
+        return self.limiter.admit(key)
+
+
+    def snapshot(self):
+        """
+        Hand over the counters, gauges, timers and sets aggregated so far,
+        and start aggregating from scratch.
+        """
+        state = {
+            'counters': self.counters,
+            'gauges': self.gauges,
+            'timers': self.timers,
+            'sets': self.sets,
+        }
+        self.counters = {}
+        self.gauges = {}
+        self.timers = {}
+        self.sets = {}
+        return state
+
+
+    def checkpoint(self):
+        """
+        The counters, gauges, timers and sets aggregated so far, like `snapshot`,
+        but without handing them over. gauges include the last value of idle gauges.
+        the returned state is live, it must be used before aggregating anything else.
+        """
+        gauges = dict(self._gauge_values)
+        gauges.update(self.gauges)
+        return {
+            'counters': self.counters,
+            'gauges': gauges,
+            'timers': self.timers,
+            'sets': self.sets,
+        }
+
+
+    def merge(self, state):
+        """
+        Fold partial aggregates taken by `snapshot` (possibly in another process,
+        or on another host) into this client: counters are summed, timers and sets
+        are merged and gauges take the merged value.
+        """
+        if self.limiter is not None:
+            state = self._admit_state(state)
+        for k, v in iteritems(state['counters']):
+            self.counters[k] = self.counters.get(k, 0) + v
+        self.gauges.update(state['gauges'])
+        for k, v in iteritems(state['timers']):
+            if k in self.timers:
+                self.timers[k] = merge_timers(self.timers[k], v)
+            else:
+                self.timers[k] = v
+        for k, v in iteritems(state['sets']):
+            if k in self.sets:
+                self.sets[k].merge(v)
+            else:
+                self.sets[k] = v
+
+
+    def _admit_state(self, state):
+        """
+        Run the keys of partial aggregates through the cardinality limiter.
+        """
+        admitted = {'counters': {}, 'gauges': {}, 'timers': {}, 'sets': {}}
+        for kind in ('counters', 'gauges', 'timers', 'sets'):
+            live = getattr(self, kind)
+            for k, v in iteritems(state[kind]):
+                if k not in live:
+                    k = self._admit(kind, k)
+                    if k is None:
+                        continue
+                if kind == 'counters':
+                    admitted[kind][k] = admitted[kind].get(k, 0) + v
+                elif kind == 'timers' and k in admitted[kind]:
+                    admitted[kind][k] = merge_timers(admitted[kind][k], v)
+                elif kind == 'sets' and k in admitted[kind]:
+                    admitted[kind][k].merge(v)
+                else:
+                    admitted[kind][k] = v
+        return admitted
+
+
+    def write(self, queue, timestamp=None, interval=None):
+        """
+        Parse and aggregate any raw messages in `queue`, then flush
+        everything aggregated so far to graphite.
+        When messages are parsed as they arrive (see `parse`), `queue` is empty.
+        """
+        self.parse_queue(queue)
+        self.flush(timestamp, interval)
+
+
+    def parse_queue(self, queue):
+        """
+        Parse and aggregate the raw messages in `queue`.
+        """
+        with self.timed('parse'):
+            for message in queue:
+                self.parse(message)
+
+
+    @contextmanager
+    def timed(self, phase):
+        """
+        Add the time spent in the block to the flush phase `phase` (see FLUSH_PHASES).
+        """
+        start = time.time()
+        yield
+        self.flush_phase_time[phase] += time.time() - start
+
+
+    def swap_window(self, interval):
+        """
+        Swap out the generation of aggregates of a window covering `interval` seconds, to be flushed.
+        """
+        with self.timed('aggregate'):
+            state = self.swap()
+            state['interval'] = interval
+        return state
+
+
+    def swap(self):
+        """
+        Swap out the current generation of aggregates in a single step,
+        and start filling a fresh one.
+        keys that were idle during the swapped out generation are added back to it
+        (counters at zero, gauges at their last value, timers and sets as `idle_timers` and `idle_sets`)
+        until they have been idle for longer than their type's TTL.
+        after that they are forgotten.
+        """
+        state = self.snapshot()
+        idle = self.expire(state)
+        if self.forward_host is not None:
+            # idle keys are reported by the central pencil, according to its own TTLs.
+            return state
+        state['counters'].update(dict.fromkeys(idle['counters'], 0))
+        for k in idle['gauges']:
+            state['gauges'][k] = self._gauge_values[k]
+        state['idle_timers'] = idle['timers']
+        state['idle_sets'] = idle['sets']
+        return state
+
+
+    def expire(self, state):
+        """
+        Close the generation `state` (taken by `snapshot`) was aggregated in:
+        keys idle for longer than their type's TTL are forgotten.
+        returns the keys that were idle during the generation, but are still kept, by type.
+        """
+        generation = self.generation
+        self.generation += 1
+        self._gauge_values.update(state['gauges'])
+
+        idle = {}
+        for kind in ('counters', 'gauges', 'timers', 'sets'):
+            ttl = self.ttls[kind]
+            seen = self._last_seen[kind]
+            seen.update(dict.fromkeys(state[kind], generation))
+            idle[kind] = []
+            expired = []
+            for k, last_seen in iteritems(seen):
+                if last_seen == generation:
+                    continue
+                if ttl is not None and generation - last_seen > ttl:
+                    expired.append(k)
+                else:
+                    idle[kind].append(k)
+            for k in expired:
+                self._evict(kind, k)
+        return idle
+
+
+    def _evict(self, kind, key):
+        """
+        Forget an idle key, along with the routes of the stats it was reported as.
+        """
+        del self._last_seen[kind][key]
+        self.evicted += 1
+        if self.limiter is not None:
+            self.limiter.release(key)
+        if kind == 'gauges':
+            del self._gauge_values[key]
+        for name in self.keys.forget(kind, key):
+            self._routes.pop(name, None)
+            if self.history is not None:
+                self.history.forget(name)
+
+
+    def crunch(self, state):
+        """
+        Crunch a generation of aggregates into (name, value) stats.
+        """
+        stats = []
+        names = self.keys.names
+
         # Timers
         # for each timer, save the raw count, min value, avg value,
-        # sum and max. value during this time period.
-        for k,v in self.timers.iteritems():
-            if len(v) > 0:
-                self.stats.append('%s.count %s %s' % (k, len(v), timestamp))
-                self.stats.append('%s.lower %s %s' % (k, int(min(v)), timestamp))
-                self.stats.append('%s.avg %s %s' % (k, int(sum(v, 0.0) / len(v)), timestamp))
-                self.stats.append('%s.sum %s %s' % (k, int(sum(v, 0)), timestamp))
-                self.stats.append('%s.upper %s %s' % (k, int(max(v)), timestamp))
-
-            # Reset timer.
-            self.timers[k] = []
-        
+        # sum, max. value and the configured percentiles during this time period.
+        for k, count, lower, mean, total, upper, percentiles in summarize(state['timers'], self.timer_percentiles):
+            values = [count, int(lower), int(mean), int(total), int(upper)]
+            values.extend([int(value) for value in percentiles])
+            stats.extend(zip(names('timers', k), values))
+        # idle timers only report their count.
+        for k in state.get('idle_timers', ()):
+            stats.append((names('timers', k)[0], 0))
+
         # Gauges
-        for k,v in self.gauges.iteritems():
-            self.stats.append('%s, %s, %s' % (k, v, timestamp))
+        stats.extend(iteritems(state['gauges']))
+
+        # Sets
+        # the estimated amount of unique members during this time period.
+        for k, sketch in iteritems(state['sets']):
+            stats.append((names('sets', k)[0], sketch.count()))
+        for k in state.get('idle_sets', ()):
+            stats.append((names('sets', k)[0], 0))
 
         # Counters
         # Calculate how many occurances happend, on avarage, per second.
-        for k,v in self.counters.iteritems():
-            if v == 0:
-                self.stats.append('%s_per_second %s %s' % (k, v, timestamp))
-                self.stats.append('%s %s %s' % (k, v, timestamp))
-            else:
-                self.stats.append('%s_per_second %s %s' % (k, v / self.flush_interval, timestamp))
-                self.stats.append('%s %s %s' % (k, v, timestamp))
-            
-            # Reset counter
-            self.counters[k] = 0
-        
-        logging.debug('about to send the following messages: %s' % (self.stats))
-        
+        interval = state.get('interval') or self.flush_interval
+        for k,v in iteritems(state['counters']):
+            per_second, name = names('counters', k)
+            stats.append((per_second, v / interval))
+            stats.append((name, v))
 
-        # Send over to graphite server.
-        if len(self.stats) > 0:
-            msg = '\n'.join(self.stats)
-            self._buffer.append(msg)
-            self.stats = []
+        return stats
 
-        if len(self._buffer) > 0:
-            logging.debug('buffer size: %s, sending data to graphite' % (len(self._buffer)))
-            self.socket_write_buffer()
-        else:
-            logging.debug('buffer is empty, not sending data to graphite')
-        
 
+    def format(self, state, timestamp):
+        """
+        Crunch a generation of aggregates, and serialize the stats for every backend.
+        returns a backend -> (message, stats count) mapping. the message is None
+        for backends without stats.
+        only touches the given state, the key table and the history,
+        so it is safe to run in a flush thread.
+        """
+        if self.forward_host is not None:
+            return self.format_batch(state, timestamp)
+        stats = self.crunch(state)
+        logging.debug('about to send the following messages: %s' % (stats))
+        if self.history is not None:
+            self.history.record(stats, timestamp)
 
-            
+        messages = {}
+        for backend, batch in iteritems(self.route(stats)):
+            if batch:
+                messages[backend] = (self.protocol.serialize(batch, timestamp), len(batch))
+        return messages
 
 
+    def format_batch(self, state, timestamp):
+        """
+        Serialize a generation of aggregates into a single batch for the central pencil,
+        counting every aggregated key as a stat. idle timers and sets are left out.
+        """
+        count = sum(len(state[kind]) for kind in ('counters', 'gauges', 'timers', 'sets'))
+        if not count:
+            return {}
+        interval = state.get('interval') or self.flush_interval
+        msg = pack_batch(state, timestamp, interval, self.forward_host)
+        return {self.backends[0]: (msg, count)}
 
 
+    def flush(self, timestamp=None, interval=None):
+        """
+        Swap out the aggregated data, crunch it into graphite-protocol messages
+        and send them to graphite.
+        the stats are stamped with `timestamp` (the flush schedule's window boundary),
+        and per second rates are over `interval` seconds. default to now and the flush interval.
+        with flush threads, crunching happens in a thread while the event loop keeps
+        ingesting into the fresh generation. sending always happens on the event loop.
+        """
+        if timestamp is None:
+            timestamp = get_timestamp()
+        state = self.swap_window(interval)
+        with self.timed('format'):
+            if self.flush_threadpool is not None:
+                messages = self.flush_threadpool.apply(self.format, (state, timestamp))
+            else:
+                messages = self.format(state, timestamp)
 
-
-
-        
-
-                
-            
-            
-    
+        # Send over to graphite server.
+        with self.timed('send'):
+            if len(self.backends) == 1:
+                backend = self.backends[0]
+                backend.flush(*messages.get(backend, (None, 0)))
+            else:
+                # backends are written to concurrently, so a slow one doesn't stall the others.
+                gevent.joinall([
+                    gevent.spawn(backend.flush, *messages.get(backend, (None, 0)))
+                    for backend in self.backends
+                ])
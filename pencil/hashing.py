@@ -0,0 +1,46 @@
+"""
+Consistent hashing of metric names to graphite backends.
+This is the same ring carbon-relay uses (carbon/hashing.py), so metrics sent
+through pencil land on the same carbon cache a carbon-relay would pick,
+and graphite-web finds them where it expects them.
+
+A backend is identified on the ring by its (host, instance) pair, exactly
+like carbon-relay destinations ("host:port:instance"). the port is not part
+of the ring position.
+"""
+
+import bisect
+from hashlib import md5
+
+from .compat import xrange, to_bytes
+
+
+def compact_hash(string):
+    return int(md5(to_bytes(string)).hexdigest()[:4], 16)
+
+
+class ConsistentHashRing(object):
+
+    def __init__(self, nodes, replica_count=100):
+        self.ring = []
+        self.nodes = set()
+        self.replica_count = replica_count
+        for node in nodes:
+            self.add_node(node)
+
+    def add_node(self, node):
+        self.nodes.add(node)
+        positions = set(position for position, n in self.ring)
+        for i in xrange(self.replica_count):
+            position = compact_hash('%s:%d' % (str(node), i))
+            while position in positions:
+                position += 1
+            positions.add(position)
+            bisect.insort(self.ring, (position, node))
+
+    def get_node(self, key):
+        position = compact_hash(key)
+        # (position,) sorts right before the entries at `position`, without comparing
+        # against their nodes (python 3 can't compare None with a node).
+        index = bisect.bisect_left(self.ring, (position,)) % len(self.ring)
+        return self.ring[index][1]
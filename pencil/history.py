@@ -0,0 +1,83 @@
+"""
+Recent history of flushed stats.
+Keeps the last few flushed values of every stat in memory, so what a metric
+has been doing lately can be looked up through the command server, without
+going through graphite.
+
+Every stat gets a fixed size ring buffer of doubles, holding one slot per flush.
+the flush timestamps are kept once, in a ring shared by all stats. flushes a stat
+was not part of are marked with NaN. rings are only allocated while the memory
+budget allows it.
+"""
+
+from array import array
+
+from .compat import xrange
+
+NAN = float('nan')
+# rough cost of a ring besides its values: the dict entry, the list and the array object.
+RING_OVERHEAD = 200
+
+
+class History(object):
+
+    def __init__(self, size, memory_limit=64 * 1024 * 1024):
+        self.size = size
+        self.memory_limit = memory_limit
+        self.flushes = 0
+        self.timestamps = array('d', [0]) * size
+        # stat name -> [values ring, index of the last flush the stat was part of]
+        self.rings = {}
+        self.ring_bytes = size * self.timestamps.itemsize + RING_OVERHEAD
+        # values not kept since the memory budget was used up.
+        self.dropped = 0
+
+    @property
+    def memory_bytes(self):
+        return len(self.rings) * self.ring_bytes + len(self.timestamps) * self.timestamps.itemsize
+
+    def record(self, stats, timestamp):
+        """
+        Keep the (name, value) stats of a single flush.
+        """
+        size = self.size
+        index = self.flushes
+        slot = index % size
+        self.timestamps[slot] = timestamp
+        rings = self.rings
+        for name, value in stats:
+            ring = rings.get(name)
+            if ring is None:
+                if self.memory_bytes + self.ring_bytes > self.memory_limit:
+                    self.dropped += 1
+                    continue
+                ring = rings[name] = [array('d', [NAN]) * size, index]
+            else:
+                # the stat missed the flushes since it was last recorded.
+                values = ring[0]
+                for missed in xrange(ring[1] + 1, min(index, ring[1] + 1 + size)):
+                    values[missed % size] = NAN
+            ring[0][slot] = value
+            ring[1] = index
+        self.flushes += 1
+
+    def values(self, name):
+        """
+        (timestamp, value) pairs of the recent flushes `name` was part of, oldest first.
+        """
+        ring = self.rings.get(name)
+        if ring is None:
+            return []
+        values, last = ring
+        result = []
+        for index in xrange(max(0, self.flushes - self.size), last + 1):
+            value = values[index % self.size]
+            if value == value:
+                result.append((int(self.timestamps[index % self.size]), value))
+        return result
+
+    def forget(self, name):
+        self.rings.pop(name, None)
+
+    def __contains__(self, name):
+        return name in self.rings
@@ -0,0 +1,214 @@
+"""
+HyperLogLog (Flajolet et al.), for the unique counts of set metrics.
+A set metric (`key:member|s`) counts the distinct members reported during a flush
+interval. keeping the members themselves would take memory in proportion to the
+traffic, so every member is hashed into one of 2^precision registers, each keeping
+the longest run of leading zero bits among the hashes it was given. the amount
+of distinct members is estimated from the registers, with a standard error of
+about 1.04 / sqrt(2^precision): 1.6% at the default precision of 12, in 4KB per set.
+
+Sets start out sparse, as a register -> value dict holding only the registers
+that were set, and switch to a dense array of registers once that takes less
+memory, so small sets (most of them, in practice) stay small.
+
+Sketches of the same precision merge losslessly (the register-wise maximum), so
+sets aggregated by ingest workers, restored from a snapshot or forwarded by other
+pencils, estimate exactly what a single sketch given every member would.
+a sketch folds exactly into any lower precision, so sketches of different
+precisions merge at the lower one.
+"""
+
+import math
+import struct
+from hashlib import md5
+
+from .compat import xrange, iteritems, itervalues, to_bytes
+
+MIN_PRECISION = 4
+MAX_PRECISION = 16
+
+HASH = struct.Struct('<Q')
+# precision, dense or not, amount of sparse registers.
+HEADER = struct.Struct('!BBI')
+# single byte strings, to count the registers holding every value.
+RANKS = [bytes(bytearray([rank])) for rank in xrange(66)]
+
+
+def check_precision(precision):
+    if not MIN_PRECISION <= precision <= MAX_PRECISION:
+        raise ValueError('set precision must be between %d and %d' % (MIN_PRECISION, MAX_PRECISION))
+
+
+def hash64(member):
+    return HASH.unpack(md5(to_bytes(member)).digest()[:8])[0]
+
+
+def alpha(m):
+    """
+    The bias correction constant for `m` registers.
+    """
+    if m == 16:
+        return 0.673
+    elif m == 32:
+        return 0.697
+    elif m == 64:
+        return 0.709
+    return 0.7213 / (1 + 1.079 / m)
+
+
+class HyperLogLog(object):
+
+    def __init__(self, precision=12):
+        check_precision(precision)
+        self.precision = precision
+        self.m = 1 << precision
+        # index -> value of the registers that were set, until the dense registers are smaller.
+        self.sparse = {}
+        self.registers = None
+        # dense registers only: how many are zero, and the sum of 2^-register over all of them.
+        self._zeros = 0
+        self._total = 0.0
+        # a dict entry takes about a hundred bytes, a dense register a single byte.
+        self._sparse_limit = max(16, self.m // 128)
+
+    def add(self, member):
+        x = hash64(member)
+        bits = 64 - self.precision
+        rest = x & ((1 << bits) - 1)
+        self._set(x >> bits, bits - rest.bit_length() + 1)
+
+    def _set(self, index, rank):
+        registers = self.registers
+        if registers is not None:
+            old = registers[index]
+            if rank > old:
+                registers[index] = rank
+                if not old:
+                    self._zeros -= 1
+                self._total += 2.0 ** -rank - 2.0 ** -old
+            return
+        sparse = self.sparse
+        if rank > sparse.get(index, 0):
+            sparse[index] = rank
+            if len(sparse) > self._sparse_limit:
+                self._densify()
+
+    def _densify(self):
+        registers = bytearray(self.m)
+        for index, rank in iteritems(self.sparse):
+            registers[index] = rank
+        self.registers = registers
+        self.sparse = None
+        self._recount()
+
+    def _recount(self):
+        registers = self.registers
+        self._zeros = registers.count(RANKS[0])
+        self._total = float(self._zeros)
+        for rank in xrange(1, 66 - self.precision):
+            self._total += registers.count(RANKS[rank]) * 2.0 ** -rank
+
+    def folded(self, precision):
+        """
+        This sketch at a lower precision: exactly the sketch of that precision
+        that would have been given the same members.
+        """
+        shift = self.precision - precision
+        mask = (1 << shift) - 1
+        sketch = HyperLogLog(precision)
+        if self.registers is None:
+            registers = iteritems(self.sparse)
+        else:
+            registers = enumerate(self.registers)
+        for index, rank in registers:
+            if not rank:
+                continue
+            # the low index bits move to the front of the hash bits the rank is counted in.
+            low = index & mask
+            if low:
+                rank = shift - low.bit_length() + 1
+            else:
+                rank += shift
+            sketch._set(index >> shift, rank)
+        return sketch
+
+    def merge(self, other):
+        """
+        Fold another sketch into this one.
+        sketches of different precisions (from pencils configured differently)
+        merge at the lower precision of the two.
+        """
+        if other.precision > self.precision:
+            other = other.folded(self.precision)
+        elif other.precision < self.precision:
+            self.__dict__.update(self.folded(other.precision).__dict__)
+        if other.registers is None:
+            for index, rank in iteritems(other.sparse):
+                self._set(index, rank)
+            return
+        if self.registers is None:
+            self._densify()
+        self.registers = bytearray(map(max, self.registers, other.registers))
+        self._recount()
+
+    def count(self):
+        """
+        The estimated amount of distinct members.
+        """
+        m = self.m
+        if self.registers is None:
+            zeros = m - len(self.sparse)
+            total = zeros + sum(2.0 ** -rank for rank in itervalues(self.sparse))
+        else:
+            zeros = self._zeros
+            total = self._total
+        estimate = alpha(m) * m * m / total
+        if estimate <= 2.5 * m and zeros:
+            # small range correction: linear counting.
+            estimate = m * math.log(float(m) / zeros)
+        return int(round(estimate))
+
+    def pack(self):
+        """
+        The sketch, as bytes.
+        """
+        if self.registers is not None:
+            return HEADER.pack(self.precision, 1, 0) + bytes(self.registers)
+        indexes = sorted(self.sparse)
+        ranks = [self.sparse[index] for index in indexes]
+        return HEADER.pack(self.precision, 0, len(indexes)) + \
+            struct.pack('!%dH%dB' % (len(indexes), len(indexes)), *(indexes + ranks))
+
+    @classmethod
+    def unpack(cls, data, offset=0):
+        """
+        A sketch packed by `pack`, and the offset right after it.
+        raises ValueError if the sketch is not valid.
+        """
+        precision, dense, amount = HEADER.unpack_from(data, offset)
+        offset += HEADER.size
+        sketch = cls(precision)
+        # the longest run of leading zeros (plus one) the hash bits left of the index can have.
+        max_rank = 65 - precision
+        if dense:
+            end = offset + sketch.m
+            if end > len(data):
+                raise ValueError('truncated set')
+            registers = bytearray(data[offset:end])
+            if max(registers) > max_rank:
+                raise ValueError('set register out of range')
+            sketch.sparse = None
+            sketch.registers = registers
+            sketch._recount()
+            return sketch, end
+        layout = struct.Struct('!%dH%dB' % (amount, amount))
+        values = layout.unpack_from(data, offset)
+        indexes = values[:amount]
+        ranks = values[amount:]
+        if amount and (max(indexes) >= sketch.m or not 1 <= min(ranks) <= max(ranks) <= max_rank):
+            raise ValueError('set register out of range')
+        sketch.sparse = dict(zip(indexes, ranks))
+        return sketch, offset + layout.size
+
+    def __repr__(self):
+        return '<set precision=%d count=%d>' % (self.precision, self.count())
@@ -0,0 +1,146 @@
+"""
+Pencil's own numbers.
+Keeps track of how busy the pencil server is - packets received, time spent parsing
+and flushing (in every phase of a flush), bytes sent to graphite, connection failures,
+spooled and dropped data, batches received from edge pencils, event loop blocks -
+and reports them in two ways:
+
+1. as `pencil.*` metrics, aggregated and sent to graphite on every flush
+   like any other counter or gauge.
+2. through the command server's `stats` command.
+
+The numbers are recorded right before a flush, so they go out with it: the
+ingest numbers (packets, parse time...) cover the window being flushed, while
+the numbers of flushing itself (flush duration and phases, bytes and datapoints
+sent, connection failures) cover the previous flush, and lag by one interval.
+"""
+
+import time
+
+from .compat import iteritems
+from .graphite_client import FLUSH_PHASES
+
+
+def kernel_drops(addr):
+    """
+    The amount of datagrams the kernel dropped for all UDP sockets bound to
+    the port of `addr` (this includes all ingest workers sharing it).
+    read from /proc/net/udp, so only available on linux. None elsewhere.
+    """
+    port = '%04X' % (int(addr.rsplit(':', 1)[1]))
+    drops = None
+    for path in ('/proc/net/udp', '/proc/net/udp6'):
+        try:
+            table = open(path)
+        except IOError:
+            continue
+        for line in list(table)[1:]:
+            fields = line.split()
+            if fields[1].rsplit(':', 1)[1] == port:
+                drops = (drops or 0) + int(fields[-1])
+        table.close()
+    return drops
+
+
+class Instrumentation(object):
+    """
+    Collects pencil's own numbers.
+    cumulative numbers (packets, bytes sent...) are sent to graphite as counters,
+    holding the change since the previous flush. point in time numbers
+    (spool depth, flush duration...) are sent as gauges.
+    """
+    def __init__(self, pencil_server, prefix='pencil'):
+        self.pencil_server = pencil_server
+        self.prefix = prefix
+
+        # updated by the pencil server itself.
+        self.parse_time = 0.0
+        self.flush_duration = 0.0
+        self.flushes = 0
+
+        self.start_time = time.time()
+        self._last_record_time = self.start_time
+        self._last_totals = {}
+        self.last_interval = {}
+
+    def totals(self):
+        """
+        Cumulative numbers since the server started.
+        """
+        server = self.pencil_server
+        graphite = server.graphite
+        backends = graphite.backends
+        totals = {
+            'packets': server.request_count,
+            'bad_lines': graphite.bad_lines,
+            'parse_time_ms': self.parse_time * 1000,
+            'flushes': self.flushes,
+            'flush_overruns': server.schedule.overruns,
+            'datapoints_sent': graphite.processed,
+            'bytes_sent': sum(b.bytes_sent for b in backends),
+            'graphite_connect_failures': sum(b.connection.connect_failures for b in backends),
+            'spool_dropped': sum(b.spool.dropped for b in backends),
+            'evicted_keys': graphite.evicted,
+            'rejected_metrics': graphite.limiter.rejected if graphite.limiter is not None else 0,
+            'kernel_drops': kernel_drops(server.settings['bind_adress']) or 0,
+            'batches': server.batch_count,
+            'late_batches': server.late_batches,
+            'bad_batches': server.bad_batches,
+            'hub_blocks': server.block_detector.blocks if server.block_detector is not None else 0,
+        }
+        # time spent in every phase of flushing, e.g. flush_format_ms.
+        for phase in FLUSH_PHASES:
+            totals['flush_%s_ms' % (phase)] = graphite.flush_phase_time[phase] * 1000
+        return totals
+
+    def gauges(self):
+        """
+        Point in time numbers.
+        """
+        graphite = self.pencil_server.graphite
+        backends = graphite.backends
+        return {
+            'flush_duration_ms': self.flush_duration * 1000,
+            'spool_depth': sum(len(b.spool) for b in backends),
+            'spool_bytes': sum(b.spool.memory_bytes + b.spool.disk_bytes for b in backends),
+            'keys': graphite.key_count,
+            'history_bytes': graphite.history.memory_bytes if graphite.history is not None else 0,
+        }
+
+    def record(self):
+        """
+        Feed the numbers since the previous call into the graphite client's
+        aggregators, to be sent along with the next flush.
+        they are aggregated like parsed metrics, so the cardinality limits apply to them too.
+        the flush they are sent with is not done yet, so its own numbers are recorded by the next call.
+        """
+        now = time.time()
+        elapsed = max(now - self._last_record_time, 1e-6)
+        totals = self.totals()
+        graphite = self.pencil_server.graphite
+
+        interval = {}
+        for name, value in iteritems(totals):
+            interval[name] = float(value - self._last_totals.get(name, 0))
+            graphite.add_counter('%s.%s' % (self.prefix, name), interval[name])
+        interval['packets_per_second'] = interval['packets'] / elapsed
+        for name, value in iteritems(self.gauges()):
+            graphite.set_gauge('%s.%s' % (self.prefix, name), value)
+
+        self._last_totals = totals
+        self._last_record_time = now
+        self.last_interval = interval
+
+    def report(self):
+        """
+        All numbers, for the command server: totals, gauges,
+        and the changes during the last flush interval.
+        """
+        report = {}
+        report.update(self.totals())
+        report.update(self.gauges())
+        report['uptime'] = time.time() - self.start_time
+        report['packets_per_second'] = report['packets'] / max(report['uptime'], 1e-6)
+        for name, value in iteritems(self.last_interval):
+            report['last_interval.%s' % (name)] = value
+        return report
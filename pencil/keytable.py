@@ -0,0 +1,56 @@
+"""
+The metric key table.
+The set of keys is mostly stable from one flush to the next, so the names
+every key is reported as (`<key>.count`, `<key>_per_second`...) are built once,
+when the key is first flushed, and reused by every following flush.
+keys are interned, so the aggregates, the idle key tracking and the table
+all share a single copy of every key.
+"""
+
+from .compat import intern, itervalues
+from .timers import percentile_name
+
+TIMER_SUFFIXES = ['count', 'lower', 'avg', 'sum', 'upper']
+
+
+class KeyTable(object):
+
+    def __init__(self, timer_percentiles=()):
+        self.timer_suffixes = TIMER_SUFFIXES + [percentile_name(pct) for pct in timer_percentiles]
+        self._names = {'counters': {}, 'gauges': {}, 'timers': {}, 'sets': {}}
+
+    def intern(self, key):
+        return intern(key)
+
+    def names(self, kind, key):
+        """
+        The names of the stats `key` is reported as:
+        counters - (key_per_second, key)
+        gauges - (key,)
+        sets - (key,)
+        timers - (key.count, key.lower, key.avg, key.sum, key.upper, key.pNN...)
+        """
+        table = self._names[kind]
+        names = table.get(key)
+        if names is None:
+            names = table[key] = self._build(kind, key)
+        return names
+
+    def forget(self, kind, key):
+        """
+        Drop a key from the table, returning the names it was reported as.
+        """
+        names = self._names[kind].pop(key, None)
+        if names is None:
+            names = self._build(kind, key)
+        return names
+
+    def _build(self, kind, key):
+        if kind == 'counters':
+            return ('%s_per_second' % (key), key)
+        elif kind in ('gauges', 'sets'):
+            return (key,)
+        return tuple(['%s.%s' % (key, suffix) for suffix in self.timer_suffixes])
+
+    def __len__(self):
+        return sum(len(table) for table in itervalues(self._names))
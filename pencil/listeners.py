@@ -1,25 +1,325 @@
 """
 This is the application side interface.
 the UDP listener is a lean and mean component that takes a message from a pencil (or statsd) client,
-and adds it to the current message buffer for the running pencil server.
+and either adds it to the current message buffer for the running pencil server,
+or hands it over to a message handler that parses it right away.
+
+Two UDP listeners are available:
+
+1. UDPListener - a gevent `DatagramServer`, waking up the event loop once per datagram.
+2. BatchedUDPListener - drains up to `batch_size` datagrams per wakeup in a tight loop,
+   using recvmmsg(2) where available, and recvfrom_into a preallocated buffer otherwise.
+
+For clients that can't afford to lose data, TCPListener accepts the same newline
+delimited lines over persistent TCP connections.
+
+A central pencil receives the batches forwarded by edge pencils (see forward.py) with BatchListener.
 """
+import os
+import errno
 import logging
-from gevent.server import DatagramServer
+import ctypes
+import ctypes.util
+import socket as native_socket
+
+import gevent
+from gevent import socket
+from gevent.server import DatagramServer, StreamServer
+
+from .compat import xrange
+from .forward import FRAME_HEADER, MAX_BATCH_SIZE
+
+# not exposed by the socket module of older pythons. this is the linux value.
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+
+# the largest possible UDP payload.
+MAX_DATAGRAM_SIZE = 65535
+
 
 class UDPListener(DatagramServer):
 
     def __init__(self, *args, **kwargs):
         self.message_buffer = kwargs.pop('message_buffer')
-        super(UDPListener, self).__init__(*args, **kwargs)        
+        self.message_handler = kwargs.pop('message_handler', None)
+        super(UDPListener, self).__init__(*args, **kwargs)
 
     def handle(self, data, address):
         logging.debug('got message from %s: "%s"' % (address, data))
-        self.message_buffer.append(data)
-    
+        if self.message_handler is not None:
+            self.message_handler(data)
+        else:
+            self.message_buffer.append(data)
+
     def __str__(self):
         return 'Pencil UDP Listener'
 
 
+class TCPListener(StreamServer):
+    """
+    Newline delimited statsd lines over persistent TCP connections.
+    data is read in large chunks, and the complete lines of every chunk are handed
+    to the message handler at once. a partial line at the end of a chunk waits for the next one.
+    nothing more is read from a connection while its data is being parsed, so a client
+    sending faster than pencil parses is slowed down by TCP flow control, instead of losing data.
+    """
+    read_size = 65536
+    max_line_length = 65536
+
+    def __init__(self, *args, **kwargs):
+        self.message_handler = kwargs.pop('message_handler')
+        super(TCPListener, self).__init__(*args, **kwargs)
+        self.dropped_lines = 0
+
+    def handle(self, sock, address):
+        logging.debug('new TCP ingest connection from %s' % (str(address)))
+        pending = b''
+        try:
+            while True:
+                data = sock.recv(self.read_size)
+                if not data:
+                    break
+                if pending:
+                    data = pending + data
+                end = data.rfind(b'\n')
+                if end < 0:
+                    pending = data
+                    if len(pending) > self.max_line_length:
+                        logging.warning('dropping a line longer than %d bytes from %s' % (
+                            self.max_line_length, str(address)
+                        ))
+                        self.dropped_lines += 1
+                        pending = b''
+                    continue
+                pending = data[end + 1:]
+                self.message_handler(data[:end])
+                # don't let a busy connection starve the other listeners.
+                gevent.sleep(0)
+        except socket.error as e:
+            logging.warning('TCP ingest connection from %s failed: %s' % (str(address), e))
+        finally:
+            sock.close()
+        # the last line doesn't have to end with a newline.
+        if pending:
+            self.message_handler(pending)
+
+    def __str__(self):
+        return 'Pencil TCP Listener'
+
+
+class BatchListener(StreamServer):
+    """
+    Batches of partial aggregates forwarded by edge pencils, over persistent TCP connections.
+    every batch is framed by its length, and handed to the batch handler as soon as it was read in full.
+    """
+    def __init__(self, *args, **kwargs):
+        self.batch_handler = kwargs.pop('batch_handler')
+        super(BatchListener, self).__init__(*args, **kwargs)
+
+    def handle(self, sock, address):
+        logging.debug('new batch connection from %s' % (str(address)))
+        reader = sock.makefile('rb')
+        try:
+            while True:
+                header = reader.read(FRAME_HEADER.size)
+                if not header:
+                    break
+                payload = b''
+                if len(header) == FRAME_HEADER.size:
+                    length, = FRAME_HEADER.unpack(header)
+                    if length > MAX_BATCH_SIZE:
+                        logging.warning('closing the batch connection from %s: a batch of %d bytes is too large' % (
+                            str(address), length
+                        ))
+                        break
+                    payload = reader.read(length)
+                if len(header) < FRAME_HEADER.size or len(payload) < length:
+                    logging.warning('batch connection from %s closed mid batch' % (str(address)))
+                    break
+                self.batch_handler(payload)
+        except socket.error as e:
+            logging.warning('batch connection from %s failed: %s' % (str(address), e))
+        finally:
+            reader.close()
+            sock.close()
+
+    def __str__(self):
+        return 'Pencil batch Listener'
+
+
+# recvmmsg(2) structures, see <sys/socket.h>
+class IOVec(ctypes.Structure):
+    _fields_ = [
+        ('iov_base', ctypes.c_void_p),
+        ('iov_len', ctypes.c_size_t),
+    ]
+
+
+class MsgHdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_name', ctypes.c_void_p),
+        ('msg_namelen', ctypes.c_uint32),
+        ('msg_iov', ctypes.POINTER(IOVec)),
+        ('msg_iovlen', ctypes.c_size_t),
+        ('msg_control', ctypes.c_void_p),
+        ('msg_controllen', ctypes.c_size_t),
+        ('msg_flags', ctypes.c_int),
+    ]
+
+
+class MMsgHdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_hdr', MsgHdr),
+        ('msg_len', ctypes.c_uint),
+    ]
+
+
+def _load_recvmmsg():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        recvmmsg = libc.recvmmsg
+    except (OSError, AttributeError, TypeError):
+        return None
+    recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(MMsgHdr), ctypes.c_uint,
+                         ctypes.c_int, ctypes.c_void_p]
+    recvmmsg.restype = ctypes.c_int
+    return recvmmsg
+
+_recvmmsg = _load_recvmmsg()
+MSG_DONTWAIT = getattr(native_socket, 'MSG_DONTWAIT', 0x40)
+
+
+class BatchedUDPListener(object):
+    """
+    A high-throughput UDP listener.
+    waits for the socket to become readable, then receives up to `batch_size`
+    datagrams without going back to the event loop, and hands them to the
+    message handler directly, instead of spawning a greenlet per datagram.
+    datagrams are received into buffers allocated once, at startup.
+    """
+    def __init__(self, sock, message_buffer, message_handler=None, batch_size=64):
+        self.socket = sock
+        self.socket.setblocking(0)
+        self.message_buffer = message_buffer
+        self.message_handler = message_handler
+        self.batch_size = batch_size
+        self._stopped = True
+
+        if _recvmmsg is not None:
+            self._buffers = [ctypes.create_string_buffer(MAX_DATAGRAM_SIZE) for i in xrange(batch_size)]
+            self._addresses = [ctypes.addressof(buf) for buf in self._buffers]
+            self._iovecs = (IOVec * batch_size)()
+            self._msgs = (MMsgHdr * batch_size)()
+            for i in xrange(batch_size):
+                self._iovecs[i].iov_base = self._addresses[i]
+                self._iovecs[i].iov_len = MAX_DATAGRAM_SIZE
+                self._msgs[i].msg_hdr.msg_iov = ctypes.pointer(self._iovecs[i])
+                self._msgs[i].msg_hdr.msg_iovlen = 1
+            self.receive_batch = self._receive_recvmmsg
+        else:
+            self._buffer = bytearray(MAX_DATAGRAM_SIZE)
+            self._view = memoryview(self._buffer)
+            self.receive_batch = self._receive_recvfrom_into
+
+    def _receive_recvmmsg(self):
+        count = _recvmmsg(self.socket.fileno(), self._msgs, self.batch_size, MSG_DONTWAIT, None)
+        if count < 0:
+            err = ctypes.get_errno()
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return []
+            raise native_socket.error(err, os.strerror(err))
+        return [ctypes.string_at(self._addresses[i], self._msgs[i].msg_len) for i in xrange(count)]
+
+    def _receive_recvfrom_into(self):
+        datagrams = []
+        while len(datagrams) < self.batch_size:
+            try:
+                size, address = self.socket.recvfrom_into(self._buffer)
+            except native_socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    break
+                raise
+            datagrams.append(self._view[:size].tobytes())
+        return datagrams
+
+    def handle(self, data):
+        if self.message_handler is not None:
+            self.message_handler(data)
+        else:
+            self.message_buffer.append(data)
+
+    def serve_forever(self):
+        self._stopped = False
+        fileno = self.socket.fileno()
+        while not self._stopped:
+            try:
+                socket.wait_read(fileno, timeout=1)
+            except socket.timeout:
+                continue
+
+            # like gevent's DatagramServer, errors are contained to the receive or the datagram
+            # they happened in, instead of ending the listener.
+            try:
+                datagrams = self.receive_batch()
+            except Exception:
+                logging.exception('could not receive datagrams')
+                continue
+            for data in datagrams:
+                try:
+                    self.handle(data)
+                except Exception:
+                    logging.exception('could not handle a datagram: %r' % (data[:100],))
+
+            # a full batch means more datagrams are waiting.
+            # let other greenlets (flush, commands) run before draining them.
+            if len(datagrams) == self.batch_size:
+                gevent.sleep(0)
+
+    def stop(self):
+        self._stopped = True
+
+    def __str__(self):
+        return 'Pencil batched UDP Listener'
+
+
+def create_udp_socket(addr, reuse_port=False, receive_buffer_size=0, native=False):
+    """
+    A UDP socket bound to `addr`.
+    with `reuse_port`, several processes can bind the same address and share its traffic.
+    a non zero `receive_buffer_size` sets the kernel receive buffer (SO_RCVBUF),
+    so bursts of datagrams don't overflow it.
+    """
+    host, port = addr.rsplit(':', 1)
+    if native:
+        sock = native_socket.socket(native_socket.AF_INET, native_socket.SOCK_DGRAM)
+    else:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+    if receive_buffer_size:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, receive_buffer_size)
+        actual = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+        logging.info('UDP receive buffer size is %d bytes' % (actual))
+    sock.bind((host, int(port)))
+    return sock
+
+
+def create_datagram_server(addr, message_buffer, message_handler=None, reuse_port=False,
+                           receive_mode='datagram', batch_size=64, receive_buffer_size=0):
+    if receive_mode == 'batched':
+        sock = create_udp_socket(addr, reuse_port, receive_buffer_size, native=True)
+        return BatchedUDPListener(sock, message_buffer=message_buffer,
+            message_handler=message_handler, batch_size=batch_size)
+    elif receive_mode != 'datagram':
+        raise ValueError('unknown receive mode: %s' % (receive_mode))
+
+    if reuse_port or receive_buffer_size:
+        addr = create_udp_socket(addr, reuse_port, receive_buffer_size)
+    return UDPListener(addr, message_buffer=message_buffer, message_handler=message_handler)
+
+
+def create_stream_server(addr, message_handler):
+    return TCPListener(addr, message_handler=message_handler)
+
 
-def create_datagram_server(addr, message_buffer):
-    return UDPListener(addr, message_buffer=message_buffer)
+def create_batch_server(addr, batch_handler):
+    return BatchListener(addr, batch_handler=batch_handler)
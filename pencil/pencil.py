@@ -3,16 +3,19 @@
 A non blocking statsd-like UDP proxy to the Graphite graphing server.
 This is more than just a python implementation of statsd. the differences are:
 
-1. Support for gauges (arbitrary numbers) in addition to aggregated counters and timers.
+1. Support for gauges (arbitrary numbers) and sets (unique counts) in addition to aggregated counters and timers.
 2. No forced name spaces. up to the client to determine the prefixes for his data.
 3. Well, built in python. so no dependency on node.js if it isn't part of your stack.
 
 Dependencies:
 
 Described requirements.txt (pip installable).
-but basically you need only python > 2.5 (tested against python 2.6 and python 2.7)
+but basically you need only python 2.7, or python 3,
 and the gevent (http://gevent.org) library for the nifty async I/O stuff.
 in order to build gevent (latest version in pypi is too old), you need Cython installed.
+on python 3.7 and up, pencil can run on asyncio instead of gevent (see the 'runtime' setting),
+with uvloop (https://github.com/MagicStack/uvloop) when it is installed.
+numpy is optional. when it is installed, raw timers are summarized in vectorized batches at flush time.
 
 HOWTO:
 
@@ -33,11 +36,68 @@ Available settings:
     default is '127.0.0.1:8126'
 
     'flush_interval' - Time in seconds between flushes to Graphite.
-    default is  10
+    flushes happen on interval boundaries of the wall clock, and stats are stamped with
+    the boundary closing their window. default is  10
+
+    'flush_jitter' - Upper bound, in seconds, of a per host offset added to every flush,
+    so a fleet of pencils doesn't flush to carbon at the same second. timestamps are not
+    affected. 0 flushes right on the boundaries. default is 0
+
+    'flush_overrun' - What to do with windows a slow flush ran past. 'merge' flushes them
+    together as soon as the slow flush is done, 'skip' flushes them along with the window
+    of the next boundary. default is 'merge'
     
     'graphite_address' - Where graphite is listening to (127.0.0.1:2003 is the default for graphite).
+    may also be a list of carbon backends, in which case every metric is sent to a single backend,
+    chosen by consistent hashing of its name, the same way carbon-relay does. backends on the same host
+    need distinct instance names, like carbon-relay destinations: 'host:port:instance'.
     default is '127.0.0.1:2003'
 
+    'graphite_protocol' - How to send data to graphite. 'line' is carbon's plaintext protocol,
+    'pickle' is carbon's pickle protocol (listening on port 2004 by default), which is cheaper for large flushes.
+    default is 'line'
+
+    'graphite_pickle_batch_size' - Maximum amount of stats in a single pickle protocol frame.
+    default is 500
+
+    'flush_threads' - Threads used to crunch and format aggregated data at flush time.
+    the aggregates are swapped out in a single step, so the event loop keeps ingesting into a fresh set of
+    aggregates while a thread formats the previous one. 0 formats on the event loop. default is 0
+
+    'graphite_timeout' - Seconds to wait when connecting to graphite.
+    default is 5
+
+    'graphite_backoff_min', 'graphite_backoff_max' - Seconds to wait before reconnecting to graphite after a failure.
+    the delay doubles on every consecutive failure, from graphite_backoff_min up to graphite_backoff_max.
+    default is 1 and 60
+
+    'spool_path' - File to spool undeliverable data to, once 'spool_memory_limit' is reached.
+    with several graphite backends, every backend gets its own file, suffixed with its address.
+    null keeps the spool in memory only. default is null
+
+    'spool_memory_limit', 'spool_disk_limit' - Bytes of undeliverable data to keep in memory, and on disk.
+    with a spool file, the two limits make up a single budget. once it is used up, the oldest data
+    is dropped, so the disk tier can grow past its limit while the memory tier drains. default is 16MB and 1GB
+
+    'spool_drop_policy' - 'oldest' only drops data when the spool is full.
+    'age' also drops data older than 'spool_max_age' seconds. default is 'oldest'
+
+    'spool_max_age' - Seconds to keep undeliverable data for, with the 'age' drop policy.
+    default is 86400
+
+    'spool_replay_rate' - Bytes per second to replay spooled data at, once graphite is back.
+    0 replays as fast as possible. default is 0
+
+    'instrumentation' - Whether pencil sends its own numbers (packets - every line read over TCP
+    counts as one - parse time, flush duration, time spent in every phase of flushing, bytes sent,
+    graphite connection failures, spool depth, dropped data, event loop blocks) to graphite on every flush.
+    the numbers about flushing are those of the previous flush, so they lag by one flush interval.
+    they count against the cardinality limits like any other metric.
+    they are also available through the command server's 'stats' command. default is false
+
+    'instrumentation_prefix' - Prefix of pencil's own metrics.
+    default is 'pencil'
+
     'log_name' - Path to the log file for the server.
     default is 'pencil.log'
 
@@ -45,23 +105,141 @@ Available settings:
     'log_level' - How much information do you want in your log file.
     default is 'info'. possible values are: 'debug','info','warning','error'.
     Choose 'error' if you don't care and just want the minimum amount of logging done.
+
+    'ingest_mode' - When to parse incoming messages. 'incremental' parses every message as it arrives,
+    so memory is bounded by the number of distinct metrics. 'buffered' keeps the raw messages until the next flush.
+    default is 'incremental'
+
+    'receive_mode' - How datagrams are received. 'datagram' wakes up the event loop for every datagram.
+    'batched' drains up to 'receive_batch_size' datagrams per wakeup, using recvmmsg(2) where available.
+    default is 'datagram'
+
+    'receive_batch_size' - Maximum amount of datagrams received per wakeup in 'batched' receive mode.
+    default is 64
+
+    'receive_buffer_size' - Size in bytes of the kernel receive buffer (SO_RCVBUF) of the UDP socket.
+    larger buffers absorb larger bursts. 0 keeps the system default. default is 0
+
+    'tcp_bind_address' - Where to listen for newline delimited lines over TCP, next to the UDP port.
+    for clients that can't afford to lose data: a client sending faster than pencil parses is slowed down
+    instead of losing data. lines received over TCP are always parsed as they arrive,
+    in the main process. null disables the TCP listener. default is null
+
+    'workers' - Amount of ingest worker processes. every worker binds 'bind_adress' with SO_REUSEPORT
+    and aggregates on its own core. at every flush, the partial aggregates of all workers are merged and sent once.
+    the cardinality limits and TTLs apply in every worker as well. 0 parses everything in the main process. default is 0
+
+    'timer_engine' - How timer samples are kept between flushes. 'raw' keeps every sample.
+    'histogram' keeps a log-bucketed histogram, so memory per timer is fixed no matter the amount of samples.
+    default is 'raw'
+
+    'timer_percentiles' - Percentiles sent for every timer, next to count, lower, avg, sum and upper.
+    e.g. 99.9 is sent as '<key>.p999'.
+    default is [50, 90, 99, 99.9]
+
+    'timer_precision' - Relative error of percentiles calculated by the 'histogram' timer engine.
+    default is 0.01
+
+    'set_precision' - Precision (in bits, 4 to 16) of the HyperLogLog sketches estimating the unique
+    members of set metrics ('key:member|s'). every bit doubles the memory of a set (up to 2^precision
+    bytes) and divides its error by the square root of 2: 12 is about 1.6% error in 4KB.
+    default is 12
+
+    'counter_ttl', 'gauge_ttl', 'timer_ttl', 'set_ttl' - Flush intervals an idle key keeps being reported for,
+    before it is forgotten. idle counters and sets are reported as 0, idle gauges at their last value
+    and idle timers as '<key>.count 0'. null never forgets idle keys.
+    default is null, null, 0 and null
+
+    'max_keys', 'max_keys_per_prefix' - Caps on the amount of distinct keys, in total and per prefix.
+    a prefix is the first 'cardinality_prefix_depth' dot separated parts of a key. 0 is unlimited.
+    default is 0 and 0
+
+    'cardinality_prefix_depth' - Dot separated parts of a key making up its prefix.
+    default is 1
+
+    'cardinality_policy' - What to do with new keys over a cap. 'reject' drops their metrics,
+    'overflow' aggregates them into 'cardinality_overflow_key' instead. the top prefixes responsible
+    are listed by the command server's 'cardinality' command. default is 'reject'
+
+    'cardinality_overflow_key' - Key to aggregate metrics of keys over a cap into, with the 'overflow' policy.
+    default is 'pencil.overflow'
+
+    'cardinality_top_k' - Amount of offending prefixes tracked.
+    default is 20
+
+    'history_size' - Amount of recent flushed values kept in memory for every stat,
+    listed by the command server's 'history <key>' command. 0 keeps nothing. default is 0
+
+    'history_memory_limit' - Bytes of memory the recent history may use. stats that don't fit
+    aren't kept. default is 64MB
+
+    'runtime' - The event loop pencil runs on. 'gevent', or 'asyncio' (python 3.7 and up),
+    which runs on uvloop when it is installed. ingest workers and the 'batched' receive mode
+    are only available with gevent. default is 'gevent'
+
+    'snapshot_path' - Where to keep a snapshot of the aggregates of the current window and of the
+    output not delivered to graphite yet. with a snapshot path, shutting down writes a snapshot
+    instead of flushing a partial window, and the next pencil picks it up on startup.
+    None disables snapshots. default is None
+
+    'snapshot_interval' - Time in seconds between checkpoint snapshots, against crashes.
+    0 only writes a snapshot on shutdown. default is 0
+
+    'forward_address' - Where a central pencil receives batches. with a forward address, this pencil is
+    an edge: on every flush it forwards its aggregates to the central pencil as a compact binary batch,
+    instead of sending stats to graphite. undeliverable batches are spooled like graphite data.
+    edges should use a per host 'instrumentation_prefix'. null sends to graphite. default is null
+
+    'forward_bind_address' - Where a central pencil listens for the batches of edge pencils (TCP).
+    batches are merged into the current window. null disables the batch listener. default is null
+
+    'flush_delay' - Seconds to wait after every interval boundary before flushing, on top of the jitter.
+    a central pencil should wait longer than its edges' flush_jitter plus the time they take to flush,
+    so their batches make it into the right window. default is 0
+
+    'block_threshold' - Seconds the event loop may be held without yielding (by parsing, flushing,
+    a command...) before the stack holding it is logged, and listed by the command server's 'blocks'
+    command. 0 disables block detection. default is 0
 """
 
+import os
 import sys
+import time
+import socket
 import pprint
 import datetime
 import logging
-try:
-    import json
-except ImportError:
-    # For python < 2.6
-    import simplejson as json
+from contextlib import contextmanager
+import json
 
-import gevent
+if __name__ == '__main__' and not __package__:
+    # run as a script (./pencil.py): import the package this module belongs to,
+    # instead of the modules next to it, so the relative imports below resolve.
+    sys.path[0] = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    import pencil
+    __package__ = 'pencil'
 
-from command_server import create_command_server
-from listeners import create_datagram_server
-from graphite_client import Graphite
+try:
+    import gevent
+    from gevent.event import Event
+    from gevent.threadpool import ThreadPool
+    from .listeners import create_datagram_server, create_stream_server, create_batch_server
+    from .workers import WorkerPool
+except ImportError:
+    # without gevent, only the asyncio runtime is available (see aio.py).
+    gevent = None
+
+from .command_server import create_command_server
+from .graphite_client import Graphite, GraphiteBackend
+from .spool import Spool
+from .instrumentation import Instrumentation
+from .cardinality import CardinalityLimiter
+from .history import History
+from .scheduler import FlushSchedule
+from .snapshot import write_snapshot, read_snapshot
+from .forward import unpack_batch
+from .profiler import SamplingProfiler, BlockDetector
+from .compat import iteritems
 
 
 DEFAULT_SETTINGS = {
@@ -74,13 +252,104 @@ DEFAULT_SETTINGS = {
     
     # Time in seconds between flushes to Graphite
     'flush_interval' : 10,
+
+    # Upper bound of a per host flush offset, in seconds. 0 flushes on the interval boundaries
+    'flush_jitter' : 0,
+
+    # Windows a slow flush ran past. One of: merge, skip
+    'flush_overrun' : 'merge',
+
+    # Seconds to wait after every boundary before flushing, for batches of edge pencils
+    'flush_delay' : 0,
     
     # Where graphite is listening to (127.0.0.1:2003 is the default for graphite)
+    # a list of addresses shards metrics between several carbon backends.
     'graphite_address' : '127.0.0.1:2003',
 
+    # One of: line, pickle. use carbon's pickle port (2004) with the pickle protocol.
+    'graphite_protocol' : 'line',
+    'graphite_pickle_batch_size' : 500,
+
+    # Threads formatting swapped out aggregates at flush time. 0 formats on the event loop.
+    'flush_threads' : 0,
+
+    # Connection to graphite. reconnects back off exponentially between min and max seconds.
+    'graphite_timeout' : 5,
+    'graphite_backoff_min' : 1,
+    'graphite_backoff_max' : 60,
+
+    # Undeliverable data is spooled in memory, then on disk. see spool.py
+    'spool_path' : None,
+    'spool_memory_limit' : 16 * 1024 * 1024,
+    'spool_disk_limit' : 1024 * 1024 * 1024,
+    'spool_drop_policy' : 'oldest', # One of: oldest, age
+    'spool_max_age' : 86400,
+    'spool_replay_rate' : 0,
+
+    # pencil's own metrics, sent as <prefix>.* on every flush.
+    'instrumentation' : False,
+    'instrumentation_prefix' : 'pencil',
+
     # Logging, if needed.
     'log_name' : 'pencil.log',
-    'log_level' : 'info' # One of:  debug, info, warning, error
+    'log_level' : 'info', # One of:  debug, info, warning, error
+
+    # When to parse incoming messages. One of: incremental, buffered
+    'ingest_mode' : 'incremental',
+
+    # How datagrams are received. One of: datagram, batched
+    'receive_mode' : 'datagram',
+    'receive_batch_size' : 64,
+    # SO_RCVBUF for the UDP socket, in bytes. 0 keeps the system default.
+    'receive_buffer_size' : 0,
+
+    # Newline delimited lines over TCP. null disables the TCP listener.
+    'tcp_bind_address' : None,
+
+    # Ingest worker processes sharing bind_adress. 0 is single process mode.
+    'workers' : 0,
+
+    # Timer aggregation. engine is one of: raw, histogram
+    'timer_engine' : 'raw',
+    'timer_percentiles' : [50, 90, 99, 99.9],
+    'timer_precision' : 0.01,
+
+    # Precision bits of set metric sketches, 4 to 16
+    'set_precision' : 12,
+
+    # Flush intervals idle keys keep being reported for. null never forgets them.
+    'counter_ttl' : None,
+    'gauge_ttl' : None,
+    'timer_ttl' : 0,
+    'set_ttl' : None,
+
+    # Caps on distinct keys. 0 is unlimited. policy is one of: reject, overflow
+    'max_keys' : 0,
+    'max_keys_per_prefix' : 0,
+    'cardinality_prefix_depth' : 1,
+    'cardinality_policy' : 'reject',
+    'cardinality_overflow_key' : 'pencil.overflow',
+    'cardinality_top_k' : 20,
+
+    # Recent flushed values per stat, for the history command. 0 keeps nothing.
+    'history_size' : 0,
+    'history_memory_limit' : 64 * 1024 * 1024,
+
+    # The event loop. One of: gevent, asyncio
+    'runtime' : 'gevent',
+
+    # Snapshot of the in flight state, for restarts. None disables snapshots
+    'snapshot_path' : None,
+    # Time in seconds between checkpoint snapshots. 0 only writes one on shutdown
+    'snapshot_interval' : 0,
+
+    # Two-tier forwarding. edges forward batches to forward_address instead of graphite,
+    # a central pencil receives them on forward_bind_address. null disables either.
+    'forward_address' : None,
+    'forward_bind_address' : None,
+
+    # Seconds the event loop may be held before the stack holding it is logged. 0 disables it
+    'block_threshold' : 0
 }
 
 
@@ -89,17 +358,19 @@ class PencilServer(object):
     The main server.
     Listens on a UDP port for incoming aggregation requests,
     and also provides a TCP port for telnet commands.
+    runs on gevent. the asyncio runtime is a subclass of it (see aio.py).
     """
+    graphite_backend_class = GraphiteBackend
 
     def __init__(self, config_file_path=None, additional_settings=None):
         """
         Takes a single argument - a path to a JSON formatted file, containing a key-value mapping of settings.
         Available settings are listed under DEFAULT_SETTINGS in this module
         """
-        self.settings = DEFAULT_SETTINGS
+        self.settings = dict(DEFAULT_SETTINGS)
 
         if config_file_path is not None:
-            self._load_config(config_file_path)
+            self.settings.update(load_config(config_file_path))
         
         if additional_settings:
             self.settings.update(additional_settings)
@@ -111,39 +382,29 @@ class PencilServer(object):
         
         # Initialize all components
         storage  = []
+        self.graphite = self._setup_graphite_client()
+        self.schedule = self._setup_flush_schedule()
+        self.instrumentation = self._setup_instrumentation()
         self._listener = self._setup_listener(storage)
+        self._tcp_listener = self._setup_tcp_listener()
+        self._batch_listener = self._setup_batch_listener()
         self._management_listener = self._setup_management_server()
-        self.graphite = self._setup_graphite_client()
+        self._workers = self._setup_workers()
+        # sample the event loop on demand (see the profile_start command), and catch it being blocked.
+        self.profiler = SamplingProfiler()
+        self.block_detector = self._setup_block_detector()
 
         # setup some info about the server.
         self._is_running = False
         self.start_date = None
         self.request_count = 0
+        # batches forwarded by edge pencils: merged, merged after their window was flushed, and dropped.
+        self.batch_count = 0
+        self.late_batches = 0
+        self.bad_batches = 0
         logging.info('initialized pencil server')
         
 
-    def _load_config(self, config_file_path):
-        """
-        Load JSON configuration from an external JSON file.
-        """
-        print('loading configuration')
-        
-        try:
-            conf = open(config_file_path, 'r')
-        except IOError:
-            print('Unable to open config file: %s' % (config_file_path))
-            return
-        try:
-            json_data = json.load(conf)
-            self.settings.update(json_data)
-        except ValueError:
-            print('Configuration file is not a valid JSON document: %s' % (config_file_path))
-
-        conf.close()    
-        
-        
-
-    
     def _setup_logging(self):
         """
         Initialize a very basic log file.
@@ -173,27 +434,75 @@ class PencilServer(object):
         """
         self._is_running = True
         self.start_date = datetime.datetime.now()
-
-        logging.info('starting UDP listener')
-        listener = gevent.Greenlet(self._listener.serve_forever)
-        listener.start()
+        self._stopping = Event()
+        self.schedule.start()
+        self.load_snapshot()
+
+        listener = None
+        if self._workers is not None:
+            logging.info('starting %d ingest workers' % (self._workers.count))
+            self._workers.start()
+        else:
+            logging.info('starting UDP listener')
+            listener = gevent.Greenlet(self._listener.serve_forever)
+            listener.start()
+
+        tcp_listener = None
+        if self._tcp_listener is not None:
+            logging.info('starting TCP listener')
+            tcp_listener = gevent.Greenlet(self._tcp_listener.serve_forever)
+            tcp_listener.start()
+
+        batch_listener = None
+        if self._batch_listener is not None:
+            logging.info('starting batch listener')
+            batch_listener = gevent.Greenlet(self._batch_listener.serve_forever)
+            batch_listener.start()
 
         logging.info('starting flush daemon')
         flush_daemon_greenlet = gevent.Greenlet(self._setup_flush_daemon)
         flush_daemon_greenlet.start()
 
+        snapshot_daemon = None
+        if self.settings['snapshot_path'] and self.settings['snapshot_interval']:
+            logging.info('starting snapshot daemon')
+            snapshot_daemon = gevent.Greenlet(self._setup_snapshot_daemon)
+            snapshot_daemon.start()
+
+        heartbeat = None
+        if self.block_detector is not None:
+            logging.info('starting block detector')
+            self.block_detector.start()
+            heartbeat = gevent.Greenlet(self._setup_heartbeat)
+            heartbeat.start()
+
         logging.info('starting command server')
         command_server = gevent.Greenlet(self._management_listener.serve_forever)
         command_server.start()
 
         logging.info('pencil server started, and is accepting requests.')
         # exit when all of them are done.
-        listener.join()
+        if listener is not None:
+            listener.join()
+        if tcp_listener is not None:
+            tcp_listener.join()
+        if batch_listener is not None:
+            batch_listener.join()
         flush_daemon_greenlet.join()
+        if snapshot_daemon is not None:
+            snapshot_daemon.join()
+        if heartbeat is not None:
+            heartbeat.join()
         command_server.join()
 
-        # Flush before stopping the server:
-        self.flush()
+        # Flush before stopping the server, unless the next pencil takes over the window:
+        if not self.settings['snapshot_path'] or not self.save_snapshot(final=True):
+            self.flush(*self.schedule.window())
+        if self._workers is not None:
+            self._workers.stop()
+        if self.block_detector is not None:
+            self.block_detector.stop()
+        self.profiler.stop()
         logging.info('pencil server - all services halted.')
 
 
@@ -202,25 +511,74 @@ class PencilServer(object):
         Stops all services for this server and exits
         """
         # Stop listener
-        logging.info('stopping UDP listener')
-        self._listener.stop()
+        # workers are stopped by start() after the final flush
+        if self._workers is None:
+            logging.info('stopping UDP listener')
+            self._listener.stop()
+        if self._tcp_listener is not None:
+            logging.info('stopping TCP listener')
+            self._tcp_listener.stop()
+        if self._batch_listener is not None:
+            logging.info('stopping batch listener')
+            self._batch_listener.stop()
         # Stop command server
         logging.info('stopping command server')
         self._management_listener.stop()
         # Stop flusing daemon
         logging.info('stopping flush daemon')
         self._is_running = False
+        self._stopping.set()
 
     
     def _setup_listener(self, storage):
         """
-        create a UDP listener instance
+        create a UDP listener instance.
+        in incremental mode, messages are parsed as soon as they arrive
+        instead of being buffered until the next flush.
         """
+        if self.settings['workers']:
+            # the ingest workers receive the datagrams (see workers.py), and this listener is never started.
+            # it must not bind the address the workers share: a plain listener only binds when started.
+            return create_datagram_server(self.settings['bind_adress'], message_buffer=storage)
+
+        message_handler = None
+        if self.settings['ingest_mode'] == 'incremental':
+            message_handler = self.handle_message
+
         return create_datagram_server(
             self.settings['bind_adress'],
-            message_buffer=storage
+            message_buffer=storage,
+            message_handler=message_handler,
+            receive_mode=self.settings['receive_mode'],
+            batch_size=self.settings['receive_batch_size'],
+            receive_buffer_size=self.settings['receive_buffer_size']
         )
     
+    def _setup_tcp_listener(self):
+        """
+        create a TCP listener instance, if configured.
+        it always parses lines as they arrive.
+        """
+        if not self.settings['tcp_bind_address']:
+            return None
+        return create_stream_server(self.settings['tcp_bind_address'], message_handler=self.handle_lines)
+
+    def _setup_batch_listener(self):
+        """
+        create a listener for the batches of edge pencils, if this is a central pencil.
+        """
+        if not self.settings['forward_bind_address']:
+            return None
+        return create_batch_server(self.settings['forward_bind_address'], batch_handler=self.handle_batch)
+
+    def _setup_workers(self):
+        """
+        create a pool of ingest worker processes, if configured.
+        """
+        if not self.settings['workers']:
+            return None
+        return WorkerPool(self, self.settings['workers'])
+
     def _setup_management_server(self):
         """
         create a TCP command server instance
@@ -233,44 +591,335 @@ class PencilServer(object):
     def _setup_graphite_client(self):
         """
         A non-blocking graphite client using gevent's socket library.
+        on an edge pencil, it forwards batches to the central pencil instead.
         """
+        forward_host = None
+        address = self.settings['graphite_address']
+        if self.settings['forward_address']:
+            forward_host = socket.gethostname()
+            address = self.settings['forward_address']
         return Graphite(
-            self.settings['graphite_address'],
-            flush_interval=self.settings['flush_interval']
+            address,
+            flush_interval=self.settings['flush_interval'],
+            timer_engine=self.settings['timer_engine'],
+            timer_percentiles=self.settings['timer_percentiles'],
+            timer_precision=self.settings['timer_precision'],
+            timeout=self.settings['graphite_timeout'],
+            min_backoff=self.settings['graphite_backoff_min'],
+            max_backoff=self.settings['graphite_backoff_max'],
+            spool_factory=self._setup_spool,
+            replay_rate=self.settings['spool_replay_rate'],
+            protocol=self.settings['graphite_protocol'],
+            pickle_batch_size=self.settings['graphite_pickle_batch_size'],
+            flush_threadpool=self._setup_flush_threadpool(),
+            counter_ttl=self.settings['counter_ttl'],
+            gauge_ttl=self.settings['gauge_ttl'],
+            timer_ttl=self.settings['timer_ttl'],
+            set_precision=self.settings['set_precision'],
+            set_ttl=self.settings['set_ttl'],
+            limiter=self._setup_cardinality_limiter(),
+            history=self._setup_history(),
+            backend_class=self.graphite_backend_class,
+            forward_host=forward_host
+        )
+
+    def _setup_flush_threadpool(self):
+        """
+        threads formatting swapped out aggregates off the event loop, if configured.
+        """
+        if not self.settings['flush_threads']:
+            return None
+        return ThreadPool(self.settings['flush_threads'])
+
+    def _setup_cardinality_limiter(self):
+        """
+        caps the amount of distinct keys, if configured.
+        """
+        if not self.settings['max_keys'] and not self.settings['max_keys_per_prefix']:
+            return None
+        return CardinalityLimiter(
+            max_keys=self.settings['max_keys'],
+            max_keys_per_prefix=self.settings['max_keys_per_prefix'],
+            prefix_depth=self.settings['cardinality_prefix_depth'],
+            policy=self.settings['cardinality_policy'],
+            overflow_key=self.settings['cardinality_overflow_key'],
+            top_k=self.settings['cardinality_top_k']
+        )
+
+    def _setup_history(self):
+        """
+        keeps the recently flushed values of every stat, if enabled.
+        """
+        if not self.settings['history_size']:
+            return None
+        return History(self.settings['history_size'], memory_limit=self.settings['history_memory_limit'])
+
+    def _setup_instrumentation(self):
+        """
+        keeps track of pencil's own numbers, if enabled.
+        """
+        if not self.settings['instrumentation']:
+            return None
+        return Instrumentation(self, prefix=self.settings['instrumentation_prefix'])
+
+    def _setup_spool(self, graphite_address):
+        """
+        A bounded spool for data that could not be delivered to a graphite backend.
+        """
+        path = self.settings['spool_path']
+        if path is not None and self.settings['forward_address']:
+            # batches for the central pencil, never mixed up with graphite data.
+            path = '%s.forward' % (path)
+        elif path is not None and isinstance(self.settings['graphite_address'], list):
+            path = '%s.%s' % (path, graphite_address.replace(':', '_'))
+        return Spool(
+            path,
+            memory_limit=self.settings['spool_memory_limit'],
+            disk_limit=self.settings['spool_disk_limit'],
+            drop_policy=self.settings['spool_drop_policy'],
+            max_age=self.settings['spool_max_age']
+        )
+
+    def _setup_block_detector(self):
+        """
+        catches the event loop being blocked, if enabled.
+        """
+        if not self.settings['block_threshold']:
+            return None
+        return BlockDetector(self.settings['block_threshold'])
+
+    def _setup_flush_schedule(self):
+        """
+        when to flush, and the window every flush covers.
+        """
+        return FlushSchedule(
+            self.settings['flush_interval'],
+            jitter=self.settings['flush_jitter'],
+            overrun=self.settings['flush_overrun'],
+            delay=self.settings['flush_delay']
         )
 
     def _setup_flush_daemon(self):
         """
-        runs the flush() command every X (configurable) seconds.
+        runs the flush() command on every window of the flush schedule.
+        flushes run one at a time. windows a slow flush runs past are dealt with by the schedule.
         """
-        interval = self.settings['flush_interval']
-        g = None
+        schedule = self.schedule
         while self._is_running:
-            g = gevent.Greenlet(self.flush)
-            g.start_later(interval)
-            gevent.sleep(interval)
-        
-        if g is not None:
-            g.join()
+            self._stopping.wait(schedule.delay())
+            if not self._is_running:
+                break
+            try:
+                self.flush(*schedule.window())
+            except Exception:
+                # keep flushing the next windows.
+                logging.exception('flushing the window ending at %d failed' % (schedule.window()[0]))
+            schedule.advance()
+
+
+    def _setup_snapshot_daemon(self):
+        """
+        writes a checkpoint snapshot every X (configurable) seconds.
+        """
+        interval = self.settings['snapshot_interval']
+        while self._is_running:
+            self._stopping.wait(interval)
+            if not self._is_running:
+                break
+            self.save_snapshot()
+
+
+    def _setup_heartbeat(self):
+        """
+        ticks the block detector for as long as the event loop is free to run it.
+        """
+        detector = self.block_detector
+        while self._is_running:
+            self._stopping.wait(detector.tick_interval)
+            detector.tick()
+
+
+    def save_snapshot(self, final=False):
+        """
+        Write a snapshot of the current window's aggregates and of the output
+        not delivered to graphite yet. returns False if the snapshot could not be written.
+        """
+        if self._workers is not None:
+            self._workers.collect()
+        queue = self._listener.message_buffer
+        self._listener.message_buffer = []
+        self.request_count += len(queue)
+        for message in queue:
+            self.graphite.parse(message)
+
+        path = self.settings['snapshot_path']
+        start = time.time()
+        timestamp, interval = self.schedule.window()
+        spools = dict((backend.address, backend.spool.memory_records()) for backend in self.graphite.backends)
+        try:
+            write_snapshot(path, self.graphite.checkpoint(), spools, timestamp, interval, final=final)
+        except (IOError, OSError) as e:
+            logging.error('could not write a snapshot to %s: %s' % (path, e))
+            return False
+        log = logging.info if final else logging.debug
+        log('wrote a snapshot to %s in %.3f seconds' % (path, time.time() - start))
+        return True
 
 
-    def flush(self):
+    def load_snapshot(self):
+        """
+        Pick up the snapshot left behind by the previous pencil, if any.
+        aggregates of the current window are merged into this one. aggregates of a window that
+        ended while pencil was down are sent on the next flush, stamped with their own window.
+        undelivered output is spooled again.
+        """
+        path = self.settings['snapshot_path']
+        if not path or not os.path.exists(path):
+            return
+        start = time.time()
+        try:
+            snapshot = read_snapshot(path)
+        except (IOError, ValueError) as e:
+            logging.error('could not load the snapshot at %s: %s' % (path, e))
+            return
+        # a snapshot is only ever loaded once.
+        os.remove(path)
+
+        graphite = self.graphite
+        backends = dict((backend.address, backend) for backend in graphite.backends)
+        for address, records in iteritems(snapshot['spools']):
+            backend = backends.get(address)
+            if backend is None:
+                logging.warning('dropping %d spooled messages for %s, which is no longer a graphite backend' % (
+                    len(records), address
+                ))
+                continue
+            for spooled_at, msg in records:
+                backend.spool.append(msg, spooled_at)
+
+        state = snapshot['state']
+        if snapshot['timestamp'] >= self.schedule.window()[0]:
+            graphite.merge(state)
+        elif snapshot['final']:
+            state['interval'] = snapshot['interval']
+            for backend, (msg, count) in iteritems(graphite.format(state, snapshot['timestamp'])):
+                backend.spool.append(msg)
+        else:
+            logging.warning('discarding the checkpoint of the window ending at %d, '
+                            'which was most likely flushed already' % (snapshot['timestamp']))
+        logging.info('loaded the snapshot at %s in %.3f seconds' % (path, time.time() - start))
+
+
+    def handle_message(self, message):
+        """
+        Parse a single incoming message into the graphite client's aggregators.
+        """
+        self.request_count += 1
+        self._parse(message)
+
+
+    def handle_lines(self, lines):
+        """
+        Parse a chunk of newline delimited lines read over TCP.
+        every line counts as a packet, like the datagram it would take over UDP.
+        """
+        self.request_count += lines.count(b'\n') + 1
+        self._parse(lines)
+
+
+    def _parse(self, message):
+        if self.instrumentation is None:
+            self.graphite.parse(message)
+            return
+        start = time.time()
+        self.graphite.parse(message)
+        self.instrumentation.parse_time += time.time() - start
+
+
+    def handle_batch(self, payload):
+        """
+        Merge a batch of partial aggregates forwarded by an edge pencil into the current window.
+        a batch of a window that was flushed already goes out with the current one.
+        """
+        try:
+            batch = unpack_batch(payload)
+        except ValueError as e:
+            logging.error('dropping a bad batch: %s' % (e))
+            self.bad_batches += 1
+            return
+        self.batch_count += 1
+        if batch['timestamp'] < self.schedule.window()[0]:
+            logging.warning('the batch of %s for the window ending at %d arrived after it was flushed, '
+                            'consider a longer flush_delay' % (batch['host'], batch['timestamp']))
+            self.late_batches += 1
+        self.graphite.merge(batch['state'])
+
+
+    def flush(self, timestamp=None, interval=None):
         """
         Flush data to graphite.
         the graphite client shoud take all requests that were aggregated so far,
-        crunch them and send the relevant graph data to graphite.
+        crunch them and send the relevant graph data to graphite, stamped with `timestamp`.
+        in incremental mode the message buffer is always empty,
+        so this only formats and sends the aggregated data.
         """
         logging.debug('flushing message buffer')
-        queue = []
-        for msg in self._listener.message_buffer:
-            queue.append(msg)
-            self.request_count += 1
-        self._listener.message_buffer = []
+        queue = self._take_messages()
+
+        with self._instrumented_flush():
+            # Aggregate and send over TCP
+            logging.debug('sending the following data to graphite client: %s' % (queue))
+            self.graphite.write(queue, timestamp, interval)
+
 
-        # Aggregate and send over TCP
-        logging.debug('sending the following data to graphite client: %s' % (queue))
-        self.graphite.write(queue)
+    def _take_messages(self):
+        """
+        Take the messages buffered (and the partial aggregates of the ingest workers) so far, to be flushed.
+        """
+        with self.graphite.timed('copy'):
+            if self._workers is not None:
+                self._workers.collect()
+            queue = self._listener.message_buffer
+            self._listener.message_buffer = []
+            self.request_count += len(queue)
+        return queue
+
+
+    @contextmanager
+    def _instrumented_flush(self):
+        """
+        Record pencil's own numbers, and time the flush in the block.
+        """
+        # pencil's own numbers go out with this flush. the ones about flushing are those of the previous flush.
+        start = time.time()
+        if self.instrumentation is not None:
+            self.instrumentation.record()
+        yield
+        if self.instrumentation is not None:
+            self.instrumentation.flush_duration = time.time() - start
+            self.instrumentation.flushes += 1
+
+
+
+def load_config(config_file_path):
+    """
+    Load JSON configuration from an external JSON file.
+    """
+    print('loading configuration')
+    
+    try:
+        conf = open(config_file_path, 'r')
+    except IOError:
+        print('Unable to open config file: %s' % (config_file_path))
+        return {}
+    try:
+        json_data = json.load(conf)
+    except ValueError:
+        print('Configuration file is not a valid JSON document: %s' % (config_file_path))
+        json_data = {}
 
+    conf.close()    
+    return json_data
 
 
 def main():
@@ -279,8 +928,23 @@ def main():
     except IndexError:
         config_path = None
     
+    settings = {}
+    if config_path is not None:
+        settings = load_config(config_path)
+
+    runtime = settings.get('runtime', DEFAULT_SETTINGS['runtime'])
+    if runtime == 'asyncio':
+        if sys.version_info < (3, 7):
+            raise ValueError('the asyncio runtime needs python 3.7 and up')
+        from .aio import AsyncioPencilServer as server_class
+    elif runtime == 'gevent':
+        if gevent is None:
+            raise ImportError('the gevent runtime needs gevent installed')
+        server_class = PencilServer
+    else:
+        raise ValueError('unknown runtime: %s' % (runtime))
     
-    server = PencilServer(config_path)
+    server = server_class(additional_settings=settings)
     server.start()
 
 
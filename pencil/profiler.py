@@ -0,0 +1,176 @@
+"""
+Looking into the event loop.
+pencil does everything - receiving, parsing, flushing, serving commands - on a single
+event loop in the main thread (gevent's hub, or asyncio's loop). when the loop falls
+behind, the kernel starts dropping datagrams, and the question is where the time goes.
+
+Two tools answer it. both run in a native thread, looking at the stack of the main
+thread (`sys._current_frames`), so they see whichever greenlet or task is running,
+need no cooperation from the code they look at, and work the same on both runtimes:
+
+1. SamplingProfiler - samples the main thread's stack every few milliseconds, for a
+   fixed duration, and counts the functions seen running (self) and anywhere on the
+   stack (total). started and stopped by the command server's `profile_start` and
+   `profile_stop` commands.
+2. BlockDetector - the event loop ticks a heartbeat several times per threshold.
+   when the heartbeat stops for longer than the threshold, something holds the loop
+   without yielding to it: the stack of the main thread is recorded and logged,
+   and recent blocks are listed by the command server's `blocks` command.
+"""
+
+import sys
+import time
+import logging
+import threading
+import traceback
+from collections import deque
+
+from .compat import iteritems, monotonic
+
+
+def function_name(code):
+    return '%s (%s:%d)' % (code.co_name, code.co_filename, code.co_firstlineno)
+
+
+class SamplingProfiler(object):
+    """
+    Samples the stack of a thread (the one creating the profiler, by default),
+    every `interval` seconds while it is running.
+    """
+    def __init__(self, thread_ident=None):
+        if thread_ident is None:
+            thread_ident = threading.current_thread().ident
+        self.thread_ident = thread_ident
+        self.interval = None
+        self.duration = 0.0
+        self.samples = 0
+        # code object -> the amount of samples it was running in, and on the stack of.
+        self.self_counts = {}
+        self.total_counts = {}
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, duration, interval=0.005):
+        """
+        Start sampling for `duration` seconds, dropping the results of the previous run.
+        """
+        if self.running:
+            raise ValueError('the profiler is already running')
+        self.interval = interval
+        self.duration = 0.0
+        self.samples = 0
+        self.self_counts = {}
+        self.total_counts = {}
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, args=(duration,), name='pencil profiler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop sampling, if still running.
+        """
+        # wakes the sampling thread up right away, so the caller's event loop isn't held for an interval.
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self, duration):
+        start = monotonic()
+        deadline = start + duration
+        while monotonic() < deadline:
+            self.sample()
+            if self._stopped.wait(self.interval):
+                break
+        self.duration = monotonic() - start
+
+    def sample(self):
+        frame = sys._current_frames().get(self.thread_ident)
+        if frame is None:
+            return
+        self.samples += 1
+        code = frame.f_code
+        self.self_counts[code] = self.self_counts.get(code, 0) + 1
+        # recursive functions count once per sample.
+        seen = set()
+        while frame is not None:
+            code = frame.f_code
+            if code not in seen:
+                seen.add(code)
+                self.total_counts[code] = self.total_counts.get(code, 0) + 1
+            frame = frame.f_back
+
+    def top(self, n=20):
+        """
+        The `n` functions seen running in most samples,
+        as (function, self samples, total samples) tuples.
+        """
+        counts = sorted(iteritems(self.self_counts), key=lambda item: item[1], reverse=True)[:n]
+        return [(function_name(code), count, self.total_counts[code]) for code, count in counts]
+
+
+class BlockDetector(object):
+    """
+    Records the stack of a thread (the one creating the detector, by default)
+    whenever its event loop stops ticking `tick` for over `threshold` seconds.
+    the last `history` blocks are kept.
+    """
+    def __init__(self, threshold, history=20, thread_ident=None):
+        if thread_ident is None:
+            thread_ident = threading.current_thread().ident
+        self.thread_ident = thread_ident
+        self.threshold = threshold
+        # how often the event loop should tick, and the detector check on it.
+        self.tick_interval = threshold / 4.0
+        self.ticks = 0
+        self.blocks = 0
+        self.recent = deque(maxlen=history)
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def tick(self):
+        """
+        Called by the event loop, every `tick_interval` seconds.
+        """
+        self.ticks += 1
+
+    def start(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name='pencil block detector')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        ticks = self.ticks
+        last_tick = monotonic()
+        block = None
+        while not self._stopped.wait(self.tick_interval):
+            now = monotonic()
+            if self.ticks != ticks:
+                ticks = self.ticks
+                last_tick = now
+                block = None
+                continue
+            if block is not None:
+                # still blocked.
+                block['duration'] = now - last_tick
+            elif now - last_tick > self.threshold:
+                block = self.record(now - last_tick)
+
+    def record(self, duration):
+        frame = sys._current_frames().get(self.thread_ident)
+        stack = ''.join(traceback.format_stack(frame)) if frame is not None else ''
+        block = {'time': time.time(), 'duration': duration, 'stack': stack}
+        self.blocks += 1
+        self.recent.append(block)
+        logging.warning('the event loop is blocked for over %.3f seconds, in:\n%s' % (duration, stack))
+        return block
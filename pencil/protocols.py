@@ -0,0 +1,72 @@
+"""
+Graphite wire protocols.
+A protocol turns the stats crunched at flush time - a list of (name, value)
+pairs sharing a single timestamp - into a message ready to be written to carbon.
+
+1. line - the plaintext protocol, one "name value timestamp" line per stat.
+   carbon listens for it on port 2003 by default.
+2. pickle - carbon's pickle protocol. stats are sent in batches of pickled
+   [(name, (timestamp, value)), ...] lists, each prefixed by its length.
+   carbon listens for it on port 2004 by default. cheaper to build and
+   to parse than the line protocol for large flushes.
+"""
+
+import struct
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from .compat import xrange, to_bytes
+
+FRAME_HEADER = struct.Struct('!L')
+
+
+class LineProtocol(object):
+
+    def serialize(self, stats, timestamp):
+        suffix = ' %s\n' % (timestamp)
+        return to_bytes(''.join(['%s %s%s' % (name, value, suffix) for name, value in stats]))
+
+    def count(self, msg):
+        """
+        The amount of stats in a serialized message.
+        """
+        return msg.count(b'\n')
+
+
+class PickleProtocol(object):
+
+    def __init__(self, batch_size=500):
+        self.batch_size = batch_size
+
+    def serialize(self, stats, timestamp):
+        frames = []
+        for i in xrange(0, len(stats), self.batch_size):
+            batch = [(name, (timestamp, value)) for name, value in stats[i:i + self.batch_size]]
+            payload = pickle.dumps(batch, 2)
+            frames.append(FRAME_HEADER.pack(len(payload)))
+            frames.append(payload)
+        return b''.join(frames)
+
+    def count(self, msg):
+        """
+        The amount of stats in a serialized message.
+        only used for spooled messages, so unpickling the frames is affordable.
+        """
+        count = 0
+        offset = 0
+        while offset < len(msg):
+            length, = FRAME_HEADER.unpack_from(msg, offset)
+            offset += FRAME_HEADER.size
+            count += len(pickle.loads(msg[offset:offset + length]))
+            offset += length
+        return count
+
+
+def create_protocol(name, batch_size=500):
+    if name == 'line':
+        return LineProtocol()
+    elif name == 'pickle':
+        return PickleProtocol(batch_size)
+    raise ValueError('unknown graphite protocol: %s' % (name))
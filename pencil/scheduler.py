@@ -0,0 +1,117 @@
+"""
+The flush schedule.
+Flushes happen on interval boundaries of the wall clock (every :00, :10, :20...
+for a 10 seconds interval), so every pencil of a fleet flushes windows covering
+the same time range, and every window is stamped with the boundary it ends at,
+no matter how long parsing or flushing took.
+
+Waiting is done on a monotonic clock, so flushes don't drift with the time each
+flush takes. the wall clock is only read to pick the boundaries, and again when
+it was stepped (NTP, a resumed VM) to re-align them.
+
+An optional per host offset (jitter) spreads the flushes of a large fleet over a
+part of the interval, so carbon isn't hit by every pencil at the same second.
+the offset delays when a window is sent, not its boundary or its timestamp.
+a fixed delay can be added to it, so a central pencil flushes a window only once
+the edge pencils forwarding to it (see forward.py) had the time to send theirs.
+
+A flush running longer than the interval overruns the boundaries that passed
+meanwhile. there is never more than a single flush running: the windows that
+were overrun are either merged, and flushed as soon as the slow flush is done,
+stamped with the last boundary that passed, or skipped, and flushed along with
+the window of the next boundary.
+"""
+
+import time
+import socket
+import logging
+
+from .compat import monotonic
+from .hashing import compact_hash
+
+# how far apart (in seconds) the wall and the monotonic clocks may drift before re-aligning.
+MAX_CLOCK_STEP = 1.0
+
+
+def host_offset(host, jitter):
+    """
+    A stable offset in [0, jitter) seconds for `host`.
+    """
+    return compact_hash(host) / 65536.0 * jitter
+
+
+class FlushSchedule(object):
+
+    def __init__(self, interval, jitter=0, host=None, overrun='merge', delay=0,
+                 clock=monotonic, wall_clock=time.time):
+        if overrun not in ('merge', 'skip'):
+            raise ValueError('unknown flush overrun policy: %s' % (overrun))
+        self.interval = interval
+        self.offset = delay
+        if jitter:
+            self.offset += host_offset(host or socket.gethostname(), min(jitter, interval))
+        self.overrun = overrun
+        self.clock = clock
+        self.wall_clock = wall_clock
+
+        # wall clock time of the boundary closing the current window, and the one before it.
+        self.boundary = None
+        self.last_boundary = None
+        # monotonic time the current window is due at (its boundary, plus the offset).
+        self.deadline = None
+        self._clock_offset = None
+        # flushes that ran past the next window's deadline.
+        self.overruns = 0
+
+    def start(self):
+        """
+        Pick the boundary closing the current window.
+        the first window is cut short: it starts now, and ends at the next boundary.
+        """
+        now = self.wall_clock()
+        mono = self.clock()
+        self._clock_offset = now - mono
+        self.boundary = (int(now // self.interval) + 1) * self.interval
+        # so per second rates of the first window are over the seconds it actually covers.
+        self.last_boundary = now
+        self.deadline = mono + (self.boundary - now) + self.offset
+
+    def delay(self):
+        """
+        Seconds left until the current window is due.
+        """
+        return max(0, self.deadline - self.clock())
+
+    def window(self):
+        """
+        (timestamp, interval) of the current window: the boundary it ends at,
+        and the seconds it covers.
+        """
+        return int(self.boundary), self.boundary - self.last_boundary
+
+    def advance(self):
+        """
+        Move on to the next window, once the current one was flushed.
+        """
+        interval = self.interval
+        if abs(self.wall_clock() - self.clock() - self._clock_offset) > MAX_CLOCK_STEP:
+            logging.warning('the wall clock was stepped, re-aligning flushes')
+            self.start()
+            return
+
+        self.last_boundary = self.boundary
+        self.boundary += interval
+        self.deadline += interval
+        late = self.clock() - self.deadline
+        if late <= 0:
+            return
+
+        self.overruns += 1
+        missed = int(late // interval)
+        if self.overrun == 'skip':
+            # wait for the next boundary to come.
+            missed += 1
+        self.boundary += missed * interval
+        self.deadline += missed * interval
+        logging.warning('the last flush overran the next window by %.3f seconds, '
+                        'the next flush covers %d windows' % (late, missed + 1))
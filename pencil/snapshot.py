@@ -0,0 +1,185 @@
+"""
+Snapshots of pencil's in flight state, so restarts don't lose data.
+A snapshot holds the aggregates of the current flush window (counters, the
+last value of every gauge, timers of either engine and set sketches) along with the output
+not delivered to graphite yet (the in memory part of every backend's spool;
+the disk part is recovered by the spool itself).
+
+Snapshots are written on shutdown instead of the final flush, and optionally
+every few seconds as checkpoints against crashes. a snapshot is written to a
+temporary file first and renamed into place, so a crash while writing never
+leaves a broken snapshot behind.
+
+The format is a header followed by five sections, all in network byte order:
+
+    header:   [magic: 8 bytes][version: 2 bytes][final: 1 byte][window timestamp: 8 bytes][window interval: 8 bytes]
+    counters: [amount: 4 bytes] ([key][value: 8 bytes]) ...
+    gauges:   [amount: 4 bytes] ([key][value: 8 bytes]) ...
+    timers:   [amount: 4 bytes] ([key][engine: 1 byte][packed timer]) ...
+    sets:     [amount: 4 bytes] ([key][packed sketch]) ...
+    spools:   [amount: 4 bytes] ([backend address][amount: 4 bytes] ([timestamp: 8 bytes][message]) ...) ...
+
+keys, addresses and messages are prefixed by their length (4 bytes).
+version 1 snapshots, written before set metrics existed, have no sets section.
+"""
+
+import os
+import struct
+
+from .compat import xrange, iteritems, to_bytes, to_str
+from .timers import RawTimer, HistogramTimer
+from .hll import HyperLogLog
+
+MAGIC = b'PNCLSNAP'
+VERSION = 2
+# snapshots of these versions are read too.
+SUPPORTED_VERSIONS = (1, 2)
+HEADER = struct.Struct('!8sHBdd')
+AMOUNT = struct.Struct('!I')
+VALUE = struct.Struct('!d')
+ENGINE = struct.Struct('!B')
+
+# timer engine ids, see timers.py
+TIMER_TYPES = (RawTimer, HistogramTimer)
+
+
+def pack_string(s):
+    s = to_bytes(s)
+    return AMOUNT.pack(len(s)) + s
+
+
+def unpack_string(data, offset):
+    length, = AMOUNT.unpack_from(data, offset)
+    offset += AMOUNT.size
+    end = offset + length
+    if end > len(data):
+        raise ValueError('truncated snapshot')
+    return data[offset:end], end
+
+
+def pack_state(state):
+    """
+    The counters, gauges, timers and sets of `state` (see Graphite.snapshot), as bytes.
+    """
+    chunks = []
+    for kind in ('counters', 'gauges'):
+        values = state[kind]
+        chunks.append(AMOUNT.pack(len(values)))
+        for k, v in iteritems(values):
+            chunks.append(pack_string(k))
+            chunks.append(VALUE.pack(v))
+    timers = state['timers']
+    chunks.append(AMOUNT.pack(len(timers)))
+    for k, timer in iteritems(timers):
+        chunks.append(pack_string(k))
+        chunks.append(ENGINE.pack(TIMER_TYPES.index(type(timer))))
+        chunks.append(timer.pack())
+    sets = state['sets']
+    chunks.append(AMOUNT.pack(len(sets)))
+    for k, sketch in iteritems(sets):
+        chunks.append(pack_string(k))
+        chunks.append(sketch.pack())
+    return b''.join(chunks)
+
+
+def unpack_state(data, offset=0, with_sets=True):
+    """
+    A state packed by `pack_state`, and the offset right after it.
+    a state packed without a sets section (by version 1 snapshots) is read with `with_sets` off.
+    """
+    state = {}
+    for kind in ('counters', 'gauges'):
+        values = state[kind] = {}
+        amount, = AMOUNT.unpack_from(data, offset)
+        offset += AMOUNT.size
+        for i in xrange(amount):
+            k, offset = unpack_string(data, offset)
+            values[to_str(k)] = VALUE.unpack_from(data, offset)[0]
+            offset += VALUE.size
+    timers = state['timers'] = {}
+    amount, = AMOUNT.unpack_from(data, offset)
+    offset += AMOUNT.size
+    for i in xrange(amount):
+        k, offset = unpack_string(data, offset)
+        engine, = ENGINE.unpack_from(data, offset)
+        if engine >= len(TIMER_TYPES):
+            raise ValueError('unknown timer engine id: %d' % (engine))
+        timers[to_str(k)], offset = TIMER_TYPES[engine].unpack(data, offset + ENGINE.size)
+    sets = state['sets'] = {}
+    if not with_sets:
+        return state, offset
+    amount, = AMOUNT.unpack_from(data, offset)
+    offset += AMOUNT.size
+    for i in xrange(amount):
+        k, offset = unpack_string(data, offset)
+        sets[to_str(k)], offset = HyperLogLog.unpack(data, offset)
+    return state, offset
+
+
+def write_snapshot(path, state, spools, timestamp, interval, final=False):
+    """
+    Write a snapshot of `state` and of the `spools` (backend address -> [(timestamp, message)...])
+    for the window ending at `timestamp`. `final` marks the snapshot of a server shutting down.
+    """
+    chunks = [HEADER.pack(MAGIC, VERSION, int(final), timestamp, interval), pack_state(state)]
+    chunks.append(AMOUNT.pack(len(spools)))
+    for address, records in iteritems(spools):
+        chunks.append(pack_string(address))
+        chunks.append(AMOUNT.pack(len(records)))
+        for spooled_at, msg in records:
+            chunks.append(VALUE.pack(spooled_at))
+            chunks.append(pack_string(msg))
+
+    tmp_path = path + '.tmp'
+    f = open(tmp_path, 'wb')
+    try:
+        f.write(b''.join(chunks))
+        f.flush()
+        os.fsync(f.fileno())
+    finally:
+        f.close()
+    os.rename(tmp_path, path)
+
+
+def read_snapshot(path):
+    """
+    Read a snapshot written by `write_snapshot`.
+    returns a dict of 'state', 'spools', 'timestamp', 'interval' and 'final'.
+    raises ValueError if the file is not a valid snapshot.
+    """
+    f = open(path, 'rb')
+    try:
+        data = f.read()
+    finally:
+        f.close()
+
+    try:
+        magic, version, final, timestamp, interval = HEADER.unpack_from(data, 0)
+        if magic != MAGIC:
+            raise ValueError('not a pencil snapshot')
+        if version not in SUPPORTED_VERSIONS:
+            raise ValueError('unsupported snapshot version: %d' % (version))
+        state, offset = unpack_state(data, HEADER.size, with_sets=version >= 2)
+
+        spools = {}
+        amount, = AMOUNT.unpack_from(data, offset)
+        offset += AMOUNT.size
+        for i in xrange(amount):
+            address, offset = unpack_string(data, offset)
+            records = spools[to_str(address)] = []
+            count, = AMOUNT.unpack_from(data, offset)
+            offset += AMOUNT.size
+            for j in xrange(count):
+                spooled_at, = VALUE.unpack_from(data, offset)
+                msg, offset = unpack_string(data, offset + VALUE.size)
+                records.append((spooled_at, msg))
+    except struct.error:
+        raise ValueError('truncated snapshot')
+
+    return {
+        'state': state,
+        'spools': spools,
+        'timestamp': int(timestamp),
+        'interval': interval,
+        'final': bool(final),
+    }
@@ -0,0 +1,274 @@
+"""
+A bounded spool for messages that could not be delivered to graphite.
+Messages are kept in memory first. Once `memory_limit` bytes are spooled,
+new messages are appended to a file on disk, which is read back through
+a memory map. The spool is bounded: when it holds more than `memory_limit`
+bytes (without a file), or more than `memory_limit` and `disk_limit` together,
+the oldest messages are dropped. with the 'age' drop policy, messages older than
+`max_age` seconds are dropped as well.
+
+The spool file is append-only. It starts with a header holding the offset
+of the oldest unsent record, followed by the records themselves:
+
+    [read offset: 8 bytes] [timestamp: 8 bytes][length: 4 bytes][message] ...
+
+so a spool file left behind by a previous pencil process is picked up
+and replayed on startup.
+"""
+
+import os
+import time
+import mmap
+import struct
+import logging
+from collections import deque
+
+HEADER = struct.Struct('!Q')
+RECORD = struct.Struct('!dI')
+
+
+class Spool(object):
+    """
+    A FIFO of messages waiting to be sent to graphite.
+    use `peek()` to get the oldest message, and `pop()` once it was sent.
+    """
+    def __init__(self, path=None, memory_limit=16 * 1024 * 1024,
+                 disk_limit=1024 * 1024 * 1024, drop_policy='oldest', max_age=86400):
+        if drop_policy not in ('oldest', 'age'):
+            raise ValueError('unknown spool drop policy: %s' % (drop_policy))
+        self.path = path
+        self.memory_limit = memory_limit
+        self.disk_limit = disk_limit
+        self.drop_policy = drop_policy
+        self.max_age = max_age
+
+        self.dropped = 0
+        self._memory = deque()
+        self.memory_bytes = 0
+
+        self._file = None
+        self._map = None
+        self.disk_records = 0
+        self.read_offset = HEADER.size
+        self.write_offset = HEADER.size
+
+        if path is not None and os.path.exists(path):
+            self._recover()
+
+    def __len__(self):
+        return len(self._memory) + self.disk_records
+
+    @property
+    def disk_bytes(self):
+        return self.write_offset - self.read_offset
+
+    def append(self, msg, timestamp=None):
+        """
+        Spool a message. memory is used until it is full, from then on
+        messages go to disk until the disk tier is drained again,
+        so messages always come out in the order they went in.
+        """
+        if timestamp is None:
+            timestamp = time.time()
+
+        if self.path is None or (self.disk_records == 0 and
+                                 self.memory_bytes + len(msg) <= self.memory_limit):
+            self._memory.append((timestamp, msg))
+            self.memory_bytes += len(msg)
+        else:
+            self._disk_append(timestamp, msg)
+
+        self._enforce_limits()
+
+    def peek(self):
+        """
+        The oldest spooled message, or None if the spool is empty.
+        """
+        record = self._oldest()
+        if record is None:
+            return None
+        return record[1]
+
+    def pop(self):
+        """
+        Remove the oldest spooled message.
+        """
+        if self._memory:
+            timestamp, msg = self._memory.popleft()
+            self.memory_bytes -= len(msg)
+        elif self.disk_records:
+            timestamp, length = RECORD.unpack_from(self._mapped(), self.read_offset)
+            self.read_offset += RECORD.size + length
+            self.disk_records -= 1
+            self._disk_advance()
+
+    def memory_records(self):
+        """
+        (timestamp, message) pairs of the messages spooled in memory, oldest first.
+        unlike the disk tier, these are lost when the process exits.
+        """
+        return list(self._memory)
+
+    def expire(self):
+        """
+        Drop messages older than `max_age` seconds, if the drop policy is 'age'.
+        """
+        if self.drop_policy != 'age':
+            return
+        deadline = time.time() - self.max_age
+        while True:
+            record = self._oldest()
+            if record is None or record[0] >= deadline:
+                break
+            self._drop()
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _oldest(self):
+        if self._memory:
+            return self._memory[0]
+        if self.disk_records:
+            data = self._mapped()
+            timestamp, length = RECORD.unpack_from(data, self.read_offset)
+            start = self.read_offset + RECORD.size
+            return timestamp, data[start:start + length]
+        return None
+
+    def _drop(self):
+        self.pop()
+        self.dropped += 1
+
+    def _enforce_limits(self):
+        self.expire()
+        dropped = 0
+        if self.path is None:
+            while self.memory_bytes > self.memory_limit and len(self._memory) > 1:
+                self.pop()
+                dropped += 1
+        else:
+            # both tiers share a single budget, so only as many of the oldest messages
+            # as it takes to fit are dropped, from whichever tier holds them.
+            # the memory tier holds the oldest ones, when not empty.
+            limit = self.memory_limit + self.disk_limit
+            disk_dropped = 0
+            while self.memory_bytes + self.disk_bytes > limit and len(self) > 1:
+                if self._memory:
+                    timestamp, msg = self._memory.popleft()
+                    self.memory_bytes -= len(msg)
+                else:
+                    timestamp, length = RECORD.unpack_from(self._mapped(), self.read_offset)
+                    self.read_offset += RECORD.size + length
+                    self.disk_records -= 1
+                    disk_dropped += 1
+                dropped += 1
+            if disk_dropped:
+                self._disk_advance()
+
+        if dropped:
+            self.dropped += dropped
+            logging.warning('spool is full, dropped %d messages' % (dropped))
+
+    # Disk tier
+
+    def _open(self, mode):
+        self._file = open(self.path, mode)
+
+    def _disk_append(self, timestamp, msg):
+        if self._file is None:
+            self._open('w+b')
+            self._write_header()
+        self._file.seek(self.write_offset)
+        self._file.write(RECORD.pack(timestamp, len(msg)))
+        self._file.write(msg)
+        self._file.flush()
+        self.write_offset += RECORD.size + len(msg)
+        self.disk_records += 1
+
+    def _mapped(self):
+        """
+        The memory map of the spool file, remapped if the file grew since it was mapped.
+        """
+        if self._map is None or len(self._map) < self.write_offset:
+            if self._map is not None:
+                self._map.close()
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._map
+
+    def _write_header(self):
+        self._file.seek(0)
+        self._file.write(HEADER.pack(self.read_offset))
+        self._file.flush()
+
+    def _disk_advance(self):
+        """
+        Persist the read offset after records were consumed.
+        an empty spool file is truncated, and a mostly consumed one is compacted.
+        """
+        if self.disk_records == 0:
+            self._truncate()
+        elif self.read_offset - HEADER.size > max(self.disk_bytes, self.memory_limit):
+            self._compact()
+        else:
+            self._write_header()
+
+    def _truncate(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self.read_offset = self.write_offset = HEADER.size
+        self._file.truncate(HEADER.size)
+        self._write_header()
+
+    def _compact(self):
+        """
+        Copy the unsent records into a fresh spool file.
+        """
+        data = self._mapped()[self.read_offset:self.write_offset]
+        tmp_path = self.path + '.tmp'
+        tmp = open(tmp_path, 'wb')
+        tmp.write(HEADER.pack(HEADER.size))
+        tmp.write(data)
+        tmp.close()
+        self.close()
+        os.rename(tmp_path, self.path)
+        self._open('r+b')
+        self.read_offset = HEADER.size
+        self.write_offset = HEADER.size + len(data)
+        logging.debug('compacted spool file %s, %d bytes left' % (self.path, len(data)))
+
+    def _recover(self):
+        """
+        Pick up the unsent records of an existing spool file.
+        a torn record at the end of the file is truncated.
+        """
+        self._open('r+b')
+        size = os.fstat(self._file.fileno()).st_size
+        offset = HEADER.size
+        if size >= HEADER.size:
+            offset = HEADER.unpack(self._file.read(HEADER.size))[0]
+        if not HEADER.size <= offset <= size:
+            offset = HEADER.size
+
+        self.read_offset = offset
+        self._file.seek(offset)
+        while offset + RECORD.size <= size:
+            timestamp, length = RECORD.unpack(self._file.read(RECORD.size))
+            if offset + RECORD.size + length > size:
+                break
+            self._file.seek(length, os.SEEK_CUR)
+            offset += RECORD.size + length
+            self.disk_records += 1
+        self.write_offset = offset
+
+        if self.disk_records == 0:
+            self._truncate()
+        else:
+            self._file.truncate(self.write_offset)
+            self._write_header()
+            logging.info('recovered %d spooled messages from %s' % (self.disk_records, self.path))
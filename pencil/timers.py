@@ -0,0 +1,364 @@
+"""
+Timer aggregation engines.
+A timer collects the samples reported for a single key during a flush interval,
+and answers the questions the graphite client asks at flush time:
+count, lower, upper, sum and arbitrary percentiles.
+
+Samples may be reported with a sample rate (e.g. `|@0.1` for one in ten).
+`count` is scaled by the sample rate, so it estimates the real amount of events,
+while `size` is the amount of samples actually received, used for averages and ranks.
+
+Two engines are available:
+
+1. raw - keeps every sample in a contiguous array of doubles. exact,
+   but memory grows with the amount of samples.
+2. histogram - a log-bucketed (HDR-style) histogram. count, lower, upper and sum
+   are exact, percentiles are accurate within a configurable relative error,
+   and memory per key is fixed no matter how many samples arrive.
+
+At flush time, `summarize` crunches all timers at once. When numpy is installed,
+raw timers of all keys are summarized in a single vectorized batch.
+
+Timers of both engines can be packed into bytes and unpacked back (see snapshot.py),
+in network byte order, so packed timers can move between hosts. timers of different
+engines or precisions (from pencils configured differently, see forward.py) merge into a histogram.
+"""
+
+import sys
+import math
+import struct
+from array import array
+
+from .compat import iteritems, array_to_bytes, array_frombytes
+
+NAN = float('nan')
+# count, amount of samples.
+RAW_HEADER = struct.Struct('!dI')
+# precision, count, size, zeros, sum, lower, upper, amount of buckets.
+HISTOGRAM_HEADER = struct.Struct('!ddIIdddI')
+
+try:
+    import numpy
+except ImportError:
+    # numpy is optional, fall back to summarizing one timer at a time.
+    numpy = None
+
+
+def percentile_name(percentile):
+    """
+    The metric suffix for a percentile, e.g. 50 -> 'p50', 99.9 -> 'p999'.
+    """
+    return 'p' + ('%g' % percentile).replace('.', '')
+
+
+def percentile_rank(percentile, count):
+    """
+    The (zero based) nearest-rank index of a percentile in `count` sorted samples.
+    """
+    rank = int(math.ceil(percentile / 100.0 * count)) - 1
+    return min(max(rank, 0), count - 1)
+
+
+class RawTimer(object):
+    """
+    Keeps every sample reported during the flush interval,
+    as unboxed doubles.
+    """
+    def __init__(self):
+        self.samples = array('d')
+        self.count = 0
+
+    def add(self, value, sample_rate=1.0):
+        self.samples.append(value)
+        if sample_rate == 1.0:
+            self.count += 1
+        else:
+            self.count += 1.0 / sample_rate
+
+    def merge(self, other):
+        """
+        Fold the samples of another raw timer into this one.
+        """
+        self.samples.extend(other.samples)
+        self.count += other.count
+
+    @property
+    def size(self):
+        return len(self.samples)
+
+    def values(self):
+        """
+        (value, amount of samples) pairs of the collected samples.
+        """
+        return ((value, 1) for value in self.samples)
+
+    @property
+    def lower(self):
+        return min(self.samples)
+
+    @property
+    def upper(self):
+        return max(self.samples)
+
+    @property
+    def sum(self):
+        return math.fsum(self.samples)
+
+    def percentiles(self, percentiles):
+        """
+        Nearest-rank percentiles of the collected samples.
+        """
+        samples = sorted(self.samples)
+        return [samples[percentile_rank(p, len(samples))] for p in percentiles]
+
+    def percentile(self, percentile):
+        return self.percentiles([percentile])[0]
+
+    def pack(self):
+        """
+        The timer's state, as bytes.
+        """
+        samples = self.samples
+        if sys.byteorder == 'little':
+            samples = array('d', samples)
+            samples.byteswap()
+        return RAW_HEADER.pack(self.count, len(samples)) + array_to_bytes(samples)
+
+    @classmethod
+    def unpack(cls, data, offset=0):
+        """
+        A timer packed by `pack`, and the offset right after it.
+        """
+        count, size = RAW_HEADER.unpack_from(data, offset)
+        offset += RAW_HEADER.size
+        end = offset + size * 8
+        if end > len(data):
+            raise ValueError('truncated raw timer')
+        timer = cls()
+        array_frombytes(timer.samples, data[offset:end])
+        if sys.byteorder == 'little':
+            timer.samples.byteswap()
+        timer.count = count
+        return timer, end
+
+    def __repr__(self):
+        return repr(self.samples.tolist())
+
+
+class HistogramTimer(object):
+    """
+    A log-bucketed histogram.
+    sample `v` is counted in bucket `ceil(log(v) / log(gamma))`, where
+    gamma = (1 + precision) / (1 - precision), so every bucket spans a fixed
+    relative range of values and any percentile read from it is within
+    `precision` of the real value. Values too small to bucket are counted
+    separately as zeros.
+    The amount of buckets only depends on the dynamic range of the samples
+    (about 2,300 buckets cover nanoseconds to years at 1% precision),
+    not on the amount of samples.
+    """
+    min_value = 1e-9
+
+    def __init__(self, precision=0.01):
+        self.precision = precision
+        self.gamma = (1.0 + precision) / (1.0 - precision)
+        self._log_gamma = math.log(self.gamma)
+        self.buckets = {}
+        self.zeros = 0
+        self.count = 0
+        self.size = 0
+        self.lower = None
+        self.upper = None
+        self.sum = 0.0
+
+    def add(self, value, sample_rate=1.0):
+        # bucketing fails on values that can't be bucketed (inf and nan), before any state changes.
+        self._bucket(value, 1)
+        self.size += 1
+        if sample_rate == 1.0:
+            self.count += 1
+        else:
+            self.count += 1.0 / sample_rate
+        self.sum += value
+        if self.lower is None or value < self.lower:
+            self.lower = value
+        if self.upper is None or value > self.upper:
+            self.upper = value
+
+    def _bucket(self, value, amount):
+        if value <= self.min_value:
+            self.zeros += amount
+            return
+        index = int(math.ceil(math.log(value) / self._log_gamma))
+        self.buckets[index] = self.buckets.get(index, 0) + amount
+
+    def values(self):
+        """
+        (value, amount of samples) pairs of the buckets, every bucket represented by its center.
+        """
+        if self.zeros:
+            yield 0.0, self.zeros
+        for index, count in iteritems(self.buckets):
+            yield 2.0 * self.gamma ** index / (self.gamma + 1.0), count
+
+    def merge(self, other):
+        """
+        Fold another timer into this one.
+        the samples of raw timers, and the buckets of histograms of another precision,
+        are re-bucketed at this histogram's precision.
+        """
+        if other.size == 0:
+            return
+        self.count += other.count
+        self.size += other.size
+        self.sum += other.sum
+        if self.lower is None or other.lower < self.lower:
+            self.lower = other.lower
+        if self.upper is None or other.upper > self.upper:
+            self.upper = other.upper
+        if not isinstance(other, HistogramTimer) or other.precision != self.precision:
+            for value, amount in other.values():
+                self._bucket(value, amount)
+            return
+        self.zeros += other.zeros
+        for index, count in iteritems(other.buckets):
+            self.buckets[index] = self.buckets.get(index, 0) + count
+
+    def percentiles(self, percentiles):
+        """
+        Estimate nearest-rank percentiles from the bucket counts,
+        in a single pass over the sorted buckets.
+        estimates are clamped into the exact [lower, upper] range.
+        """
+        ranks = sorted((percentile_rank(p, self.size), i) for i, p in enumerate(percentiles))
+        values = [0.0] * len(percentiles)
+        indexes = iter(sorted(self.buckets))
+        seen = self.zeros
+        value = 0.0
+        for rank, i in ranks:
+            while seen <= rank:
+                index = next(indexes)
+                seen += self.buckets[index]
+                value = 2.0 * self.gamma ** index / (self.gamma + 1.0)
+            values[i] = min(max(value, self.lower), self.upper)
+        return values
+
+    def percentile(self, percentile):
+        return self.percentiles([percentile])[0]
+
+    def pack(self):
+        """
+        The timer's state, as bytes.
+        """
+        indexes = sorted(self.buckets)
+        lower = self.lower if self.lower is not None else NAN
+        upper = self.upper if self.upper is not None else NAN
+        header = HISTOGRAM_HEADER.pack(self.precision, self.count, self.size, self.zeros,
+                                       self.sum, lower, upper, len(indexes))
+        counts = [self.buckets[index] for index in indexes]
+        return header + struct.pack('!%di%dQ' % (len(indexes), len(indexes)), *(indexes + counts))
+
+    @classmethod
+    def unpack(cls, data, offset=0):
+        """
+        A timer packed by `pack`, and the offset right after it.
+        """
+        precision, count, size, zeros, total, lower, upper, buckets = HISTOGRAM_HEADER.unpack_from(data, offset)
+        offset += HISTOGRAM_HEADER.size
+        layout = struct.Struct('!%di%dQ' % (buckets, buckets))
+        values = layout.unpack_from(data, offset)
+        timer = cls(precision)
+        timer.buckets = dict(zip(values[:buckets], values[buckets:]))
+        timer.count = count
+        timer.size = size
+        timer.zeros = zeros
+        timer.sum = total
+        # NaN marks an empty histogram.
+        if lower == lower:
+            timer.lower = lower
+            timer.upper = upper
+        return timer, offset + layout.size
+
+    def __repr__(self):
+        return '<histogram count=%s lower=%s upper=%s buckets=%s>' % (
+            self.count, self.lower, self.upper, len(self.buckets)
+        )
+
+
+def timer_factory(engine, precision=0.01):
+    """
+    Return a callable creating empty timers for the given engine name.
+    """
+    if engine == 'raw':
+        return RawTimer
+    elif engine == 'histogram':
+        return lambda: HistogramTimer(precision)
+    raise ValueError('unknown timer engine: %s' % (engine))
+
+
+def merge_timers(timer, other):
+    """
+    Fold `other` into `timer`, and return the merged timer.
+    timers of different engines (from pencils configured differently) merge into a histogram,
+    which may be `other`.
+    """
+    if isinstance(timer, RawTimer) and not isinstance(other, RawTimer):
+        other.merge(timer)
+        return other
+    timer.merge(other)
+    return timer
+
+
+def _summarize_raw_batch(keys, timers, percentiles):
+    """
+    Summarize many raw timers at once with numpy:
+    all samples are concatenated into one array, and every statistic is a
+    single vectorized operation over the per-key segments of that array.
+    """
+    counts = numpy.array([len(timers[k].samples) for k in keys], dtype=numpy.int64)
+    weighted_counts = [timers[k].count for k in keys]
+    starts = numpy.zeros(len(keys), dtype=numpy.int64)
+    numpy.cumsum(counts[:-1], out=starts[1:])
+    values = numpy.concatenate([numpy.frombuffer(timers[k].samples, dtype=numpy.float64) for k in keys])
+
+    lowers = numpy.minimum.reduceat(values, starts)
+    uppers = numpy.maximum.reduceat(values, starts)
+    sums = numpy.add.reduceat(values, starts)
+
+    # sort the samples within each segment: by key, then by value.
+    segments = numpy.repeat(numpy.arange(len(keys)), counts)
+    ordered = values[numpy.lexsort((values, segments))]
+    columns = []
+    for p in percentiles:
+        ranks = numpy.ceil(p / 100.0 * counts).astype(numpy.int64) - 1
+        ranks = numpy.clip(ranks, 0, counts - 1)
+        columns.append(ordered[starts + ranks].tolist())
+
+    means = sums / counts
+    results = []
+    for i, k in enumerate(keys):
+        results.append((k, weighted_counts[i], float(lowers[i]), float(means[i]), float(sums[i]),
+                        float(uppers[i]), [column[i] for column in columns]))
+    return results
+
+
+def summarize(timers, percentiles):
+    """
+    Calculate the flush statistics of every non-empty timer in `timers`
+    (a key -> timer mapping).
+    returns a list of (key, count, lower, mean, sum, upper, percentile values) tuples.
+    """
+    results = []
+    raw_keys = []
+    for k, t in iteritems(timers):
+        if not t.size > 0:
+            continue
+        if numpy is not None and isinstance(t, RawTimer):
+            raw_keys.append(k)
+        else:
+            total = t.sum
+            results.append((k, t.count, t.lower, total / t.size, total, t.upper, t.percentiles(percentiles)))
+
+    if raw_keys:
+        results.extend(_summarize_raw_batch(raw_keys, timers, percentiles))
+    return results
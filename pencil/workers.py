@@ -0,0 +1,234 @@
+"""
+Multi-process ingest.
+A single pencil process parses and aggregates on a single core. In worker mode,
+the pencil server forks N worker processes, each binding the same UDP address
+with SO_REUSEPORT, so the kernel spreads incoming datagrams between them.
+
+Every worker parses and aggregates locally. At flush time, the main process
+asks all workers for their partial aggregates over a socket pair, merges them
+into its own graphite client, and flushes once. so graphite sees a single series
+per key, no matter how many workers there are.
+
+Workers apply the cardinality limits and TTLs too, so their memory is bounded
+like the main process': keys over a cap are rejected (or folded) as they arrive,
+and keys idle for longer than their TTL are forgotten.
+
+The wire format between the processes is a length-prefixed pickle.
+"""
+
+import os
+import time
+import signal
+import struct
+import logging
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+import gevent
+from gevent import socket
+
+from .compat import xrange
+from .listeners import create_datagram_server
+from .graphite_client import Graphite
+from .cardinality import SpaceSaving
+
+FRAME_HEADER = struct.Struct('!L')
+
+# Commands sent from the main process to the workers.
+COLLECT = b'c'
+QUIT = b'q'
+
+
+def send_frame(sock, obj):
+    payload = pickle.dumps(obj, 2)
+    sock.sendall(FRAME_HEADER.pack(len(payload)) + payload)
+
+
+def recv_exactly(sock, size):
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(min(size, 65536))
+        if not chunk:
+            raise EOFError('connection closed')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def recv_frame(sock):
+    length, = FRAME_HEADER.unpack(recv_exactly(sock, FRAME_HEADER.size))
+    return pickle.loads(recv_exactly(sock, length))
+
+
+class Worker(object):
+    """
+    The worker process side: listen on the shared UDP address,
+    aggregate locally, and hand the partial aggregates over when asked to.
+    """
+    def __init__(self, settings, sock, limiter=None):
+        self.settings = settings
+        self.sock = sock
+        self.request_count = 0
+        self.parse_time = 0.0
+        # used for aggregation only, this client never connects to graphite.
+        self.graphite = Graphite(
+            settings['graphite_address'],
+            flush_interval=settings['flush_interval'],
+            timer_engine=settings['timer_engine'],
+            timer_percentiles=settings['timer_percentiles'],
+            timer_precision=settings['timer_precision'],
+            counter_ttl=settings['counter_ttl'],
+            gauge_ttl=settings['gauge_ttl'],
+            timer_ttl=settings['timer_ttl'],
+            set_precision=settings['set_precision'],
+            set_ttl=settings['set_ttl'],
+            limiter=limiter
+        )
+        self.listener = create_datagram_server(
+            settings['bind_adress'],
+            message_buffer=[],
+            message_handler=self.handle_message,
+            reuse_port=True,
+            receive_mode=settings['receive_mode'],
+            batch_size=settings['receive_batch_size'],
+            receive_buffer_size=settings['receive_buffer_size']
+        )
+
+    def handle_message(self, message):
+        self.request_count += 1
+        start = time.time()
+        self.graphite.parse(message)
+        self.parse_time += time.time() - start
+
+    def collect_rejected(self):
+        """
+        The amount of keys the limiter rejected since the last collection,
+        and the prefixes responsible, as (prefix, count) tuples.
+        """
+        limiter = self.graphite.limiter
+        if limiter is None:
+            return 0, []
+        rejected = limiter.rejected
+        offenders = [(prefix, count) for prefix, count, error in limiter.offenders.top()]
+        limiter.rejected = 0
+        limiter.offenders = SpaceSaving(limiter.offenders.size)
+        return rejected, offenders
+
+    def run(self):
+        listener = gevent.spawn(self.listener.serve_forever)
+        try:
+            while True:
+                command = self.sock.recv(1)
+                if command == COLLECT:
+                    state = self.graphite.snapshot()
+                    self.graphite.expire(state)
+                    state['requests'] = self.request_count
+                    state['rejected'], state['offenders'] = self.collect_rejected()
+                    state['bad_lines'] = self.graphite.bad_lines
+                    state['parse_time'] = self.parse_time
+                    self.request_count = 0
+                    self.graphite.bad_lines = 0
+                    self.parse_time = 0.0
+                    send_frame(self.sock, state)
+                else:
+                    # QUIT, or the main process went away.
+                    break
+        finally:
+            self.listener.stop()
+            listener.kill()
+
+
+class WorkerPool(object):
+    """
+    The main process side: fork the workers, and collect their partial aggregates.
+    """
+    def __init__(self, pencil_server, count):
+        self.pencil_server = pencil_server
+        self.count = count
+        self.workers = []
+
+    def start(self):
+        for i in xrange(self.count):
+            parent_sock, child_sock = socket.socketpair()
+            pid = gevent.fork()
+            if pid == 0:
+                parent_sock.close()
+                self._run_child(child_sock)
+            child_sock.close()
+            self.workers.append((pid, parent_sock))
+            logging.info('started ingest worker %d (pid %d)' % (i, pid))
+
+    def _run_child(self, sock):
+        status = 0
+        try:
+            Worker(self.pencil_server.settings, sock,
+                   limiter=self.pencil_server._setup_cardinality_limiter()).run()
+        except Exception:
+            logging.exception('ingest worker %d crashed' % (os.getpid()))
+            status = 1
+        os._exit(status)
+
+    def collect(self):
+        """
+        Ask all workers for their partial aggregates,
+        and merge them into the pencil server's graphite client.
+        """
+        graphite = self.pencil_server.graphite
+        asked = []
+        for pid, sock in self.workers:
+            try:
+                sock.sendall(COLLECT)
+            except socket.error as e:
+                self._reap(pid, sock, e)
+                continue
+            asked.append((pid, sock))
+        for pid, sock in asked:
+            try:
+                state = recv_frame(sock)
+            except (EOFError, socket.error) as e:
+                self._reap(pid, sock, e)
+                continue
+            self.pencil_server.request_count += state.pop('requests')
+            graphite.bad_lines += state.pop('bad_lines')
+            rejected = state.pop('rejected')
+            offenders = state.pop('offenders')
+            if graphite.limiter is not None:
+                graphite.limiter.rejected += rejected
+                for prefix, count in offenders:
+                    graphite.limiter.offenders.add(prefix, count)
+            if self.pencil_server.instrumentation is not None:
+                self.pencil_server.instrumentation.parse_time += state.pop('parse_time')
+            else:
+                state.pop('parse_time')
+            graphite.merge(state)
+
+    def _reap(self, pid, sock, error):
+        """
+        Forget a worker that can't be collected from anymore (it most likely died),
+        so it doesn't fail every flush from now on.
+        """
+        self.workers.remove((pid, sock))
+        logging.error('could not collect data from ingest worker %d: %s. '
+                      'continuing with %d workers' % (pid, error, len(self.workers)))
+        sock.close()
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except OSError:
+            pass
+        try:
+            os.waitpid(pid, 0)
+        except OSError:
+            pass
+
+    def stop(self):
+        for pid, sock in self.workers:
+            try:
+                sock.sendall(QUIT)
+            except socket.error:
+                pass
+            sock.close()
+        for pid, sock in self.workers:
+            os.waitpid(pid, 0)
+        self.workers = []
@@ -0,0 +1,52 @@
+import unittest
+
+from pencil.cardinality import CardinalityLimiter, SpaceSaving
+
+
+class CardinalityLimiterTest(unittest.TestCase):
+
+    def test_global_cap(self):
+        limiter = CardinalityLimiter(max_keys=2)
+        self.assertEqual([limiter.admit(k) for k in ('a.x', 'b.x', 'c.x')], ['a.x', 'b.x', None])
+        self.assertEqual((limiter.keys, limiter.rejected), (2, 1))
+
+    def test_prefix_cap(self):
+        limiter = CardinalityLimiter(max_keys_per_prefix=1, prefix_depth=2)
+        self.assertEqual(limiter.admit('web.api.a'), 'web.api.a')
+        self.assertEqual(limiter.admit('web.api.b'), None)
+        self.assertEqual(limiter.admit('web.db.a'), 'web.db.a')
+        self.assertEqual(limiter.offenders.top(), [('web.api', 1, 0)])
+
+    def test_overflow_policy(self):
+        limiter = CardinalityLimiter(max_keys=1, policy='overflow', overflow_key='overflow')
+        self.assertEqual(limiter.admit('a'), 'a')
+        self.assertEqual(limiter.admit('b'), 'overflow')
+        self.assertEqual(limiter.admit('overflow'), 'overflow')
+        self.assertEqual(limiter.keys, 1)
+
+    def test_release_frees_admitted_keys_only(self):
+        limiter = CardinalityLimiter(max_keys=1)
+        self.assertEqual(limiter.admit('a.x'), 'a.x')
+        limiter.release('a.y')
+        self.assertEqual((limiter.keys, limiter.prefixes), (1, {'a': 1}))
+        limiter.release('a.x')
+        self.assertEqual((limiter.keys, limiter.prefixes), (0, {}))
+        self.assertEqual(limiter.admit('b.x'), 'b.x')
+
+    def test_unknown_policy(self):
+        self.assertRaises(ValueError, CardinalityLimiter, policy='drop')
+
+
+class SpaceSavingTest(unittest.TestCase):
+
+    def test_heavy_hitters_are_kept(self):
+        sketch = SpaceSaving(2)
+        for item in ['a'] * 10 + ['b', 'c', 'd'] + ['a'] * 5:
+            sketch.add(item)
+        top = sketch.top()
+        self.assertEqual(top[0], ('a', 15, 0))
+        self.assertEqual(len(top), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+import unittest
+
+from pencil.forward import FRAME_HEADER, BatchProtocol, pack_batch, unpack_batch
+from pencil.hll import HyperLogLog
+from pencil.timers import HistogramTimer
+
+
+def make_state():
+    timer = HistogramTimer()
+    timer.add(5.0)
+    hll = HyperLogLog()
+    hll.add('a')
+    hll.add('b')
+    return {'counters': {'c': 2.0}, 'gauges': {'g': 1.0}, 'timers': {'t': timer}, 'sets': {'s': hll}}
+
+
+class BatchTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        frame = pack_batch(make_state(), 1010, 10.0, 'web1')
+        length, = FRAME_HEADER.unpack_from(frame)
+        self.assertEqual(length, len(frame) - FRAME_HEADER.size)
+        batch = unpack_batch(frame[FRAME_HEADER.size:])
+        self.assertEqual((batch['timestamp'], batch['interval'], batch['host']), (1010, 10.0, 'web1'))
+        self.assertEqual(batch['state']['counters'], {'c': 2.0})
+        self.assertEqual(batch['state']['timers']['t'].size, 1)
+        self.assertEqual(batch['state']['sets']['s'].count(), 2)
+
+    def test_rejects_bad_batches(self):
+        payload = pack_batch(make_state(), 1010, 10.0, 'web1')[FRAME_HEADER.size:]
+        for bad in (payload + b'x', payload[:-1], b'NOTPENCIL' + payload[9:]):
+            self.assertRaises(ValueError, unpack_batch, bad)
+
+    def test_count(self):
+        frames = pack_batch(make_state(), 1010, 10.0, 'web1') * 2
+        self.assertEqual(BatchProtocol().count(frames), 8)
+
+
+if __name__ == '__main__':
+    unittest.main()
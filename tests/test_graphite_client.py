@@ -0,0 +1,55 @@
+import logging
+import unittest
+
+from pencil.graphite_client import Graphite
+from pencil.cardinality import CardinalityLimiter
+
+
+class GraphiteTest(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.WARNING)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def graphite(self, **kwargs):
+        return Graphite(['127.0.0.1:2003'], 10, **kwargs)
+
+    def test_parse(self):
+        graphite = self.graphite()
+        graphite.parse(b'hits:1|c\nhits:2|c|@0.5\nload:0.5|g\nt:10|ms\nusers:a|s\nusers:a|s')
+        self.assertEqual(graphite.counters, {'hits': 5.0})
+        self.assertEqual(graphite.gauges, {'load': 0.5})
+        self.assertEqual(graphite.timers['t'].size, 1)
+        self.assertEqual(graphite.sets['users'].count(), 1)
+        self.assertEqual(graphite.bad_lines, 0)
+
+    def test_non_finite_values_are_bad_lines(self):
+        for engine in ('raw', 'histogram'):
+            graphite = self.graphite(timer_engine=engine)
+            graphite.parse(b't:inf|ms\nt:nan|ms\ng:-inf|g\nc:nan|c\nc:1|c|@nan\nt:1|ms')
+            self.assertEqual(graphite.bad_lines, 5)
+            self.assertEqual(graphite.timers['t'].size, 1)
+            self.assertEqual(graphite.counters, {})
+            stats = dict(graphite.crunch(graphite.swap()))
+            self.assertEqual(stats['t.upper'], 1.0)
+
+    def test_idle_keys_expire_after_their_ttl(self):
+        graphite = self.graphite(counter_ttl=1)
+        graphite.parse(b'hits:1|c')
+        self.assertEqual(graphite.swap()['counters'], {'hits': 1.0})
+        self.assertEqual(graphite.swap()['counters'], {'hits': 0})
+        self.assertEqual(graphite.swap()['counters'], {})
+        self.assertEqual(graphite.evicted, 1)
+
+    def test_limiter_applies_to_added_counters(self):
+        graphite = self.graphite(limiter=CardinalityLimiter(max_keys=1))
+        graphite.add_counter('pencil.packets', 1)
+        graphite.parse(b'hits:1|c')
+        self.assertEqual(graphite.counters, {'pencil.packets': 1})
+        self.assertEqual(graphite.limiter.rejected, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
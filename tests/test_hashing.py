@@ -0,0 +1,19 @@
+import unittest
+
+from pencil.hashing import ConsistentHashRing, compact_hash
+
+
+class ConsistentHashRingTest(unittest.TestCase):
+
+    def test_key_hashing_to_a_ring_position(self):
+        ring = ConsistentHashRing([('a', None), ('b', None), ('c', None)])
+        positions = dict(ring.ring)
+        i = 0
+        while compact_hash('key%d' % i) not in positions:
+            i += 1
+        key = 'key%d' % i
+        self.assertEqual(ring.get_node(key), positions[compact_hash(key)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import struct
+import unittest
+
+from pencil.hll import HyperLogLog, HEADER
+
+
+def sketch(members, precision=12):
+    hll = HyperLogLog(precision)
+    for member in members:
+        hll.add(member)
+    return hll
+
+
+def members(start, stop):
+    return ['member%d' % (i) for i in range(start, stop)]
+
+
+class HyperLogLogTest(unittest.TestCase):
+
+    def assertEstimates(self, hll, count, error=0.05):
+        self.assertTrue(abs(hll.count() - count) <= count * error, (hll.count(), count))
+
+    def test_empty(self):
+        self.assertEqual(HyperLogLog().count(), 0)
+
+    def test_duplicates_count_once(self):
+        hll = sketch(['a', 'b', 'a', 'a', 'b'])
+        self.assertEqual(hll.count(), 2)
+
+    def test_sparse_then_dense(self):
+        hll = sketch(members(0, 10))
+        self.assertTrue(hll.registers is None)
+        self.assertEqual(hll.count(), 10)
+        for member in members(10, 10000):
+            hll.add(member)
+        self.assertTrue(hll.sparse is None)
+        self.assertEstimates(hll, 10000)
+
+    def test_merge(self):
+        merged = sketch(members(0, 3000))
+        merged.merge(sketch(members(2000, 5000)))
+        self.assertEqual(merged.count(), sketch(members(0, 5000)).count())
+        self.assertEstimates(merged, 5000)
+
+    def test_merge_sparse_into_dense(self):
+        merged = sketch(members(0, 5000))
+        merged.merge(sketch(members(4990, 5010)))
+        self.assertEqual(merged.count(), sketch(members(0, 5010)).count())
+
+    def test_merge_another_precision(self):
+        merged = sketch(members(0, 3000), precision=12)
+        merged.merge(sketch(members(3000, 6000), precision=10))
+        self.assertEqual(merged.precision, 10)
+        self.assertEqual(merged.count(), sketch(members(0, 6000), precision=10).count())
+
+    def test_pack_round_trip(self):
+        for hll in (sketch(members(0, 5)), sketch(members(0, 5000))):
+            packed = hll.pack()
+            unpacked, offset = HyperLogLog.unpack(packed + b'trailing')
+            self.assertEqual(offset, len(packed))
+            self.assertEqual(unpacked.count(), hll.count())
+            self.assertEqual(unpacked.pack(), packed)
+
+    def test_unpack_rejects_out_of_range_registers(self):
+        sparse = lambda index, rank: HEADER.pack(12, 0, 1) + struct.pack('!HB', index, rank)
+        self.assertRaises(ValueError, HyperLogLog.unpack, sparse(4096, 1))
+        self.assertRaises(ValueError, HyperLogLog.unpack, sparse(5, 0))
+        self.assertRaises(ValueError, HyperLogLog.unpack, sparse(5, 54))
+        self.assertEqual(HyperLogLog.unpack(sparse(5, 53))[0].sparse, {5: 53})
+        dense = HEADER.pack(12, 1, 0) + b'\x36' + b'\x00' * 4095
+        self.assertRaises(ValueError, HyperLogLog.unpack, dense)
+        self.assertRaises(ValueError, HyperLogLog.unpack, HEADER.pack(12, 1, 0) + b'\x00' * 10)
+        self.assertRaises(ValueError, HyperLogLog.unpack, HEADER.pack(20, 0, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
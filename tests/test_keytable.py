@@ -0,0 +1,31 @@
+import unittest
+
+from pencil.keytable import KeyTable
+
+
+class KeyTableTest(unittest.TestCase):
+
+    def test_names(self):
+        table = KeyTable(timer_percentiles=[50, 99.9])
+        self.assertEqual(table.names('counters', 'hits'), ('hits_per_second', 'hits'))
+        self.assertEqual(table.names('gauges', 'load'), ('load',))
+        self.assertEqual(table.names('timers', 't'),
+                         ('t.count', 't.lower', 't.avg', 't.sum', 't.upper', 't.p50', 't.p999'))
+
+    def test_names_are_built_once(self):
+        table = KeyTable()
+        names = table.names('counters', 'hits')
+        self.assertTrue(table.names('counters', 'hits') is names)
+        self.assertEqual(len(table), 1)
+
+    def test_forget(self):
+        table = KeyTable()
+        table.names('sets', 'users')
+        self.assertEqual(table.forget('sets', 'users'), ('users',))
+        self.assertEqual(len(table), 0)
+        # keys that were never flushed are forgotten too.
+        self.assertEqual(table.forget('gauges', 'load'), ('load',))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+import unittest
+
+from pencil.scheduler import FlushSchedule, host_offset
+
+
+class Clock(object):
+    """
+    A wall clock and a monotonic clock, moved by hand.
+    """
+    def __init__(self, now):
+        self.now = now
+        self.mono = 50.0
+
+    def wall(self):
+        return self.now
+
+    def monotonic(self):
+        return self.mono
+
+    def sleep(self, seconds):
+        self.now += seconds
+        self.mono += seconds
+
+
+class FlushScheduleTest(unittest.TestCase):
+
+    def schedule(self, now=1003.5, **kwargs):
+        self.clock = Clock(now)
+        schedule = FlushSchedule(10, clock=self.clock.monotonic, wall_clock=self.clock.wall, **kwargs)
+        schedule.start()
+        return schedule
+
+    def test_first_window_is_cut_short(self):
+        schedule = self.schedule()
+        self.assertEqual(schedule.window(), (1010, 6.5))
+        self.assertEqual(schedule.delay(), 6.5)
+
+    def test_windows_align_to_boundaries(self):
+        schedule = self.schedule()
+        self.clock.sleep(schedule.delay() + 0.3)
+        schedule.advance()
+        self.assertEqual(schedule.window(), (1020, 10))
+        self.assertAlmostEqual(schedule.delay(), 9.7)
+        self.assertEqual(schedule.overruns, 0)
+
+    def test_overrun_merges_windows(self):
+        schedule = self.schedule()
+        self.clock.sleep(schedule.delay() + 25)
+        schedule.advance()
+        self.assertEqual(schedule.overruns, 1)
+        # the overrun windows go out right away, stamped with the last boundary that passed.
+        self.assertEqual(schedule.window(), (1030, 20))
+        self.assertEqual(schedule.delay(), 0)
+
+    def test_overrun_skips_windows(self):
+        schedule = self.schedule(overrun='skip')
+        self.clock.sleep(schedule.delay() + 25)
+        schedule.advance()
+        self.assertEqual(schedule.overruns, 1)
+        self.assertEqual(schedule.window(), (1040, 30))
+        self.assertAlmostEqual(schedule.delay(), 5)
+
+    def test_wall_clock_step_realigns(self):
+        schedule = self.schedule()
+        self.clock.sleep(schedule.delay())
+        self.clock.now += 3600
+        schedule.advance()
+        self.assertEqual(schedule.window(), (4620, 10))
+
+    def test_offset_delays_flushes_not_boundaries(self):
+        schedule = self.schedule(jitter=5, host='web1', delay=1)
+        offset = host_offset('web1', 5)
+        self.assertTrue(0 <= offset < 5)
+        self.assertEqual(schedule.window(), (1010, 6.5))
+        self.assertAlmostEqual(schedule.delay(), 6.5 + 1 + offset)
+
+    def test_unknown_overrun_policy(self):
+        self.assertRaises(ValueError, FlushSchedule, 10, overrun='queue')
+
+
+if __name__ == '__main__':
+    unittest.main()
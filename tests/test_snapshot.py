@@ -0,0 +1,84 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from pencil import snapshot
+from pencil.snapshot import write_snapshot, read_snapshot, pack_state, pack_string
+from pencil.timers import RawTimer, HistogramTimer
+from pencil.hll import HyperLogLog
+
+
+def make_state():
+    raw = RawTimer()
+    raw.add(1.5)
+    raw.add(2.5, 0.5)
+    histogram = HistogramTimer()
+    histogram.add(10.0)
+    hll = HyperLogLog()
+    hll.add('member')
+    return {
+        'counters': {'hits': 3.0},
+        'gauges': {'load': 0.5},
+        'timers': {'raw': raw, 'histogram': histogram},
+        'sets': {'users': hll},
+    }
+
+
+class SnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'pencil.snapshot')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, data):
+        f = open(self.path, 'wb')
+        f.write(data)
+        f.close()
+
+    def test_round_trip(self):
+        spools = {'127.0.0.1:2003': [(1000.0, b'a.b 1 1000\n')]}
+        write_snapshot(self.path, make_state(), spools, 1010, 10.0, final=True)
+        loaded = read_snapshot(self.path)
+        self.assertEqual((loaded['timestamp'], loaded['interval'], loaded['final']), (1010, 10.0, True))
+        self.assertEqual(loaded['spools'], spools)
+        state = loaded['state']
+        self.assertEqual(state['counters'], {'hits': 3.0})
+        self.assertEqual(state['gauges'], {'load': 0.5})
+        self.assertEqual(list(state['timers']['raw'].samples), [1.5, 2.5])
+        self.assertEqual(state['timers']['raw'].count, 3)
+        self.assertTrue(isinstance(state['timers']['histogram'], HistogramTimer))
+        self.assertEqual(state['timers']['histogram'].upper, 10.0)
+        self.assertEqual(state['sets']['users'].count(), 1)
+        self.assertFalse(os.path.exists(self.path + '.tmp'))
+
+    def test_version_1_has_no_sets(self):
+        state = make_state()
+        state['sets'] = {}
+        # a version 1 snapshot is a version 2 one, without the (empty) sets section.
+        data = snapshot.HEADER.pack(snapshot.MAGIC, 1, 0, 1010, 10.0) + pack_state(state)[:-snapshot.AMOUNT.size]
+        data += snapshot.AMOUNT.pack(1) + pack_string('127.0.0.1:2003')
+        data += snapshot.AMOUNT.pack(1) + snapshot.VALUE.pack(1000.0) + pack_string(b'msg')
+        self.write(data)
+        loaded = read_snapshot(self.path)
+        self.assertEqual(loaded['state']['sets'], {})
+        self.assertEqual(loaded['state']['counters'], {'hits': 3.0})
+        self.assertEqual(loaded['spools'], {'127.0.0.1:2003': [(1000.0, b'msg')]})
+
+    def test_rejects_bad_snapshots(self):
+        write_snapshot(self.path, make_state(), {}, 1010, 10.0)
+        f = open(self.path, 'rb')
+        data = f.read()
+        f.close()
+        for bad in (b'NOTPENCIL' + data[9:],
+                    snapshot.HEADER.pack(snapshot.MAGIC, 3, 0, 1010, 10.0),
+                    data[:len(data) // 2]):
+            self.write(bad)
+            self.assertRaises(ValueError, read_snapshot, self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from pencil.spool import Spool
+
+
+def drain(spool):
+    messages = []
+    while spool.peek() is not None:
+        messages.append(spool.peek())
+        spool.pop()
+    return messages
+
+
+class SpoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'pencil.spool')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def message(self, i):
+        return ('%03d' % (i)).encode() * 33 + b'\n'
+
+    def test_memory_only_drops_oldest(self):
+        spool = Spool(memory_limit=300)
+        for i in range(5):
+            spool.append(self.message(i))
+        self.assertEqual(spool.dropped, 2)
+        self.assertEqual(drain(spool), [self.message(i) for i in range(2, 5)])
+
+    def test_memory_then_disk_in_order(self):
+        spool = Spool(self.path, memory_limit=300, disk_limit=10000)
+        for i in range(10):
+            spool.append(self.message(i))
+        self.assertEqual(len(spool.memory_records()), 3)
+        self.assertEqual(spool.disk_records, 7)
+        self.assertEqual(drain(spool), [self.message(i) for i in range(10)])
+        self.assertEqual(spool.disk_bytes, 0)
+        spool.close()
+
+    def test_full_spool_drops_only_what_it_takes(self):
+        spool = Spool(self.path, memory_limit=1000, disk_limit=1000)
+        i = 0
+        while spool.memory_bytes + spool.disk_bytes + 112 <= 2000:
+            spool.append(self.message(i))
+            i += 1
+        self.assertEqual(spool.dropped, 0)
+        spool.append(self.message(i))
+        # a single message over the budget drops the single oldest message, from memory.
+        self.assertEqual(spool.dropped, 1)
+        self.assertEqual(drain(spool), [self.message(j) for j in range(1, i + 1)])
+        spool.close()
+
+    def test_recover_from_file(self):
+        spool = Spool(self.path, memory_limit=0, disk_limit=10000)
+        for i in range(4):
+            spool.append(self.message(i))
+        spool.pop()
+        spool.close()
+        spool = Spool(self.path, memory_limit=0, disk_limit=10000)
+        self.assertEqual(drain(spool), [self.message(i) for i in range(1, 4)])
+        spool.close()
+
+    def test_age_policy_expires_old_messages(self):
+        spool = Spool(drop_policy='age', max_age=60)
+        spool.append(b'old', timestamp=0)
+        spool.append(b'new')
+        spool.expire()
+        self.assertEqual(drain(spool), [b'new'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+import unittest
+
+from pencil.timers import RawTimer, HistogramTimer, merge_timers, summarize
+
+
+class RawTimerTest(unittest.TestCase):
+
+    def test_nearest_rank_percentiles(self):
+        timer = RawTimer()
+        for value in range(100, 0, -1):
+            timer.add(float(value))
+        self.assertEqual(timer.percentiles([50, 90, 99, 100]), [50.0, 90.0, 99.0, 100.0])
+        self.assertEqual((timer.lower, timer.upper, timer.sum), (1.0, 100.0, 5050.0))
+
+    def test_sample_rate_scales_count(self):
+        timer = RawTimer()
+        timer.add(1.0, 0.1)
+        timer.add(2.0, 0.1)
+        self.assertAlmostEqual(timer.count, 20.0)
+        self.assertEqual(timer.size, 2)
+
+    def test_pack_round_trip(self):
+        timer = RawTimer()
+        for value in (3.5, 1.25, 1e6):
+            timer.add(value, 0.5)
+        packed = timer.pack() + b'trailing'
+        unpacked, offset = RawTimer.unpack(packed)
+        self.assertEqual(offset, len(packed) - len(b'trailing'))
+        self.assertEqual(list(unpacked.samples), [3.5, 1.25, 1e6])
+        self.assertEqual(unpacked.count, timer.count)
+
+    def test_truncated(self):
+        timer = RawTimer()
+        timer.add(1.0)
+        self.assertRaises(ValueError, RawTimer.unpack, timer.pack()[:-1])
+
+
+class HistogramTimerTest(unittest.TestCase):
+
+    def fill(self, timer, values):
+        for value in values:
+            timer.add(float(value))
+        return timer
+
+    def test_exact_stats(self):
+        timer = self.fill(HistogramTimer(), range(1, 1001))
+        self.assertEqual((timer.size, timer.count), (1000, 1000))
+        self.assertEqual((timer.lower, timer.upper, timer.sum), (1.0, 1000.0, 500500.0))
+
+    def test_percentiles_within_precision(self):
+        values = range(1, 1001)
+        histogram = self.fill(HistogramTimer(0.01), values)
+        raw = self.fill(RawTimer(), values)
+        percentiles = [50, 90, 99, 99.9]
+        for estimate, exact in zip(histogram.percentiles(percentiles), raw.percentiles(percentiles)):
+            self.assertTrue(abs(estimate - exact) <= exact * 0.01, (estimate, exact))
+
+    def test_zeros(self):
+        timer = self.fill(HistogramTimer(), [0, 0, 0, 10])
+        self.assertEqual(timer.zeros, 3)
+        self.assertEqual(timer.percentile(50), 0.0)
+        self.assertAlmostEqual(timer.percentile(100), 10.0, delta=0.1)
+
+    def test_non_finite_values_leave_the_timer_untouched(self):
+        timer = self.fill(HistogramTimer(), [1, 2])
+        for value in (float('inf'), float('nan')):
+            self.assertRaises((ValueError, OverflowError), timer.add, value)
+        self.assertEqual((timer.size, timer.sum, timer.upper), (2, 3.0, 2.0))
+        self.assertEqual(sum(timer.buckets.values()), 2)
+
+    def test_merge(self):
+        timer = self.fill(HistogramTimer(), [1, 2, 3])
+        timer.merge(self.fill(HistogramTimer(), [4, 100]))
+        self.assertEqual((timer.size, timer.lower, timer.upper, timer.sum), (5, 1.0, 100.0, 110.0))
+        self.assertEqual(sum(timer.buckets.values()), 5)
+
+    def test_merge_another_precision(self):
+        timer = self.fill(HistogramTimer(0.01), [10, 20])
+        timer.merge(self.fill(HistogramTimer(0.05), [30]))
+        self.assertEqual(timer.size, 3)
+        self.assertEqual(sum(timer.buckets.values()), 3)
+        self.assertAlmostEqual(timer.percentile(100), 30.0, delta=30 * 0.06)
+
+    def test_merge_raw_into_histogram(self):
+        raw = RawTimer()
+        raw.add(5.0)
+        histogram = self.fill(HistogramTimer(), [1])
+        merged = merge_timers(raw, histogram)
+        self.assertTrue(merged is histogram)
+        self.assertEqual((merged.size, merged.lower, merged.upper), (2, 1.0, 5.0))
+
+    def test_pack_round_trip(self):
+        timer = self.fill(HistogramTimer(0.02), [0, 1.5, 2, 3000])
+        unpacked, offset = HistogramTimer.unpack(timer.pack())
+        self.assertEqual(offset, len(timer.pack()))
+        for attr in ('precision', 'count', 'size', 'zeros', 'sum', 'lower', 'upper', 'buckets'):
+            self.assertEqual(getattr(unpacked, attr), getattr(timer, attr))
+
+    def test_pack_empty(self):
+        unpacked, offset = HistogramTimer.unpack(HistogramTimer().pack())
+        self.assertEqual((unpacked.size, unpacked.lower, unpacked.upper), (0, None, None))
+
+
+class SummarizeTest(unittest.TestCase):
+
+    def test_summarize_skips_empty_timers(self):
+        raw = RawTimer()
+        for value in (1.0, 2.0, 3.0, 4.0):
+            raw.add(value)
+        timers = {'raw': raw, 'empty': RawTimer(), 'histogram': HistogramTimer()}
+        results = summarize(timers, [50])
+        self.assertEqual(results, [('raw', 4, 1.0, 2.5, 10.0, 4.0, [2.0])])
+
+
+if __name__ == '__main__':
+    unittest.main()